@@ -8,11 +8,18 @@ from PIL import Image, ImageTk  # Pillow muss installiert sein: pip install pill
 import os
 import sys
 import subprocess
-from config import API_URL, STORAGE_RULES, STUDY_ID_PATTERN
+from config import API_URL, STORAGE_RULES, STUDY_ID_PATTERN, ALLOCATOR_DB, INSTRUMENTATION, SERVICE_URL, ROW_CACHE
+from config import LOG_LEVEL, LOG_FILE, LOG_RATE_LIMIT
 import utils as u
 import positions as p
 import validation as v
+import pipeline as pl
+import instrumentation
+import diagnostics
 from redcap_api import download_reference_from_redcap
+from allocator import IdAllocator
+from service import ServiceClient
+from rowcache import RowCache
 
  
 API_TOKEN = ""
@@ -59,13 +66,33 @@ def ask_for_material(parent):
 
 
 def run_validation():
+    if INSTRUMENTATION:
+        instrumentation.enable()
+    cache = None
     try:
         # ===============================
         # 1. Download reference data
         # ===============================
-        reference_rows = download_reference_from_redcap(API_URL, API_TOKEN)
-        #ref_path = "/home/aaron/Desktop/BioVal/data/Ref_file_test.csv" ###
-        u.save_data_as_csv(reference_rows, ref_path)
+        service = ref_csv = allocator = None
+        reference_label = ref_path
+        if ROW_CACHE and not SERVICE_URL:
+            cache = RowCache(ROW_CACHE)
+        if SERVICE_URL:
+            # the validation service (service.py) keeps the reference in memory, nothing is downloaded here
+            service = ServiceClient(SERVICE_URL)
+            reference_label = service.status()["reference"]
+            reference_errors = service.reference_errors()
+        else:
+            reference_rows = download_reference_from_redcap(API_URL, API_TOKEN)
+            #ref_path = "/home/aaron/Desktop/BioVal/data/Ref_file_test.csv" ###
+            # validated in memory; the reference csv is written in the background
+            reference, reference_errors, ref_csv = pl.validate_reference_records(
+                reference_rows, csv_path=ref_path, cache=cache
+            )
+            del reference_rows
+            if ALLOCATOR_DB:
+                allocator = IdAllocator(ALLOCATOR_DB)
+                allocator.reconcile(reference)
 
         # ===============================
         # 2. NEW: Show available positions
@@ -75,9 +102,11 @@ def run_validation():
             messagebox.showinfo("Cancelled", "No biomaterial selected.")
             return
 
-        available_positions = p.get_available_positions(material, reference_rows)
-
-        selected_positions = p.select_positions_for_material(material,available_positions)
+        with instrumentation.span("positions.select"):
+            if service is not None:
+                selected_positions = service.available_positions(material)
+            else:
+                selected_positions = p.select_free_positions(material, reference.occupied_positions)
 
         csv_path = filedialog.asksaveasfilename(
             defaultextension=".csv",
@@ -94,20 +123,14 @@ def run_validation():
         # 3. Continue with import validation
         # ===============================
         import_path = filedialog.askopenfilename(title="Select Import CSV")
-        _, import_rows = u.read_csv(import_path)
-
-        ref_rows, reference_errors = v.validate_reference_file(ref_path, "Reference data")
-        _, import_errors = v.validate_import_file(import_path, "Import file", ref_rows)
-
-        v.check_internal_duplicates(import_rows, "Import file")
-        v.check_internal_duplicates(reference_rows, "Reference data")
-
-        occupied_pos = p.get_occupied_positions(reference_rows)
-        duplicate_positions_count = v.check_duplicate_positions(import_rows, occupied_pos, ref_rows)
-
-        import_rows, labid_messages = u.assign_lab_patient_ids(import_rows, reference_rows)
-        import_rows, instance_messages = u.assign_instances(import_rows, reference_rows)
-        u.save_data_as_csv(import_rows, import_path)
+        if service is not None:
+            import_rows, import_errors, labid_messages, instance_messages, _ = service.check_import(import_path)
+        else:
+            import_rows, import_errors, labid_messages, instance_messages, _ = pl.check_import(
+                import_path, reference, allocator=allocator, cache=cache
+            )
+            with instrumentation.span("reference.write_csv"):
+                ref_csv.wait()
 
         # ===============================
         # 4. Report
@@ -119,24 +142,34 @@ def run_validation():
         )
 
         if report_path:
-            u.write_report(
-                report_path,
-                import_path,
-                import_rows,
-                ref_path,
-                import_errors,
-                reference_errors,
-                labid_messages,
-                instance_messages,
-            )
+            with instrumentation.span("report.write", rows=len(import_rows)):
+                u.write_report(
+                    report_path,
+                    import_path,
+                    import_rows,
+                    reference_label,
+                    import_errors,
+                    reference_errors,
+                    labid_messages,
+                    instance_messages,
+                    metrics=instrumentation.summary() if INSTRUMENTATION else None,
+                )
+            if INSTRUMENTATION:
+                instrumentation.save_json(os.path.splitext(report_path)[0] + "_metrics.json")
             messagebox.showinfo("Success", "Validation completed!")
         else:
             messagebox.showinfo("Success", "Validation completed! No report saved.")
 
     except Exception as e:
         messagebox.showerror("Validation Error", str(e))
+    finally:
+        if cache is not None:
+            cache.save()
+        diagnostics.report_suppressed()
 
 # --- GUI Setup ---
+# no console in the frozen build: the messages then only go to LOG_FILE
+diagnostics.configure(LOG_LEVEL, log_file=LOG_FILE or None, rate_limit=LOG_RATE_LIMIT)
 root = tk.Tk()
 root.title("BioVal – Biorepository Validator")
 root.geometry("700x520")
@@ -0,0 +1,338 @@
+"""
+Persistent lab ID and instance allocator.
+
+utils.assign_lab_patient_ids hands out max(used_lab_ids) + 1 of the current reference snapshot and
+utils.assign_instances the next instance of each study. Two runs at the same time see the same snapshot
+and hand out the same numbers. The IdAllocator keeps the reservations in a local SQLite database that
+all runs share:
+
+- Every run reserves the numbers of a whole import file in one write transaction (BEGIN IMMEDIATE), so
+  concurrent runs get disjoint blocks and the cost is one transaction per file, not per ID.
+- A study ID that is already reserved gets the same lab ID again, a tube that is already reserved the
+  same instance, so two runs importing the same new patient stay consistent.
+- reconcile compares the reservations with each new REDCap snapshot: reservations that arrived in
+  REDCap are marked as uploaded, reservations that conflict with the snapshot are dropped and
+  reservations that were never uploaded are freed after expire_after seconds. The highest numbers seen
+  in REDCap are kept as floors, so an older snapshot of another run can never hand them out again.
+
+The database uses write-ahead logging; keep it on a local disk (SQLite locking is not reliable on
+network shares).
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+EXPIRE_AFTER = 24 * 3600  # seconds until a reservation that was never uploaded is freed
+IN_CHUNK = 500  # host parameters per IN (...) query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lab_ids (
+    lab_id INTEGER PRIMARY KEY,
+    study_id TEXT NOT NULL UNIQUE,
+    session TEXT NOT NULL,
+    reserved_at REAL NOT NULL,
+    uploaded INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS instances (
+    study_id TEXT NOT NULL,
+    tube TEXT NOT NULL,
+    instance INTEGER NOT NULL,
+    session TEXT NOT NULL,
+    reserved_at REAL NOT NULL,
+    uploaded INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (study_id, tube),
+    UNIQUE (study_id, instance)
+);
+CREATE TABLE IF NOT EXISTS floors (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+
+def tube_text(tube_key):
+    """
+    Helper function. Stores a tube key (tube_id or position tuple) as text.
+    """
+    return json.dumps(list(tube_key) if isinstance(tube_key, tuple) else tube_key)
+
+
+def tube_from_text(text):
+    """
+    Helper function. Inverse of tube_text.
+    """
+    tube_key = json.loads(text)
+    return tuple(tube_key) if isinstance(tube_key, list) else tube_key
+
+
+def chunks(values, size=IN_CHUNK):
+    """
+    Helper function. Splits a list into parts of at most size elements.
+    """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class IdAllocator:
+    """
+    Shared store of reserved lab IDs and instances.
+
+    Attributes:
+        path (str): Path of the SQLite database
+        session (str): ID of this run; every reservation records the session that made it
+        expire_after (float): Seconds until a reservation that was never uploaded is freed
+    """
+
+    def __init__(self, path, session=None, expire_after=EXPIRE_AFTER, timeout=30.0):
+        self.path = path
+        self.session = session or uuid.uuid4().hex
+        self.expire_after = expire_after
+        self.lock = threading.Lock()
+        # autocommit mode, transactions are opened explicitly; timeout = waiting for the write lock
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Helper function. Write transaction on the shared database. BEGIN IMMEDIATE takes the write lock
+        up front, so concurrent runs queue for it (up to the connection timeout) instead of failing
+        when a read transaction tries to write.
+        """
+        with self.lock:
+            con = self.connection
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def floor(self, con, kind, key=""):
+        """
+        Helper function. Highest number of a kind seen in REDCap so far (0 if none).
+        """
+        row = con.execute("SELECT value FROM floors WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else 0
+
+    def next_lab_id(self, used_lab_ids=()):
+        """
+        Returns the lab ID the next reservation would get (informational; it is not reserved).
+
+        Args:
+            used_lab_ids (Iterable[int]): Lab IDs of the current reference snapshot
+        """
+        with self.transaction() as con:
+            return self.next_lab_id_in(con, max(used_lab_ids, default=0))
+
+    def next_lab_id_in(self, con, used_max):
+        """
+        Helper function. Next free lab ID inside a transaction.
+        """
+        reserved_max = con.execute("SELECT MAX(lab_id) FROM lab_ids").fetchone()[0] or 0
+        return max(used_max, self.floor(con, "lab_id"), reserved_max) + 1
+
+    def reserve_lab_ids(self, study_ids, used_lab_ids=()):
+        """
+        Core function. Reserves lab IDs for study IDs that have none in the reference snapshot. The new
+        IDs are one consecutive block after everything that is used in REDCap or reserved by any run.
+
+        Args:
+            study_ids (Iterable[str]): Study IDs without a lab ID (duplicates are allowed)
+            used_lab_ids (Iterable[int]): Lab IDs of the current reference snapshot
+
+        Returns:
+            Dict[str, int]: Lab ID per study ID; study IDs reserved before keep their lab ID
+        """
+        study_ids = list(dict.fromkeys(study_ids))
+        if not study_ids:
+            return {}
+        used_lab_ids = set(used_lab_ids)
+        used_max = max(used_lab_ids, default=0)
+
+        with self.transaction() as con:
+            reserved = {}
+            for part in chunks(study_ids):
+                reserved.update(con.execute(
+                    f"SELECT study_id, lab_id FROM lab_ids WHERE study_id IN ({','.join('?' * len(part))})", part
+                ))
+            # a reservation whose lab ID went to another study in REDCap (not reconciled yet) is stale
+            stale = [(lab_id,) for lab_id in reserved.values() if lab_id in used_lab_ids]
+            if stale:
+                con.executemany("DELETE FROM lab_ids WHERE lab_id = ?", stale)
+                reserved = {study_id: lab_id for study_id, lab_id in reserved.items() if lab_id not in used_lab_ids}
+            new = [study_id for study_id in study_ids if study_id not in reserved]
+            if new:
+                start = self.next_lab_id_in(con, used_max)
+                now = time.time()
+                con.executemany(
+                    "INSERT INTO lab_ids (lab_id, study_id, session, reserved_at) VALUES (?, ?, ?, ?)",
+                    [(start + i, study_id, self.session, now) for i, study_id in enumerate(new)],
+                )
+                reserved.update(zip(new, range(start, start + len(new))))
+        return {study_id: reserved[study_id] for study_id in study_ids}
+
+    def reserve_instances(self, tubes, study_to_max_instance=None):
+        """
+        Core function. Reserves instances for tubes that are not in the reference snapshot. The new
+        instances of a study follow everything that is used in REDCap or reserved by any run.
+
+        Args:
+            tubes (Iterable[Tuple]): New (study_id, tube key) pairs (duplicates are allowed)
+            study_to_max_instance (Dict, optional): Max instance per study of the current reference snapshot
+
+        Returns:
+            Dict[Tuple, int]: Instance per (study_id, tube key); tubes reserved before keep their instance
+        """
+        tubes = list(dict.fromkeys(tubes))
+        if not tubes:
+            return {}
+        study_to_max_instance = study_to_max_instance or {}
+        study_ids = list(dict.fromkeys(study_id for study_id, _ in tubes))
+        texts = [(study_id, tube_text(tube_key)) for study_id, tube_key in tubes]
+
+        with self.transaction() as con:
+            reserved, next_instance = {}, {}
+            for part in chunks(texts, IN_CHUNK // 2):
+                reserved.update(
+                    ((study_id, tube), instance) for study_id, tube, instance in con.execute(
+                        "SELECT study_id, tube, instance FROM instances WHERE (study_id, tube) IN "
+                        f"(VALUES {','.join(['(?, ?)'] * len(part))})",
+                        [value for key in part for value in key],
+                    )
+                )
+            for study_id in study_ids:
+                # both answered from the primary key / unique index without scanning the study
+                reserved_max = con.execute(
+                    "SELECT MAX(instance) FROM instances WHERE study_id = ?", (study_id,)
+                ).fetchone()[0] or 0
+                next_instance[study_id] = max(reserved_max, self.floor(con, "instance", study_id)) + 1
+
+            new_rows, stale = [], []
+            now = time.time()
+            for key in texts:
+                if key in reserved:
+                    # the tube is new in the snapshot, so an instance at or below the snapshot max of the
+                    # study went to another tube in REDCap (not reconciled yet)
+                    if reserved[key] > study_to_max_instance.get(key[0], 0):
+                        continue
+                    stale.append(key)
+                study_id = key[0]
+                instance = max(next_instance[study_id], study_to_max_instance.get(study_id, 0) + 1)
+                next_instance[study_id] = instance + 1
+                reserved[key] = instance
+                new_rows.append((study_id, key[1], instance, self.session, now))
+            con.executemany("DELETE FROM instances WHERE study_id = ? AND tube = ?", stale)
+            if new_rows:
+                con.executemany(
+                    "INSERT INTO instances (study_id, tube, instance, session, reserved_at) VALUES (?, ?, ?, ?, ?)",
+                    new_rows,
+                )
+        return {tube: reserved[key] for tube, key in zip(tubes, texts)}
+
+    def reconcile(self, reference):
+        """
+        Core function. Brings the reservations up to date with a new reference snapshot.
+
+        Args:
+            reference (ReferenceIndex): Index of the new reference snapshot
+
+        Returns:
+            Dict[str, int]: Number of reservations that were "uploaded", "dropped" because the snapshot
+            gave the study or tube another number, "expired" and still "pending"
+        """
+        stats = {"uploaded": 0, "dropped": 0, "expired": 0, "pending": 0}
+        cutoff = time.time() - self.expire_after
+        study_to_lab, used_lab_ids = reference.study_to_lab, reference.used_lab_ids
+        tube_map, instance_keys = reference.tube_map, reference.instance_keys
+
+        with self.transaction() as con:
+            con.execute(
+                "INSERT INTO floors VALUES ('lab_id', '', ?) "
+                "ON CONFLICT (kind, key) DO UPDATE SET value = MAX(value, excluded.value)",
+                (max(used_lab_ids, default=0),),
+            )
+            con.executemany(
+                "INSERT INTO floors VALUES ('instance', ?, ?) "
+                "ON CONFLICT (kind, key) DO UPDATE SET value = MAX(value, excluded.value)",
+                reference.study_to_max_instance.items(),
+            )
+
+            uploaded, dropped, expired = [], [], []
+            for lab_id, study_id, reserved_at in con.execute(
+                "SELECT lab_id, study_id, reserved_at FROM lab_ids WHERE uploaded = 0"
+            ).fetchall():
+                snapshot_lab = study_to_lab.get(study_id)
+                if snapshot_lab is not None and int(snapshot_lab) == lab_id:
+                    uploaded.append((lab_id,))
+                elif snapshot_lab is not None or lab_id in used_lab_ids:
+                    dropped.append((lab_id,))
+                elif reserved_at < cutoff:
+                    expired.append((lab_id,))
+            con.executemany("UPDATE lab_ids SET uploaded = 1 WHERE lab_id = ?", uploaded)
+            con.executemany("DELETE FROM lab_ids WHERE lab_id = ?", dropped + expired)
+            stats["uploaded"] += len(uploaded)
+            stats["dropped"] += len(dropped)
+            stats["expired"] += len(expired)
+
+            uploaded, dropped, expired = [], [], []
+            for study_id, tube, instance, reserved_at in con.execute(
+                "SELECT study_id, tube, instance, reserved_at FROM instances WHERE uploaded = 0"
+            ).fetchall():
+                snapshot_instance = tube_map.get((study_id, tube_from_text(tube)))
+                if snapshot_instance == instance:
+                    uploaded.append((study_id, tube))
+                elif snapshot_instance is not None or (study_id, str(instance)) in instance_keys:
+                    dropped.append((study_id, tube))
+                elif reserved_at < cutoff:
+                    expired.append((study_id, tube))
+            con.executemany("UPDATE instances SET uploaded = 1 WHERE study_id = ? AND tube = ?", uploaded)
+            con.executemany("DELETE FROM instances WHERE study_id = ? AND tube = ?", dropped + expired)
+            stats["uploaded"] += len(uploaded)
+            stats["dropped"] += len(dropped)
+            stats["expired"] += len(expired)
+
+            # uploaded reservations are covered by the floors; keep them only while older snapshots
+            # of other runs may still miss them
+            con.execute("DELETE FROM lab_ids WHERE uploaded = 1 AND reserved_at < ?", (cutoff,))
+            con.execute("DELETE FROM instances WHERE uploaded = 1 AND reserved_at < ?", (cutoff,))
+            stats["pending"] = (
+                con.execute("SELECT COUNT(*) FROM lab_ids WHERE uploaded = 0").fetchone()[0]
+                + con.execute("SELECT COUNT(*) FROM instances WHERE uploaded = 0").fetchone()[0]
+            )
+        return stats
+
+    def release(self, session=None):
+        """
+        Frees the reservations of a session that were not uploaded (e.g. after a dry run or an error).
+
+        Args:
+            session (str, optional): Session ID, defaults to this run
+
+        Returns:
+            int: Number of freed reservations
+        """
+        session = session or self.session
+        with self.transaction() as con:
+            freed = con.execute("DELETE FROM lab_ids WHERE session = ? AND uploaded = 0", (session,)).rowcount
+            freed += con.execute("DELETE FROM instances WHERE session = ? AND uploaded = 0", (session,)).rowcount
+        return freed
+
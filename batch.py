@@ -0,0 +1,236 @@
+"""
+Batch validation of many import files against one reference.
+
+Validating import files one by one checks each of them only against the reference: two files that put
+tubes on the same position, or that are validated before either is uploaded, get the same new lab IDs
+and instances. check_batch validates all files of a batch in one pass over the shared ReferenceIndex:
+
+- every file gets the same checks as a single run (rows, instances and positions against the reference)
+- collisions between the files are reported as errors of the later file: a position used by stored tubes
+  in two files (batch.position), the same tube_id in two files (batch.tube_id) and the same given
+  (study_id, redcap_repeat_instance) in two files (batch.instance)
+- lab IDs and instances are assigned against the reference plus the files before (ReferenceIndex.overlay),
+  so a patient in several files gets one lab ID and the instances of a patient continue across files
+
+write_batch_report writes one combined report with a section per file.
+
+    python cli.py -r data/Ref_file.csv --batch imports/ -o batch_report.html
+"""
+import fnmatch
+import os
+
+import instrumentation
+import utils as u
+import validation as v
+from utils import ReferenceIndex
+from records import iter_records
+from error_records import ErrorRecord, set_box
+from reporting import open_report
+
+# Files written by BioVal itself, never validated as import files
+OUTPUT_PATTERNS = ("*_report.*", "*_report_page*", "*_validated.csv", "available_positions_*", "*_metrics.json")
+
+
+def is_import_file(name, pattern="*.csv"):
+    """
+    Helper function. True for files matching pattern that were not written by BioVal.
+    """
+    if name.startswith(".") or not fnmatch.fnmatch(name, pattern):
+        return False
+    return not any(fnmatch.fnmatch(name, output) for output in OUTPUT_PATTERNS)
+
+
+def expand_import_paths(paths, pattern="*.csv"):
+    """
+    Helper function. Replaces folders by the import files in them (sorted by name); files are kept as given.
+
+    Returns:
+        List[str]: Import file paths without duplicates
+    """
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if is_import_file(name, pattern) and os.path.isfile(os.path.join(path, name))
+            )
+        else:
+            expanded.append(path)
+    return list(dict.fromkeys(expanded))
+
+
+class BatchKeys:
+    """
+    Positions, tube IDs and instance keys of the files checked so far.
+
+    Attributes:
+        positions (Dict[Tuple, str]): (freezer, rack, box, pos) of stored tubes -> first file
+        tube_ids (Dict[str, str]): tube_id -> first file
+        instances (Dict[Tuple, str]): (study_id, redcap_repeat_instance) -> first file
+    """
+
+    def __init__(self):
+        self.positions = {}
+        self.tube_ids = {}
+        self.instances = {}
+
+    def check(self, name, rows):
+        """
+        Core function. Checks the rows of one file against the files before and adds its keys. Keys
+        repeated inside the file are left to the checks of the file itself.
+
+        Args:
+            name (str): Name of the file (shown in the errors of later files)
+            rows (List[TubeRecord]): Normalized rows of the file
+
+        Returns:
+            List[ErrorRecord]: Collisions with earlier files, in row order
+        """
+        errors = []
+        positions, tube_ids, instances = {}, {}, {}
+        for i, record in enumerate(iter_records(rows), start=2):
+            row_errors = []
+            if record.tube_status == "1" and record.position_key is not None:
+                key = record.position_key
+                if key in self.positions:
+                    row_errors.append(ErrorRecord(i, "batch.position", "tube_pos", (key, self.positions[key])))
+                positions.setdefault(key, name)
+            if record.tube_id:
+                if record.tube_id in self.tube_ids:
+                    row_errors.append(
+                        ErrorRecord(i, "batch.tube_id", "tube_id", (record.tube_id, self.tube_ids[record.tube_id]))
+                    )
+                tube_ids.setdefault(record.tube_id, name)
+            if record.instance_key is not None:
+                study_id, instance = record.instance_key
+                if record.instance_key in self.instances:
+                    row_errors.append(ErrorRecord(
+                        i, "batch.instance", "redcap_repeat_instance",
+                        (instance, self.instances[record.instance_key], study_id),
+                    ))
+                instances.setdefault(record.instance_key, name)
+            if row_errors:
+                set_box(row_errors, (record.freezer, record.rack, record.box))
+                errors.extend(row_errors)
+        for seen, new in ((self.positions, positions), (self.tube_ids, tube_ids), (self.instances, instances)):
+            for key, value in new.items():
+                seen.setdefault(key, value)
+        return errors
+
+
+class BatchFile:
+    """
+    Result of one file of a batch.
+
+    Attributes:
+        path (str): Path of the import file
+        rows (List[TubeRecord]): Normalized rows with the assigned lab IDs and instances
+        errors (List[ErrorRecord]): Errors of the file, including the collisions with earlier files
+        batch_errors (int): Number of collisions with earlier files
+        labid_messages, instance_messages (List[str]): Assignment messages
+        duplicate_positions (int): Number of invalid position duplicates with the reference
+    """
+
+    def __init__(self, path, rows, errors, batch_errors, labid_messages, instance_messages, duplicate_positions):
+        self.path = path
+        self.rows = rows
+        self.errors = errors
+        self.batch_errors = batch_errors
+        self.labid_messages = labid_messages
+        self.instance_messages = instance_messages
+        self.duplicate_positions = duplicate_positions
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def error_count(self):
+        return len(self.errors) + self.duplicate_positions
+
+
+def check_batch(import_paths, reference, workers=1, write_back=True, allocator=None, cache=None, columnar=False):
+    """
+    Core function. Validates import files as one batch against a shared reference index, see the
+    module docstring. The reference index is not modified.
+
+    Args:
+        import_paths (List[str]): Import CSVs in the order of the batch
+        reference (ReferenceIndex): Index of the reference data
+        workers (int): Number of processes for the row validation
+        write_back (bool): Save the assigned lab IDs and instances into the import files
+        allocator (IdAllocator, optional): Shared allocator for the new lab IDs and instances (allocator.py)
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py)
+        columnar (bool): Validate the rows with the NumPy columnar engine (columnar.py)
+
+    Returns:
+        List[BatchFile]: Result per file, in batch order
+    """
+    names = [os.path.basename(path) for path in import_paths]
+    keys = BatchKeys()
+    batch_index = ReferenceIndex.overlay(reference)
+    results = []
+    for path in import_paths:
+        # the same name twice (files from several folders) is shown with its path
+        name = os.path.basename(path) if names.count(os.path.basename(path)) == 1 else path
+        rows, errors = v.validate_import_file(path, name, reference, columnar=columnar, workers=workers, cache=cache)
+        v.check_internal_duplicates(rows, name, workers=workers)
+        with instrumentation.span("duplicates.positions", rows=len(rows)):
+            duplicate_positions = v.check_duplicate_positions(rows, None, reference)
+        with instrumentation.span("duplicates.batch", rows=len(rows)):
+            batch_errors = keys.check(name, rows)
+
+        # assigned against the reference and the files before, then the file joins the batch index
+        with instrumentation.span("assign.lab_ids", rows=len(rows)):
+            rows, labid_messages = u.assign_lab_patient_ids(rows, batch_index, allocator=allocator)
+        with instrumentation.span("assign.instances", rows=len(rows)):
+            rows, instance_messages = u.assign_instances(rows, batch_index, allocator=allocator)
+        for record in rows:
+            batch_index.add(record)
+
+        if write_back:
+            with instrumentation.span("import.write_back", rows=len(rows)):
+                u.save_data_as_csv(rows, path)
+        instrumentation.count("import.rows", len(rows))
+        instrumentation.count("import.errors", len(errors) + len(batch_errors))
+        instrumentation.count("import.batch_collisions", len(batch_errors))
+        results.append(BatchFile(
+            path, rows, errors + batch_errors, len(batch_errors), labid_messages, instance_messages,
+            duplicate_positions,
+        ))
+    return results
+
+
+def write_batch_report(filename, results, reference_file, error_reference, metrics=None, fmt=None):
+    """
+    Writes the combined report of a batch: a summary over all files, then per file its errors (with
+    the collisions with earlier files) and assignments, then the errors of the reference data.
+
+    Args:
+        filename (str): Path of the report (the extension .csv, .jsonl or .html selects the format)
+        results (List[BatchFile]): Results of check_batch
+        reference_file (str): Path to reference CSV
+        error_reference (List[List[ErrorRecord]]): Error lists of the failing reference rows
+        metrics (Dict, optional): Stage timings and counters (instrumentation.summary), appended at the end
+        fmt (str, optional): Report format (text, csv, jsonl, html), overrides the extension
+    """
+    inputs = [("Import", result.path) for result in results] + [("Reference", reference_file)]
+    with open_report(filename, fmt, inputs=inputs) as report:
+        report.add_fact("Number of import files", len(results))
+        report.add_fact("Number of import rows processed", sum(len(result.rows) for result in results))
+        report.add_fact("Collisions between import files", sum(result.batch_errors for result in results))
+
+        for n, result in enumerate(results, start=1):
+            source = f"import{n}"
+            with report.section(source, f"Errors / Warnings {result.name}:", result.name):
+                report.add_errors(result.errors)
+            with report.section(f"{source}.labid", f"Lab Id assignment {result.name}:"):
+                report.add_messages(result.labid_messages)
+            with report.section(f"{source}.instance", f"Red cap instance assignment {result.name}:"):
+                report.add_messages(result.instance_messages)
+
+        with report.section("reference", "Errors / Warnings Referencefile:", "Reference file"):
+            for error_list in error_reference or []:
+                report.add_row_errors(error_list)
+
+        report.close(metrics)
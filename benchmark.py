@@ -0,0 +1,257 @@
+"""
+Benchmark suite of the validation stages.
+
+Generates synthetic registries of the given sizes (synthetic.py) and times every stage of the
+validation on them, as the functions are called on plain CSV rows:
+
+    read_csv, validate_row, validate_row_compiled, validate_tube_instances, get_available_positions,
+    select_positions_for_material, assign_instances, write_report
+
+Every stage runs --repeat times, the fastest run counts. The results are written to JSON, so the
+numbers of two versions can be compared (--compare old.json flags stages that got slower):
+
+    python benchmark.py --sizes 1000,10000,100000 --out benchmark.json
+    python benchmark.py --sizes 1000,10000,100000 --compare benchmark.json
+
+10M rows can be generated, but the row based stages hold the whole file as dictionaries in memory
+(several GB per million rows).
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import utils as u
+import positions as p
+import validation as v
+from rules import validate_row_compiled
+from synthetic import generate_files
+
+
+STAGES = (
+    "read_csv", "validate_row", "validate_row_compiled", "validate_tube_instances", "get_available_positions",
+    "select_positions_for_material", "assign_instances", "write_report",
+)
+RESULT_VERSION = 1
+
+
+def git_revision():
+    """
+    Helper function. Short git commit of the working tree, empty if git is not available.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def time_stage(function, repeat):
+    """
+    Helper function. Runs a stage repeat times with the output discarded (validate_row prints every
+    position).
+
+    Returns:
+        result: Return value of the last run
+        runs (List[float]): Seconds of every run
+    """
+    runs = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            runs.append(time.perf_counter() - start)
+    return result, runs
+
+
+def run_size(size, work_dir, stages=STAGES, repeat=3, material="BIOFLUID", import_ratio=0.01, **options):
+    """
+    Core function. Generates one synthetic registry and times the stages on it.
+
+    Args:
+        size (int): Number of tube rows of the reference
+        work_dir (str): Directory for the generated files and the report
+        stages (Iterable[str]): Stages to time, see STAGES
+        repeat (int): Runs per stage
+        material (str): Material of the position stages
+        import_ratio (float): Size of the import file relative to the reference
+        **options: SyntheticBiorepository options (occupancy, error_rate, ...)
+
+    Returns:
+        List[Dict]: One result per stage (size, stage, rows, seconds, runs, rows_per_second)
+    """
+    start = time.perf_counter()
+    paths = generate_files(work_dir, size, max(1, int(size * import_ratio)), **options)
+    print(f"{size} rows: generated in {time.perf_counter() - start:.1f}s")
+
+    # inputs of the later stages, prepared without timing if their stage is skipped
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        headers, reference_rows = u.read_csv(paths["reference"])
+        _, import_rows = u.read_csv(paths["import"])
+        available = p.get_available_positions(material, reference_rows)
+        import_errors = v.validate_tube_instances(import_rows, reference_rows)
+        reference_errors = [errors for errors in (
+            validate_row_compiled(row, i) for i, row in enumerate(reference_rows, start=2)
+        ) if errors]
+        import_rows, labid_messages = u.assign_lab_patient_ids(import_rows, reference_rows)
+        import_rows, instance_messages = u.assign_instances(import_rows, reference_rows)
+    report_path = os.path.join(work_dir, "report.txt")
+
+    def validate_rows(validate):
+        return [validate(row, i) for i, row in enumerate(reference_rows, start=2)]
+
+    stage_functions = {
+        "read_csv": (lambda: u.read_csv(paths["reference"]), len(reference_rows)),
+        "validate_row": (lambda: validate_rows(v.validate_row), len(reference_rows)),
+        "validate_row_compiled": (lambda: validate_rows(validate_row_compiled), len(reference_rows)),
+        "validate_tube_instances": (
+            lambda: v.validate_tube_instances(import_rows, reference_rows), len(reference_rows) + len(import_rows)
+        ),
+        "get_available_positions": (lambda: p.get_available_positions(material, reference_rows), len(reference_rows)),
+        "select_positions_for_material": (lambda: p.select_positions_for_material(material, available), len(available)),
+        "assign_instances": (
+            lambda: u.assign_instances(import_rows, reference_rows), len(reference_rows) + len(import_rows)
+        ),
+        "write_report": (
+            lambda: u.write_report(
+                report_path, paths["import"], import_rows, paths["reference"], import_errors, reference_errors,
+                labid_messages, instance_messages,
+            ),
+            len(import_rows) + len(reference_errors),
+        ),
+    }
+
+    results = []
+    for stage in stages:
+        function, rows = stage_functions[stage]
+        _, runs = time_stage(function, repeat)
+        seconds = min(runs)
+        results.append({
+            "size": size, "stage": stage, "rows": rows, "seconds": seconds, "runs": runs,
+            "rows_per_second": rows / seconds if seconds else None,
+        })
+        print(f"  {stage:<30} {seconds:9.4f}s  {rows / seconds if seconds else 0:12.0f} rows/s")
+    return results
+
+
+def run_benchmark(sizes, stages=STAGES, repeat=3, work_dir=None, label="", **options):
+    """
+    Core function. Runs the benchmark for every size.
+
+    Args:
+        sizes (Iterable[int]): Reference sizes in rows
+        stages (Iterable[str]): Stages to time
+        repeat (int): Runs per stage
+        work_dir (str, optional): Keep the generated files here (one subdirectory per size);
+            by default a temporary directory is used
+        label (str): Name of the measured version, e.g. a release tag
+        **options: Further run_size options
+
+    Returns:
+        Dict: Benchmark document with the environment and the results
+    """
+    document = {
+        "version": RESULT_VERSION,
+        "label": label,
+        "revision": git_revision(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "options": options,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            size_dir = os.path.join(work_dir or tmp_dir, str(size))
+            document["results"].extend(run_size(size, size_dir, stages, repeat, **options))
+    return document
+
+
+def compare(old, new, tolerance=1.25):
+    """
+    Core function. Compares two benchmark documents stage by stage.
+
+    Args:
+        old (Dict): Earlier benchmark document
+        new (Dict): Current benchmark document
+        tolerance (float): A stage counts as regression if it takes more than tolerance times as long
+
+    Returns:
+        List[Dict]: The regressions (size, stage, old, new, ratio)
+    """
+    old_seconds = {(r["size"], r["stage"]): r["seconds"] for r in old["results"]}
+    regressions = []
+    print(f"\nCompared with {old.get('label') or old.get('revision') or 'previous run'} ({old.get('created', '')}):")
+    for result in new["results"]:
+        key = (result["size"], result["stage"])
+        if key not in old_seconds or not old_seconds[key]:
+            continue
+        ratio = result["seconds"] / old_seconds[key]
+        flag = "  REGRESSION" if ratio > tolerance else ""
+        print(f"  {key[0]:>9} {key[1]:<30} {old_seconds[key]:9.4f}s -> {result['seconds']:9.4f}s  x{ratio:.2f}{flag}")
+        if flag:
+            regressions.append({"size": key[0], "stage": key[1], "old": old_seconds[key],
+                                "new": result["seconds"], "ratio": ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the BioVal validation stages on synthetic data.")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Comma separated reference sizes in rows (default: 1000,10000,100000)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the fastest counts (default: 3)")
+    parser.add_argument("--out", default="benchmark.json", help="JSON result file (default: benchmark.json)")
+    parser.add_argument("--label", default="", help="Name of the measured version")
+    parser.add_argument("--compare", metavar="JSON", help="Earlier result file; exit code 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Slowdown factor that counts as regression (default: 1.25)")
+    parser.add_argument("--work-dir", help="Keep the generated files in this directory")
+    parser.add_argument("--material", type=str.upper, default="BIOFLUID", help="Material of the position stages")
+    parser.add_argument("--occupancy", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--tubes-per-patient", type=float, default=8.0)
+    parser.add_argument("--import-ratio", type=float, default=0.01, help="Import size relative to the reference")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError:
+        parser.error("--sizes must be comma separated numbers")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    document = run_benchmark(
+        sizes, stages, args.repeat, args.work_dir, args.label, material=args.material,
+        import_ratio=args.import_ratio, occupancy=args.occupancy, error_rate=args.error_rate,
+        tubes_per_patient=args.tubes_per_patient, seed=args.seed,
+    )
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2)
+    print(f"Results saved to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), document, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than x{args.tolerance}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+Columnar binary snapshots of the reference data.
+
+Parsing the wide reference CSV with csv.DictReader on every run is slow for large registries. A binary
+snapshot stores the same table column by column and is memory-mapped when it is loaded, so opening it
+only reads a small header; the values are decoded when the rows are iterated.
+
+Two formats are supported:
+ - Arrow IPC (Feather v2) files, if pyarrow is installed (engine="arrow")
+ - a built-in fixed layout otherwise (engine="builtin"): a JSON header followed by one section per column.
+   Low-cardinality columns (freezer, biomaterial, tube_status, ...) are dictionary encoded (value list +
+   fixed-width integer codes), all other columns are stored as offsets + UTF-8 data.
+
+Both formats convert losslessly back to the CSV that utils.save_data_as_csv writes (snapshot_to_csv).
+
+    python binary_snapshot.py to-snapshot data/Ref_file_test.csv ref.bvsnap
+    python binary_snapshot.py to-csv ref.bvsnap ref.csv
+"""
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from records import TubeRecord
+from diagnostics import get_logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+except ImportError:  # optional dependency
+    pa = None
+
+log = get_logger("binary_snapshot")
+
+MAGIC = b"BIOVALS1"
+ARROW_MAGIC = b"ARROW1"
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+
+# Columns with at most this many distinct values (and fewer than half of the rows) are dictionary encoded
+MAX_DICTIONARY_SIZE = 65535
+
+
+def arrow_available():
+    """
+    Returns True if pyarrow is installed.
+    """
+    return pa is not None
+
+
+def is_snapshot(path):
+    """
+    Helper function. Checks the magic bytes of a file: True for built-in and Arrow snapshots, False for CSV.
+    """
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC))
+    return head == MAGIC or head.startswith(ARROW_MAGIC)
+
+
+def cell(value):
+    """
+    Helper function. Converts a value the way csv.DictWriter writes it (None -> "").
+    """
+    if value is None:
+        return ""
+    return value if type(value) is str else str(value)
+
+
+def table_from_records(records, headers=None):
+    """
+    Helper function. Collects records into columns.
+
+    Args:
+        records (Iterable[Dict]): Flat REDCap records or TubeRecords
+        headers (List[str], optional): Column names; default: the keys of the first record, like
+            utils.save_data_as_csv
+
+    Returns:
+        headers (List[str]): Column names
+        columns (List[List[str]]): Values per column
+    """
+    columns = None
+    for record in records:
+        if type(record) is TubeRecord:
+            record = record.to_dict()
+        if columns is None:
+            if headers is None:
+                headers = list(record.keys())
+            columns = [[] for _ in headers]
+        get = record.get
+        for column, name in zip(columns, headers):
+            column.append(cell(get(name, "")))
+    if columns is None:
+        raise ValueError("No records to write.")
+    return headers, columns
+
+
+def code_format(size):
+    """
+    Helper function. Smallest array typecode for dictionary codes of a dictionary with size values.
+    """
+    return "B" if size <= 0xFF else "H"
+
+
+def write_snapshot(records, path, headers=None, engine="auto"):
+    """
+    Core function. Saves records as a columnar binary snapshot. The file is replaced atomically.
+
+    Args:
+        records (Iterable[Dict]): Flat REDCap records or TubeRecords
+        path (str): Path of the snapshot
+        headers (List[str], optional): Column names, see table_from_records
+        engine (str): "arrow", "builtin" or "auto" (Arrow if pyarrow is installed)
+
+    Returns:
+        int: Number of rows written
+    """
+    if engine == "auto":
+        engine = "arrow" if arrow_available() else "builtin"
+    if engine == "arrow" and not arrow_available():
+        raise ValueError("The arrow snapshot engine needs pyarrow (pip install pyarrow).")
+
+    headers, columns = table_from_records(records, headers)
+    tmp_path = path + ".tmp"
+    if engine == "arrow":
+        write_arrow(headers, columns, tmp_path)
+    else:
+        write_builtin(headers, columns, tmp_path)
+    os.replace(tmp_path, path)
+    return len(columns[0]) if columns else 0
+
+
+def write_arrow(headers, columns, path):
+    """
+    Helper function. Writes the columns as Arrow IPC file, low-cardinality columns dictionary encoded.
+    """
+    arrays = []
+    for values in columns:
+        column = pa.array(values, type=pa.string())
+        if len(set(values)) <= min(MAX_DICTIONARY_SIZE, len(values) // 2):
+            column = column.dictionary_encode()
+        arrays.append(column)
+    table = pa.Table.from_arrays(arrays, names=headers)
+    with pa.OSFile(path, "wb") as sink:
+        with pa_ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_builtin(headers, columns, path):
+    """
+    Helper function. Writes the columns in the built-in fixed layout:
+
+        MAGIC | uint64 header length | JSON header | column sections (8 byte aligned)
+
+    The header describes every column: {"name", "kind": "dict", "dictionary", "codes": [offset, typecode]}
+    or {"name", "kind": "str", "offsets": [offset, typecode], "data": [offset, length]}. Offsets count
+    from the end of the header, numbers are stored in the byte order given in the header.
+    """
+    n_rows = len(columns[0])
+    sections = []
+    descriptions = []
+    position = 0
+    for name, values in zip(headers, columns):
+        distinct = dict.fromkeys(values)
+        if len(distinct) <= min(MAX_DICTIONARY_SIZE, n_rows // 2):
+            dictionary = list(distinct)
+            code_of = {value: code for code, value in enumerate(dictionary)}
+            typecode = code_format(len(dictionary))
+            codes = pad(array(typecode, map(code_of.__getitem__, values)).tobytes())
+            descriptions.append(
+                {"name": name, "kind": "dict", "dictionary": dictionary, "codes": [position, typecode]}
+            )
+            sections.append(codes)
+            position += len(codes)
+        else:
+            encoded = [value.encode("utf-8") for value in values]
+            data = b"".join(encoded)
+            typecode = "I" if len(data) < 2 ** 32 else "Q"
+            offsets = array(typecode, [0])
+            total = 0
+            for value in encoded:
+                total += len(value)
+                offsets.append(total)
+            offsets = pad(offsets.tobytes())
+            descriptions.append({
+                "name": name, "kind": "str",
+                "offsets": [position, typecode], "data": [position + len(offsets), len(data)],
+            })
+            data = pad(data)
+            sections.extend((offsets, data))
+            position += len(offsets) + len(data)
+
+    header = {
+        "version": FORMAT_VERSION, "rows": n_rows, "byteorder": sys.byteorder, "columns": descriptions,
+    }
+    header_bytes = pad(json.dumps(header).encode("utf-8"), b" ")
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for section in sections:
+            f.write(section)
+
+
+def pad(data, fill=b"\0"):
+    """
+    Helper function. Pads bytes to the section alignment.
+    """
+    return data + fill * (-len(data) % ALIGNMENT)
+
+
+class DictColumn:
+    """
+    Dictionary encoded column of a built-in snapshot; codes is a memoryview into the mapped file.
+    """
+
+    def __init__(self, dictionary, codes):
+        self.dictionary = dictionary
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.dictionary[self.codes[i]]
+
+    def __iter__(self):
+        return map(self.dictionary.__getitem__, self.codes)
+
+
+class StrColumn:
+    """
+    Offset + UTF-8 data column of a built-in snapshot; offsets and data are memoryviews into the mapped file.
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def __iter__(self):
+        data = self.data
+        offsets = self.offsets
+        start = offsets[0]
+        for i in range(1, len(offsets)):
+            end = offsets[i]
+            yield str(data[start:end], "utf-8")
+            start = end
+
+
+class SnapshotTable:
+    """
+    Memory-mapped built-in snapshot. Opening it only parses the header; the columns are views into the
+    mapped file and are decoded while they are read.
+
+    Attributes:
+        headers (List[str]): Column names in CSV order
+        columns (Dict[str, DictColumn | StrColumn]): Columns by name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a BioVal snapshot.")
+        (header_length,) = struct.unpack_from("<Q", self.map, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(bytes(self.map[start:start + header_length]))
+        if header.get("version") != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported snapshot version in {path}.")
+
+        self.n_rows = header["rows"]
+        swap = header["byteorder"] != sys.byteorder
+        buffer = memoryview(self.map)[start + header_length:]
+        self.views.append(buffer)
+        self.headers = []
+        self.columns = {}
+        for description in header["columns"]:
+            name = description["name"]
+            self.headers.append(name)
+            if description["kind"] == "dict":
+                offset, typecode = description["codes"]
+                codes = self.numbers(buffer, offset, typecode, self.n_rows, swap)
+                self.columns[name] = DictColumn(description["dictionary"], codes)
+            else:
+                offset, typecode = description["offsets"]
+                offsets = self.numbers(buffer, offset, typecode, self.n_rows + 1, swap)
+                data_offset, data_length = description["data"]
+                data = buffer[data_offset:data_offset + data_length]
+                self.views.append(data)
+                self.columns[name] = StrColumn(offsets, data)
+
+    def numbers(self, buffer, offset, typecode, count, swap):
+        """
+        Helper function. Zero-copy view of count numbers in the mapped file (a copy if the byte order
+        of the file differs from this machine).
+        """
+        size = array(typecode).itemsize
+        raw = buffer[offset:offset + count * size]
+        if swap:
+            numbers = array(typecode, raw)
+            numbers.byteswap()
+            return numbers
+        view = raw.cast(typecode)
+        self.views.extend((raw, view))
+        return view
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        return self.columns[name]
+
+    def iter_rows(self):
+        """
+        Yields the rows as dictionaries in CSV column order.
+        """
+        headers = self.headers
+        for values in zip(*(self.columns[name] for name in headers)):
+            yield dict(zip(headers, values))
+
+    def close(self):
+        """
+        Releases the views and unmaps the file.
+        """
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.columns = {}
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArrowTable:
+    """
+    Memory-mapped Arrow snapshot with the interface of SnapshotTable.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.source = pa.memory_map(path, "r")
+        self.table = pa_ipc.open_file(self.source).read_all()
+        self.headers = list(self.table.column_names)
+        self.n_rows = self.table.num_rows
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        return self.table.column(name).to_pylist()
+
+    def iter_rows(self):
+        headers = self.headers
+        for batch in self.table.to_batches():
+            columns = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+            for values in zip(*columns):
+                yield dict(zip(headers, map(cell, values)))
+
+    def close(self):
+        self.table = None
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_snapshot(path):
+    """
+    Core function. Opens a snapshot (built-in or Arrow) memory-mapped.
+
+    Returns:
+        SnapshotTable | ArrowTable: Table with headers, len(), column(name), iter_rows() and close()
+    """
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC))
+    if head.startswith(ARROW_MAGIC):
+        if not arrow_available():
+            raise ValueError(f"{path} is an Arrow snapshot, reading it needs pyarrow (pip install pyarrow).")
+        return ArrowTable(path)
+    return SnapshotTable(path)
+
+
+def iter_snapshot(path):
+    """
+    Helper function. Snapshot counterpart of utils.iter_csv: returns the headers and a row iterator that
+    closes the snapshot when it is exhausted.
+
+    Returns:
+        tuple: (List[str] headers, Iterator[Dict] rows)
+    """
+    table = load_snapshot(path)
+
+    def rows():
+        with table:
+            yield from table.iter_rows()
+
+    return table.headers, rows()
+
+
+def read_snapshot(path):
+    """
+    Helper function. Snapshot counterpart of utils.read_csv.
+
+    Returns:
+        tuple: (List[str] headers, List[Dict] rows)
+    """
+    with load_snapshot(path) as table:
+        return table.headers, list(table.iter_rows())
+
+
+def snapshot_to_csv(path, out_path):
+    """
+    Core function. Converts a snapshot back to CSV, byte for byte as utils.save_data_as_csv writes it.
+
+    Args:
+        path (str): Path of the snapshot
+        out_path (str): Path of the CSV file
+    """
+    with load_snapshot(path) as table, open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=table.headers)
+        writer.writeheader()
+        writer.writerows(table.iter_rows())
+    log.info("Data saved to %s", out_path)
+
+
+def csv_to_snapshot(csv_path, path, engine="auto"):
+    """
+    Core function. Converts a reference CSV into a snapshot.
+
+    Returns:
+        int: Number of rows written
+    """
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        return write_snapshot(reader, path, headers=reader.fieldnames, engine=engine)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert reference data between CSV and binary snapshots.")
+    parser.add_argument("command", choices=["to-snapshot", "to-csv"])
+    parser.add_argument("source")
+    parser.add_argument("target")
+    parser.add_argument("--engine", choices=["auto", "arrow", "builtin"], default="auto")
+    args = parser.parse_args(argv)
+
+    if args.command == "to-snapshot":
+        n_rows = csv_to_snapshot(args.source, args.target, args.engine)
+        print(f"Saved {n_rows} rows to {args.target}")
+    else:
+        snapshot_to_csv(args.source, args.target)
+        print(f"Data saved to {args.target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+"""
+Headless command line entry point for BioVal.
+
+Runs the same pipeline as the Start button of the GUI (BioVal.py), but takes every path from the
+command line instead of file dialogs. Neither tkinter nor Pillow is imported here, so the command
+starts fast and can be scripted over many import files, e.g. in nightly jobs:
+
+    python cli.py -r data/Ref_file.csv --download import_1.csv import_2.csv
+    python cli.py -r data/Ref_file.csv --material BIOFLUID --positions-out positions.csv
+"""
+import argparse
+import functools
+import os
+import sys
+
+from config import API_URL, STORAGE_RULES, LOG_LEVEL, LOG_FILE, LOG_RATE_LIMIT
+import utils as u
+import positions as p
+import validation as v
+from occupancy import load_or_build
+from pipeline import validate_reference_records, check_import
+from binary_snapshot import csv_to_snapshot
+from allocator import IdAllocator
+from rowcache import RowCache
+from batch import expand_import_paths, check_batch, write_batch_report
+from reporting import FORMATS, DEFAULT_EXTENSIONS, open_report
+import instrumentation
+import diagnostics
+
+
+def add_reference_arguments(parser, required=True):
+    """
+    Helper function. Adds the options of the reference data (file, REDCap download) that load_reference
+    reads to a parser (also used by watcher.py and service.py).
+    """
+    parser.add_argument(
+        "-r", "--reference", required=required,
+        help="Reference CSV or binary snapshot (the data already stored in REDCap). "
+             "Overwritten with a CSV when --download is given.",
+    )
+    parser.add_argument(
+        "--download", action="store_true",
+        help="Download the reference data from REDCap and save it to --reference first.",
+    )
+    parser.add_argument("--api-url", default=API_URL, help="REDCap API endpoint URL.")
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep the last REDCap export in this directory; later downloads only fetch the records "
+             "modified since the last sync.",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=0,
+        help="Export the reference in batches of this many records (record ID list first) instead of "
+             "one request (default: 0, one request).",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4,
+        help="Maximal number of batch requests at the same time (default: 4).",
+    )
+    parser.add_argument(
+        "--full-download", action="store_true",
+        help="With --cache-dir: export everything again (drops records deleted in REDCap from the snapshot).",
+    )
+    parser.add_argument(
+        "--token", default=os.environ.get("BIOVAL_API_TOKEN", ""),
+        help="REDCap API token (default: environment variable BIOVAL_API_TOKEN).",
+    )
+
+
+def add_log_arguments(parser):
+    """
+    Helper function. Adds the diagnostics options (-q, -v, --log-level, --log-file, --log-rate-limit).
+    """
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="Only show warnings and errors of the validation (e.g. for very large files).",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Also show per-row debug messages.")
+    parser.add_argument(
+        "--log-level", action="append", default=[], metavar="[MODULE=]LEVEL",
+        help="Log level of all modules or of one module, e.g. WARNING or validation=DEBUG (repeatable).",
+    )
+    parser.add_argument("--log-file", default=LOG_FILE or None, help="Also write the log with time stamps to FILE.")
+    parser.add_argument(
+        "--log-rate-limit", type=int, default=LOG_RATE_LIMIT,
+        help=f"Show every per-row message type at most N times per run, 0 = all (default: {LOG_RATE_LIMIT}).",
+    )
+
+
+def configure_logging(parser, args):
+    """
+    Helper function. Configures diagnostics.py from the options of add_log_arguments.
+    """
+    level = "WARNING" if args.quiet else "DEBUG" if args.verbose else LOG_LEVEL
+    module_levels = {}
+    for value in args.log_level:
+        module, _, module_level = value.rpartition("=")
+        if module:
+            module_levels[module] = module_level
+        else:
+            level = module_level
+    try:
+        diagnostics.configure(level, module_levels, args.log_file, args.log_rate_limit)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def build_parser():
+    """
+    Helper function. Builds the argument parser of the command line interface.
+
+    Returns:
+        argparse.ArgumentParser: Parser for the BioVal command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog="bioval",
+        description="Validate biorepository REDCap import files without the graphical interface.",
+    )
+    parser.add_argument(
+        "import_files", nargs="*", metavar="IMPORT_CSV",
+        help="Import file(s) to validate (with --batch also folders). Lab IDs and instances are written "
+             "back into each file.",
+    )
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="Validate all import files as one batch: collisions between the files (positions, tube IDs, "
+             "instances) are reported, lab IDs and instances are assigned across the files and one "
+             "combined report is written (-o, default batch_report.txt next to the files).",
+    )
+    add_reference_arguments(parser, required=False)
+    parser.add_argument(
+        "--service", metavar="URL",
+        help="Validate on a running validation service (service.py) that keeps the reference in memory, "
+             "instead of loading the reference here.",
+    )
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="Also save the reference as binary snapshot; later runs load it memory-mapped with -r FILE.",
+    )
+    parser.add_argument(
+        "--material", type=str.upper, choices=sorted(STORAGE_RULES.keys()),
+        help="Biomaterial for which the available positions are selected.",
+    )
+    parser.add_argument("--positions-out", help="CSV file for the selected available positions.")
+    parser.add_argument(
+        "--box-policy", choices=p.BOX_POLICIES, default="first-fit",
+        help="BIOFLUID box choice: first boxes with 15 free slots in storage order (default) or "
+             "best-fit, the fullest boxes that still have 15 free slots.",
+    )
+    parser.add_argument(
+        "--occupancy-index", metavar="FILE",
+        help="Persistent occupancy index of --material. With --download --cache-dir only the positions "
+             "of the records changed since the last sync are updated, otherwise it is rebuilt.",
+    )
+    parser.add_argument(
+        "--allocator-db", metavar="FILE",
+        help="SQLite file shared by concurrent runs: new lab IDs and instances are reserved there, so "
+             "runs at the same time never hand out the same numbers.",
+    )
+    parser.add_argument(
+        "-o", "--report",
+        help="Report file. Only allowed for a single import file; "
+             "by default the report is written next to each import file as <name>_report.txt.",
+    )
+    parser.add_argument(
+        "--report-format", choices=FORMATS,
+        help="Report format: text, csv, jsonl or html (default: by the extension of --report, otherwise text).",
+    )
+    parser.add_argument(
+        "--reference-report", metavar="FILE",
+        help="Also write the errors of the reference data to FILE while the reference is validated "
+             "(summary per rule and box at the top, format by extension or --report-format).",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1,
+        help="Validate large files in chunks on this many processes (default: 1).",
+    )
+    parser.add_argument(
+        "--engine", choices=("rows", "columnar"), default="rows",
+        help="Row validation engine: rows (default) or columnar, which checks whole columns with NumPy "
+             "(faster for large files, loads the reference into memory; one process, no --row-cache).",
+    )
+    parser.add_argument(
+        "--row-cache", metavar="FILE",
+        help="Keep the row-level results in FILE; later runs only check new or changed rows with the rules "
+             "again (single process, -j 1).",
+    )
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="Time every stage (spans, counters, rows/s, peak RSS), append the numbers to the reports "
+             "and save them as JSON to FILE.",
+    )
+    add_log_arguments(parser)
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Do not write the assigned lab IDs and instances back into the import file(s).",
+    )
+    return parser
+
+
+def default_report_path(import_path, fmt=None):
+    """
+    Helper function. Derives the report path next to an import file.
+
+    Args:
+        import_path (str): Path to the import CSV
+        fmt (str, optional): Report format, text by default
+
+    Returns:
+        str: Path of the report, e.g. import_1.csv -> import_1_report.txt
+    """
+    stem, _ = os.path.splitext(import_path)
+    return f"{stem}_report{DEFAULT_EXTENSIONS[fmt or 'text']}"
+
+
+def default_batch_report_path(import_paths, fmt=None):
+    """
+    Helper function. Path of the combined report of a batch: batch_report.txt in the common folder
+    of the import files.
+    """
+    folder = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in import_paths])
+    return os.path.join(folder, f"batch_report{DEFAULT_EXTENSIONS[fmt or 'text']}")
+
+
+def load_reference(args, error_sink=None, cache=None, sync_stats=None, columnar=False):
+    """
+    Core function of the CLI. Downloads the reference data if requested and validates the
+    reference file. The reference file is streamed, only its ReferenceIndex is kept in memory.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        error_sink (function, optional): Called with the errors of every failing reference row
+        cache (RowCache, optional): Reuse the row results of unchanged reference rows
+        sync_stats (Dict, optional): Filled with the stats of the snapshot sync (--cache-dir,
+            snapshots.sync_reference), e.g. for the occupancy index
+        columnar (bool): Validate with the NumPy columnar engine (--engine columnar)
+
+    Returns:
+        reference (ReferenceIndex): Index of the reference data
+        reference_errors List[List[ErrorRecord]]: Validation errors of the failing reference rows
+    """
+    if args.download:
+        if not args.token:
+            raise ValueError("No REDCap API token given (use --token or BIOVAL_API_TOKEN).")
+        # imported here so that runs on a local reference file do not pay for requests
+        from redcap_api import RedcapClient, ExportStats, download_reference_batched
+        if not args.cache_dir:
+            # the records are validated and saved while they are downloaded
+            with RedcapClient(args.api_url, args.token, pool_size=args.concurrency) as client:
+                if args.batch_size:
+                    export_stats = ExportStats()
+                    records = client.iter_records_batched(
+                        batch_size=args.batch_size, concurrency=args.concurrency, stats=export_stats
+                    )
+                else:
+                    export_stats, records = None, client.export_records()
+                headers, records = u.peek_headers(records)
+                records = u.write_csv_while_reading(records, args.reference, headers)
+                print(f" Checking Reference data: {args.api_url}")
+                result = v.validate_reference_rows(
+                    headers, records, "Reference data", workers=args.workers, error_sink=error_sink, cache=cache,
+                    columnar=columnar,
+                )
+            if export_stats is not None:
+                print(export_stats.summary())
+            return result
+
+        from snapshots import SnapshotStore, sync_reference
+        download = None
+        if args.batch_size:
+            download = functools.partial(
+                download_reference_batched, batch_size=args.batch_size, concurrency=args.concurrency
+            )
+        records, stats = sync_reference(
+            SnapshotStore(args.cache_dir), args.api_url, args.token, full=args.full_download, download=download
+        )
+        print(f"Reference snapshot updated ({stats['mode']} export, {stats['downloaded']} rows downloaded)")
+        if sync_stats is not None:
+            sync_stats.update(stats)
+        # validated in memory, the reference CSV is written in the background
+        reference, reference_errors, side_output = validate_reference_records(
+            records, csv_path=args.reference, workers=args.workers, error_sink=error_sink, cache=cache,
+            columnar=columnar,
+        )
+        side_output.wait()
+        return reference, reference_errors
+
+    return v.validate_reference_stream(
+        args.reference, "Reference data", workers=args.workers, error_sink=error_sink, cache=cache,
+        columnar=columnar,
+    )
+
+
+def write_available_positions(material, reference, out_path, index_path=None, box_policy="first-fit", service=None,
+                              sync_stats=None):
+    """
+    Core function of the CLI. Selects the available positions for a biomaterial and saves them.
+
+    Args:
+        material (str): Biomaterial key of STORAGE_RULES
+        reference (ReferenceIndex): Index of the reference data
+        out_path (str): Path of the positions CSV
+        index_path (str, optional): Persistent occupancy index of the material (occupancy.py); it is
+            updated with the changes of the reference and saved again
+        box_policy (str): "first-fit" or "best-fit" choice of the BIOFLUID boxes (positions.select_free_positions)
+        service (ServiceClient, optional): Select the positions on the validation service instead
+        sync_stats (Dict, optional): Stats of the snapshot sync of the reference (load_reference); with a
+            delta export only the changed positions of the saved index are updated
+    """
+    if service is not None:
+        selected_positions = service.available_positions(material, box_policy)
+        p.save_positions_to_csv(out_path, selected_positions)
+        print(f"Saved {len(selected_positions)} available {material} positions to {out_path}")
+        return
+
+    index = None
+    if index_path:
+        index, changed = load_or_build(index_path, material, reference.occupied_positions, sync_stats)
+        if changed is None:
+            print(f"Built occupancy index {index_path}")
+        else:
+            print(f"Updated occupancy index {index_path}: {changed} slot(s) changed")
+    selected_positions = p.select_free_positions(
+        material, reference.occupied_positions, index=index, box_policy=box_policy
+    )
+    p.save_positions_to_csv(out_path, selected_positions)
+    print(f"Saved {len(selected_positions)} available {material} positions to {out_path}")
+
+
+def validate_import(import_path, report_path, reference_path, reference, reference_errors,
+                    write_back=True, workers=1, allocator=None, report_format=None, service=None, cache=None,
+                    columnar=False):
+    """
+    Core function of the CLI. Validates one import file against the reference data, assigns lab
+    IDs and instances and writes the report.
+
+    Args:
+        import_path (str): Path to the import CSV
+        report_path (str): Path of the report
+        reference_path (str): Path to the reference CSV (only shown in the report)
+        reference (ReferenceIndex): Index of the reference data
+        reference_errors (List[List[ErrorRecord]]): Validation errors of the failing reference rows
+        write_back (bool): Save the assigned lab IDs and instances into the import file
+        workers (int): Number of processes for the row validation
+        allocator (IdAllocator, optional): Shared allocator for the new lab IDs and instances
+        report_format (str, optional): Report format, by default chosen by the extension of report_path
+        service (ServiceClient, optional): Validate on the validation service instead (reference,
+            workers, allocator and cache are not used)
+        cache (RowCache, optional): Reuse the row results of unchanged import rows
+        columnar (bool): Validate the rows with the NumPy columnar engine
+
+    Returns:
+        int: Number of import errors and invalid duplicate positions
+    """
+    if service is not None:
+        result = service.check_import(import_path, write_back=write_back)
+    else:
+        result = check_import(
+            import_path, reference, workers=workers, write_back=write_back, allocator=allocator, cache=cache,
+            columnar=columnar,
+        )
+    import_rows, import_errors, labid_messages, instance_messages, duplicate_positions_count = result
+
+    with instrumentation.span("report.write", rows=len(import_rows)):
+        u.write_report(
+            report_path,
+            import_path,
+            import_rows,
+            reference_path,
+            import_errors,
+            reference_errors,
+            labid_messages,
+            instance_messages,
+            metrics=instrumentation.summary() if instrumentation.is_enabled() else None,
+            fmt=report_format,
+        )
+    print(f"Report saved to {report_path}")
+    return len(import_errors) + duplicate_positions_count
+
+
+def validate_batch(import_paths, report_path, reference_path, reference, reference_errors,
+                   write_back=True, workers=1, allocator=None, report_format=None, cache=None, columnar=False):
+    """
+    Core function of the CLI. Validates import files as one batch (batch.check_batch) and writes the
+    combined report.
+
+    Args:
+        import_paths (List[str]): Import CSVs of the batch
+        report_path (str, optional): Path of the combined report, by default next to the files
+        reference_path (str): Path to the reference CSV (only shown in the report)
+        reference (ReferenceIndex): Index of the reference data
+        reference_errors (List[List[ErrorRecord]]): Validation errors of the failing reference rows
+        write_back (bool): Save the assigned lab IDs and instances into the import files
+        workers (int): Number of processes for the row validation
+        allocator (IdAllocator, optional): Shared allocator for the new lab IDs and instances
+        report_format (str, optional): Report format, by default chosen by the extension of report_path
+        cache (RowCache, optional): Reuse the row results of unchanged import rows
+        columnar (bool): Validate the rows with the NumPy columnar engine
+
+    Returns:
+        int: Number of errors (including collisions between the files) and invalid duplicate positions
+    """
+    if not import_paths:
+        raise ValueError("No import files found for the batch.")
+    results = check_batch(
+        import_paths, reference, workers=workers, write_back=write_back, allocator=allocator, cache=cache,
+        columnar=columnar,
+    )
+    report_path = report_path or default_batch_report_path(import_paths, report_format)
+    with instrumentation.span("report.write", rows=sum(len(result.rows) for result in results)):
+        write_batch_report(
+            report_path, results, reference_path, reference_errors,
+            metrics=instrumentation.summary() if instrumentation.is_enabled() else None,
+            fmt=report_format,
+        )
+    for result in results:
+        print(f"{result.name}: {len(result.rows)} rows, {result.error_count} errors "
+              f"({result.batch_errors} collisions with earlier files)")
+    print(f"Batch report saved to {report_path}")
+    return sum(result.error_count for result in results)
+
+
+def main(argv=None):
+    """
+    Command line entry point. Runs the BioVal pipeline for every given import file.
+
+    Args:
+        argv (List[str], optional): Arguments, defaults to sys.argv[1:]
+
+    Returns:
+        int: Exit code - 0 if all import files are valid, 1 if errors were found, 2 on hard errors
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.report and len(args.import_files) != 1 and not args.batch:
+        parser.error("--report can only be used with exactly one import file (or --batch)")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.engine == "columnar" and (args.workers > 1 or args.row_cache):
+        parser.error("--engine columnar validates in one process and cannot be used with --workers or --row-cache")
+    if args.batch_size < 0 or args.concurrency < 1:
+        parser.error("--batch-size must not be negative and --concurrency must be at least 1")
+    if args.positions_out and not args.material:
+        parser.error("--positions-out requires --material")
+    if args.occupancy_index and not args.material:
+        parser.error("--occupancy-index requires --material")
+    if not args.reference and not args.service:
+        parser.error("the following arguments are required: -r/--reference (or --service)")
+    if args.service:
+        local_only = ("download", "snapshot", "occupancy_index", "allocator_db", "reference_report", "row_cache", "batch")
+        given = [f"--{name.replace('_', '-')}" for name in local_only if getattr(args, name)]
+        if args.engine != "rows":
+            given.append("--engine")
+        if given:
+            parser.error(f"{', '.join(given)} cannot be used with --service (the service loads the reference)")
+
+    configure_logging(parser, args)
+
+    allocator = service = cache = None
+    reference = None
+    reference_path = args.reference
+    sync_stats = {}
+    columnar = args.engine == "columnar"
+    if args.metrics:
+        instrumentation.enable()
+    try:
+        if args.row_cache:
+            cache = RowCache(args.row_cache)
+
+        # ===============================
+        # 1. Reference data
+        # ===============================
+        if args.service:
+            # imported here so that local runs do not load the service module
+            from service import ServiceClient
+            service = ServiceClient(args.service)
+            reference_path = args.reference or service.status()["reference"]
+            reference_errors = service.reference_errors()
+        elif args.reference_report:
+            with open_report(args.reference_report, args.report_format, inputs=[("Reference", args.reference)]) as report:
+                with report.section("reference", "Errors / Warnings Referencefile:", "Reference file"):
+                    reference, reference_errors = load_reference(
+                        args, error_sink=report.add_row_errors, cache=cache, sync_stats=sync_stats,
+                        columnar=columnar,
+                    )
+            print(f"Reference report saved to {args.reference_report}")
+        else:
+            reference, reference_errors = load_reference(args, cache=cache, sync_stats=sync_stats, columnar=columnar)
+        if args.snapshot:
+            n_rows = csv_to_snapshot(args.reference, args.snapshot)
+            print(f"Saved reference snapshot with {n_rows} rows to {args.snapshot}")
+        if args.allocator_db:
+            allocator = IdAllocator(args.allocator_db)
+            stats = allocator.reconcile(reference)
+            print(
+                f"Allocator: {stats['uploaded']} reservations uploaded, {stats['dropped']} dropped, "
+                f"{stats['expired']} expired, {stats['pending']} pending"
+            )
+
+        # ===============================
+        # 2. Available positions
+        # ===============================
+        if args.material:
+            out_path = args.positions_out or f"available_positions_{args.material}.csv"
+            with instrumentation.span("positions.select"):
+                write_available_positions(
+                    args.material, reference, out_path, args.occupancy_index, args.box_policy, service, sync_stats
+                )
+
+        # ===============================
+        # 3. Import validation and report
+        # ===============================
+        error_count = 0
+        if args.batch:
+            error_count = validate_batch(
+                expand_import_paths(args.import_files), args.report, reference_path, reference, reference_errors,
+                write_back=not args.dry_run, workers=args.workers, allocator=allocator,
+                report_format=args.report_format, cache=cache, columnar=columnar,
+            )
+        else:
+            for import_path in args.import_files:
+                report_path = args.report or default_report_path(import_path, args.report_format)
+                error_count += validate_import(
+                    import_path, report_path, reference_path, reference, reference_errors,
+                    write_back=not args.dry_run, workers=args.workers, allocator=allocator,
+                    report_format=args.report_format, service=service, cache=cache,
+                    columnar=columnar,
+                )
+        if allocator is not None and args.dry_run:
+            allocator.release()  # nothing was written, nothing will be uploaded
+
+    except Exception as e:
+        print(f"Validation Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if cache is not None:
+            cache.save()
+        diagnostics.report_suppressed()
+        if args.metrics:
+            instrumentation.save_json(args.metrics)
+            print(f"Metrics saved to {args.metrics}")
+
+    return 1 if error_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
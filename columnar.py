@@ -0,0 +1,339 @@
+"""
+Optional NumPy columnar validation engine for whole files.
+
+The columns of REQUIRED_FIELDS are loaded into NumPy arrays and dictionary encoded (categories + integer
+codes), so every check is evaluated once per distinct value and broadcast to the rows as a boolean mask.
+The engine produces the same errors, in the same order per row, as rules.validate_row_compiled and
+validation.validate_row. Without NumPy it falls back to rules.validate_row_compiled row by row.
+"""
+import csv
+import gc
+from contextlib import contextmanager
+from collections import defaultdict
+from itertools import zip_longest
+from operator import attrgetter, itemgetter, methodcaller, not_
+
+from config import REQUIRED_FIELDS, STUDY_ID_PATTERN
+from rules import (
+    ALLOWED, FILLED, MATERIAL_RULES, MATERIAL_PRECEDENCE, MATERIAL_OF, VALID_EVENTS,
+    VALID_INSTRUMENTS, VALID_STATUS, validate_row_compiled,
+)
+from records import TubeRecord
+from error_records import ErrorRecord, set_box
+from utils import read_csv
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+
+@contextmanager
+def gc_paused():
+    """
+    Helper context manager. Pauses the cyclic garbage collector while millions of strings and tuples
+    are created, which otherwise triggers repeated full collections without freeing anything.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def numpy_available():
+    """
+    Helper function. Tells whether the columnar engine can run vectorized.
+    """
+    return np is not None
+
+
+# Fields that are only checked for empty values; they have (nearly) one value per row and are not
+# worth dictionary encoding
+PLAIN_FIELDS = ("study", "lab_id", "sampling_date", "tube_id", "box_id")
+
+
+class CategoricalColumn:
+    """
+    Helper class. One stripped, dictionary encoded column: the distinct values (categories) and one
+    integer code per row pointing into them. Checks run once per category.
+    """
+
+    __slots__ = ("categories", "codes")
+
+    def __init__(self, values):
+        raw_categories = list(dict.fromkeys(values))
+        raw_index = {value: i for i, value in enumerate(raw_categories)}
+        raw_codes = np.fromiter(map(raw_index.__getitem__, values), dtype=np.intp, count=len(values))
+
+        # strip only the distinct values, then merge values that are equal after stripping
+        stripped = [value.strip() for value in raw_categories]
+        self.categories = list(dict.fromkeys(stripped))
+        index = {value: i for i, value in enumerate(self.categories)}
+        self.codes = np.array([index[value] for value in stripped], dtype=np.intp)[raw_codes]
+
+    def mask(self, predicate):
+        """
+        Evaluates predicate(value) once per category and returns the boolean mask of the rows.
+        """
+        return np.array([bool(predicate(value)) for value in self.categories], dtype=bool)[self.codes]
+
+    def empty(self):
+        return self.mask(lambda value: value == "")
+
+    def map(self, func):
+        """
+        Maps every category with func and returns the codes into the list of mapped values.
+        """
+        mapped = [func(value) for value in self.categories]
+        targets = sorted(set(mapped), key=lambda value: (value is None, str(value)))
+        target_index = {value: i for i, value in enumerate(targets)}
+        lookup = np.array([target_index[value] for value in mapped], dtype=np.intp)
+        return targets, lookup[self.codes]
+
+    def value(self, i):
+        return self.categories[self.codes[i]]
+
+
+class PlainColumn:
+    """
+    Helper class. One stripped column without encoding, for fields with (nearly) unique values.
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = list(map(str.strip, values))
+
+    def mask(self, predicate):
+        return np.fromiter(map(predicate, self.values), dtype=bool, count=len(self.values))
+
+    def empty(self):
+        return np.fromiter(map(not_, self.values), dtype=bool, count=len(self.values))
+
+    def value(self, i):
+        return self.values[i]
+
+
+def make_columns(raw_columns):
+    """
+    Helper function. Builds the column objects of REQUIRED_FIELDS from their raw value sequences.
+
+    Args:
+        raw_columns (Dict[str, Sequence[str]]): Raw (unstripped) values per field
+
+    Returns:
+        Dict[str, CategoricalColumn | PlainColumn]: Column per field
+    """
+    return {
+        field: (PlainColumn if field in PLAIN_FIELDS else CategoricalColumn)(raw_columns[field])
+        for field in REQUIRED_FIELDS
+    }
+
+
+def columns_from_rows(rows):
+    """
+    Helper function. Transposes a list of row dictionaries or normalized TubeRecords (records.py) into
+    the raw columns of REQUIRED_FIELDS.
+    """
+    if type(rows[0]) is TubeRecord:
+        # every record has all fields (missing ones are "")
+        transposed = zip(*map(attrgetter(*REQUIRED_FIELDS), rows))
+        return dict(zip(REQUIRED_FIELDS, transposed))
+    try:
+        transposed = zip(*map(itemgetter(*REQUIRED_FIELDS), rows))
+        return dict(zip(REQUIRED_FIELDS, transposed))
+    except KeyError:
+        # rows without some of the fields (e.g. structural errors) - same default as validate_row
+        return {field: list(map(methodcaller("get", field, ""), rows)) for field in REQUIRED_FIELDS}
+
+
+def columns_from_csv(path):
+    """
+    Helper function. Reads the raw columns of REQUIRED_FIELDS directly from a CSV file, without
+    building one dictionary per row.
+
+    Args:
+        path (str): Path to the CSV file
+
+    Returns:
+        headers List[str]: Column headers of the CSV
+        raw_columns Dict[str, Sequence[str]]: Raw values of the present REQUIRED_FIELDS
+        n (int): Number of data rows
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        headers = next(reader, [])
+        records = list(reader)
+
+    positions = {field: i for i, field in reversed(list(enumerate(headers)))}
+    wanted = [field for field in REQUIRED_FIELDS if field in positions]
+    n = len(records)
+    if not wanted or n == 0:
+        return headers, {field: [""] * n for field in wanted}, n
+
+    # short rows are padded with empty values
+    width = max(positions[field] for field in wanted) + 1
+    transposed = list(zip_longest(*records, fillvalue=""))[:width]
+    return headers, {field: transposed[positions[field]] for field in wanted}, n
+
+
+def emit(errors, mask, code, field, index_offset, *columns):
+    """
+    Helper function. Appends an ErrorRecord of the rule to the error list of every row set in mask.
+
+    Args:
+        errors (List[List[ErrorRecord]]): Error lists of all rows
+        mask (np.ndarray): Rows that fail the check
+        code (str): Rule code (error_records.MESSAGES)
+        field (str): Checked field
+        index_offset (int): Row number of the first row
+        columns: CategoricalColumn objects of the message arguments (value, biomaterial)
+    """
+    for i in np.flatnonzero(mask).tolist():
+        errors[i].append(ErrorRecord(i + index_offset, code, field, tuple(column.value(i) for column in columns)))
+
+
+def validate_rows_columnar(rows, start=2):
+    """
+    Core function for large files. Validates all rows column-wise with NumPy.
+
+    Args:
+        rows (List[Dict] | List[TubeRecord]): Rows of the CSV file or their normalized records
+        start (int): Row number of the first row (2 for the first data row of a CSV)
+
+    Returns:
+        errors_list List[List[ErrorRecord]]: Error lists of the failing rows only, in row order. Each list is
+            identical to the one of validate_row.
+    """
+    if np is None:
+        return failing_rows_compiled(rows, start)
+    if not rows:
+        return []
+    with gc_paused():
+        columns = make_columns(columns_from_rows(rows))
+    return validate_columns(columns, len(rows), start)
+
+
+def failing_rows_compiled(rows, start=2):
+    """
+    Helper function. Row-wise fallback without NumPy; returns the error lists of the failing rows.
+    """
+    errors_list = []
+    for i, row in enumerate(rows, start=start):
+        row_errors = validate_row_compiled(row, i)
+        if row_errors:
+            errors_list.append(row_errors)
+    return errors_list
+
+
+def validate_csv_columnar(path, label):
+    """
+    Core function for large files. Validates a CSV file column-wise with NumPy without creating row
+    dictionaries. Falls back to the row-wise rules when NumPy is not installed.
+
+    Args:
+        path (str): Path to the CSV file
+        label (str): Descriptive label (e.g. "Reference data")
+
+    Returns:
+        errors_list List[List[ErrorRecord]]: Error lists of the failing rows only, in row order
+
+    Raises:
+        ValueError: If required columns are missing
+    """
+    if np is None:
+        headers, rows = read_csv(path)
+        check_columns(headers, label)
+        return failing_rows_compiled(rows)
+
+    with gc_paused():
+        headers, raw_columns, n = columns_from_csv(path)
+        check_columns(headers, label)
+        columns = make_columns(raw_columns)
+        del raw_columns
+    if n == 0:
+        return []
+    return validate_columns(columns, n, 2)
+
+
+def check_columns(headers, label):
+    """
+    Helper function. Raises ValueError if REQUIRED_FIELDS are missing in the headers.
+    """
+    missing = [field for field in REQUIRED_FIELDS if field not in headers]
+    if missing:
+        raise ValueError(f"Missing required columns in {label}: {missing}")
+
+
+def validate_columns(columns, n, start):
+    """
+    Helper function. Runs all row checks of validate_row as vectorized masks over the columns.
+
+    Args:
+        columns (Dict): Column objects of REQUIRED_FIELDS (see make_columns)
+        n (int): Number of rows
+        start (int): Row number of the first row
+
+    Returns:
+        errors_list List[List[ErrorRecord]]: Error lists of the failing rows only, in row order
+    """
+    empty = {field: column.empty() for field, column in columns.items()}
+    errors = defaultdict(list)
+
+    # SKIP LOGIC: empty REDCap rows in the reference file are ignored
+    active = ~(empty["biomaterial"] & empty["redcap_repeat_instrument"] & empty["tube_pos"])
+
+    # (1) Required fields
+    for field in REQUIRED_FIELDS:
+        emit(errors, active & empty[field], "missing_value", field, start)
+
+    emit(errors, active & columns["redcap_event_name"].mask(lambda value: value not in VALID_EVENTS),
+         "invalid_event", "redcap_event_name", start, columns["redcap_event_name"])
+    emit(errors, active & columns["redcap_repeat_instrument"].mask(lambda value: value not in VALID_INSTRUMENTS),
+         "invalid_instrument", "redcap_repeat_instrument", start, columns["redcap_repeat_instrument"])
+
+    instance = columns["redcap_repeat_instance"]
+    emit(errors, active & instance.mask(lambda value: value and not value.isdigit()),
+         "instance_not_integer", "redcap_repeat_instance", start, instance)
+    emit(errors, active & instance.mask(lambda value: value.isdigit() and int(value) <= 0),
+         "instance_not_positive", "redcap_repeat_instance", start, instance)
+
+    # (2) Material-specific storage rules, dispatched by the material code of each row
+    biomaterial = columns["biomaterial"]
+    biomaterial.categories = [value.lower() for value in biomaterial.categories]
+    materials, material_codes = biomaterial.map(MATERIAL_OF.get)
+
+    for material in MATERIAL_PRECEDENCE:
+        if material not in materials:
+            continue
+        is_material = active & (material_codes == materials.index(material))
+        for field, kind, allowed, code in MATERIAL_RULES[material][1]:
+            if kind == ALLOWED:
+                allowed = frozenset(allowed)
+                failed = columns[field].mask(lambda value: value not in allowed)
+            elif kind == FILLED:
+                failed = empty[field]
+            else:
+                failed = ~empty[field]
+            emit(errors, is_material & failed, code, field, start, columns[field], biomaterial)
+
+    if None in materials:
+        unknown = active & (material_codes == materials.index(None))
+        emit(errors, unknown, "unknown_material", "biomaterial", start, biomaterial)
+
+    # General checks
+    emit(errors, active & columns["tube_status"].mask(lambda value: value not in VALID_STATUS),
+         "invalid_tube_status", "tube_status", start, columns["tube_status"], biomaterial)
+
+    study_id = columns["study_id"]
+    emit(errors, active & empty["study_id"], "missing_study_id", "study_id", start)
+    emit(errors, active & study_id.mask(lambda value: value and not STUDY_ID_PATTERN.fullmatch(value)),
+         "invalid_study_id", "study_id", start, study_id)
+
+    freezer, rack, box = columns["freezer"], columns["rack"], columns["box"]
+    for i, row_errors in errors.items():
+        set_box(row_errors, (freezer.value(i), rack.value(i), box.value(i)))
+    return [errors[i] for i in sorted(errors)]
@@ -93,3 +93,33 @@ FREEZER_ORDER = {
 
 # Here the API TOKEN of SOPHIE need to go inside and the url for RD registry # this needs to be unvisable once you are ready
 API_URL = "https://redcap.uni-heidelberg.de/api/"
+
+# SQLite file of the lab ID / instance allocator (allocator.py), shared by all BioVal runs on this computer
+# so that runs at the same time never hand out the same lab IDs or instances. Empty = no reservations.
+ALLOCATOR_DB = ""
+
+# Time every stage of a validation run (instrumentation.py); the numbers are appended to the report and
+# saved next to it as <report>_metrics.json
+INSTRUMENTATION = False
+
+# Number of most frequent error rules and boxes listed in the report summary (reporting.py)
+REPORT_SUMMARY_RULES = 20
+
+# Errors listed in detail in a report (the others are only counted in its summary) and errors per report
+# page; further pages are written next to the report as <report>_page2.txt, ... (reporting.py)
+REPORT_DETAIL_LIMIT = 100000
+REPORT_PAGE_SIZE = 10000
+
+# Diagnostics (diagnostics.py): level of the BioVal messages (DEBUG, INFO, WARNING), optional log file and
+# how often every per-row message type (e.g. reused positions) is shown per run before it is only counted
+LOG_LEVEL = "INFO"
+LOG_FILE = ""
+LOG_RATE_LIMIT = 20
+
+# URL of a running validation service (service.py), e.g. "http://biorep-pc:8766/". The GUI then validates
+# there against the reference the service keeps in memory instead of downloading it. Empty = local run.
+SERVICE_URL = ""
+
+# File of the row validation cache (rowcache.py): rows that did not change since an earlier run are not
+# checked with the rules again. Cleared automatically when the rules above change. Empty = no cache.
+ROW_CACHE = ""
@@ -0,0 +1,157 @@
+"""
+Leveled, rate-limited diagnostics on top of the logging module.
+
+The validation modules log to "bioval.<module>" loggers instead of printing. configure() decides what
+is shown: one level for all of BioVal, optionally other levels per module, the console (stdout; left
+out when the frozen GUI build has none) and an optional log file.
+
+Messages that can occur once per row (reused positions, occupied positions, ...) are logged with
+log_limited: every message type (logger and message template) is written at most rate_limit times per
+run, the rest is only counted. The check happens before a log record is created, so a file with a
+million reused positions costs a million counter increments, not a million lines of terminal output.
+report_suppressed() logs the counts at the end of a run:
+
+    log = diagnostics.get_logger("validation")
+    diagnostics.log_limited(log, logging.INFO, "Row %s: Position %s reused", i, key)
+"""
+import logging
+import sys
+import threading
+from collections import Counter
+
+ROOT = "bioval"
+RATE_LIMIT = 20  # messages per type and run
+CONSOLE_FORMAT = "%(message)s"
+FILE_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+
+def get_logger(name):
+    """
+    Helper function. Logger of a BioVal module, e.g. get_logger("validation") -> "bioval.validation".
+    """
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+class RateLimiter:
+    """
+    Counts the messages per type and tells whether one more may be written.
+
+    Attributes:
+        limit (int): Messages per type, 0 = no limit
+        seen (Counter): Messages per (logger name, message template)
+    """
+
+    def __init__(self, limit=RATE_LIMIT):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.seen = Counter()
+
+    def allow(self, key):
+        """
+        Helper function. Counts one message of the type key; True while the type is below the limit.
+        """
+        with self.lock:
+            self.seen[key] += 1
+            n = self.seen[key]
+        return not self.limit or n <= self.limit
+
+    def suppressed(self):
+        """
+        Returns:
+            Dict[Tuple[str, str], int]: Suppressed messages per (logger name, message template)
+        """
+        with self.lock:
+            if not self.limit:
+                return {}
+            return {key: n - self.limit for key, n in self.seen.items() if n > self.limit}
+
+    def reset(self):
+        with self.lock:
+            self.seen.clear()
+
+
+LIMITER = RateLimiter()
+
+
+def log_limited(logger, level, msg, *args):
+    """
+    Core function. Logs a message that can occur once per row; above the rate limit of its type it
+    is only counted.
+
+    Args:
+        logger (logging.Logger): Logger of the module
+        level (int): Log level, e.g. logging.INFO
+        msg (str): Message template with %-placeholders (the template is the message type)
+        *args: Values of the placeholders, only formatted if the message is written
+    """
+    if logger.isEnabledFor(level) and LIMITER.allow((logger.name, msg)):
+        logger.log(level, msg, *args)
+
+
+def report_suppressed(logger=None):
+    """
+    Core function. Logs how many messages of every type were suppressed and starts counting anew.
+
+    Returns:
+        int: Number of suppressed messages
+    """
+    logger = logger or logging.getLogger(ROOT)
+    suppressed = LIMITER.suppressed()
+    for (name, msg), n in sorted(suppressed.items()):
+        logger.info("%d more '%s' messages of %s suppressed", n, msg, name)
+    LIMITER.reset()
+    return sum(suppressed.values())
+
+
+def parse_level(level):
+    """
+    Helper function. Log level from a name ("debug", "WARNING") or number.
+    """
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level '{level}'")
+    return value
+
+
+def configure(level="INFO", module_levels=None, log_file=None, rate_limit=RATE_LIMIT, console=True):
+    """
+    Core function. Sets up the BioVal loggers; can be called again (the handlers are replaced).
+
+    Args:
+        level (str | int): Level of all BioVal modules, e.g. "WARNING" for a quiet run
+        module_levels (Dict[str, str | int], optional): Other levels of single modules,
+            e.g. {"validation": "DEBUG"}
+        log_file (str, optional): Also write all messages of the level with time stamps to this file
+        rate_limit (int): Messages per type and run of log_limited, 0 = no limit
+        console (bool): Write the messages to stdout (stderr if there is no stdout)
+
+    Returns:
+        logging.Logger: The root logger of BioVal
+    """
+    root = logging.getLogger(ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(parse_level(level))
+    root.propagate = False
+
+    for name, module_level in (module_levels or {}).items():
+        get_logger(name).setLevel(parse_level(module_level))
+
+    stream = sys.stdout or sys.stderr  # both are None in the windowed PyInstaller build
+    if console and stream is not None:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        root.addHandler(handler)
+    if log_file:
+        handler = logging.FileHandler(log_file, encoding="utf-8")
+        handler.setFormatter(logging.Formatter(FILE_FORMAT))
+        root.addHandler(handler)
+    if not root.handlers:
+        root.addHandler(logging.NullHandler())
+
+    LIMITER.limit = rate_limit
+    LIMITER.reset()
+    return root
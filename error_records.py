@@ -0,0 +1,235 @@
+"""
+Structured validation errors.
+
+The validators used to return formatted strings ("Row 12: Invalid tube-pos 'K1' for serum ..."), which
+the report had to take apart again with split(":"). An ErrorRecord keeps the row, the field, a rule code,
+the severity and the message arguments instead; the text is only formatted when it is rendered
+(str(error) gives the same text as before). Errors can be counted per rule (aggregate), filtered and
+sorted without formatting a single message.
+
+Convention of the message arguments: args[0] is the offending value, the further arguments are the
+context (biomaterial, study ID). The summary of a rule is its message without the value, so
+aggregate counts e.g. "4312 x DNA must be stored in 4-degree freezer." over all rows.
+"""
+import re
+from collections import Counter
+
+
+ERROR = "error"
+WARNING = "warning"
+
+# Message template per rule code: {0} = offending value, {1} = context, {field} = checked field
+MESSAGES = {
+    "missing_value": "Missing value in '{field}'",
+    "invalid_event": "Invalid Redcap Event name must be participant_regist_arm_1.",
+    "invalid_instrument": "Invalid Redcap Repeated instrument: must be biorepository.",
+    "instance_not_integer": "redcap_repeat_instance must be a positive integer",
+    "instance_not_positive": "redcap_repeat_instance must be >= 1",
+    "unknown_material": "Unknown or unsupported material '{0}'",
+    "invalid_tube_status": "Invalid tube_status '{0}' for {1} (must be 1-5)",
+    "missing_study_id": "Missing study_id",
+    "invalid_study_id": "Invalid study_id format '{0}'",
+    "duplicate_instance": "Duplicate tube instance {0} for patient {1} in import file.",
+    "instance_exists": "Tube instance {0} for patient {1} already exists in REDCap and must not be overwritten.",
+    # material specific storage rules (rules.MATERIAL_RULES), {1} = biomaterial as written in the row
+    "biofluid.tube_pos": "Invalid tube-pos '{0}' for {1} (must be A1–H10)",
+    "biofluid.freezer": "{1} must be stored in -80 freezers (1–3).",
+    "biofluid.rack": "Invalid rack number '{0}' for {1} (must be 1-100)",
+    "biofluid.box": "Invalid box number '{0}' for {1} (must be 1-1000)",
+    "biofluid.box_id": "Invalid box or empty box ID '{0}' for {1} (must be unique ID)",
+    "paxgene.tube_pos": "Invalid tube-pos '{0}' for PAXgene (must be A1–G7)",
+    "paxgene.freezer": "PAXgene must be stored in -80 freezers (1–3).",
+    "paxgene.box": "Invalid box number '{0}' for {1} (must be 1-500)",
+    "paxgene.rack": "Rack must be empty for {1}",
+    "paxgene.box_id": "Box ID must be empty for {1}",
+    "dna.tube_pos": "Invalid tube-pos '{0}' for DNA (must be A1–J10)",
+    "dna.freezer": "DNA must be stored in 4-degree freezer.",
+    "dna.rack": "Rack must be empty for {1}",
+    "dna.box_id": "Box ID must be empty for {1}",
+    "cells.tube_pos": "Invalid tube-pos '{0}' for {1} (must be A1–J10)",
+    "cells.freezer": "{1} must be stored in nitrogen tank.",
+    "cells.box_id": "Box ID must be empty for {1}",
+    "cells.rack": "Invalid rack number '{0}' for {1} (must be 1-100)",
+    # collisions between the files of a batch (batch.py), {1} = the earlier file
+    "batch.position": "Position {0} is also used by a stored tube in {1}",
+    "batch.tube_id": "tube_id '{0}' is also used in {1}",
+    "batch.instance": "Tube instance {0} for patient {2} is also used in {1}",
+}
+
+# Message without the offending value, e.g. "Invalid tube-pos for {1} (must be A1–H10)"
+SUMMARIES = {code: re.sub(r" ?'?\{0\}'?", "", message) for code, message in MESSAGES.items()}
+
+
+class ErrorRecord:
+    """
+    One validation error; formatted only when rendered.
+
+    Attributes:
+        row (int): Row number as shown in the report
+        code (str): Rule code, key of MESSAGES
+        field (str): Checked field ("" if the rule is not about one field)
+        args (Tuple): Message arguments, (offending value, context...)
+        severity (str): ERROR or WARNING
+        box (Tuple[str, str, str] | None): (freezer, rack, box) of the row, if known
+    """
+
+    __slots__ = ("row", "code", "field", "args", "severity", "box")
+
+    def __init__(self, row, code, field="", args=(), severity=ERROR, box=None):
+        self.row = row
+        self.code = code
+        self.field = field
+        self.args = args
+        self.severity = severity
+        self.box = box
+
+    @property
+    def message(self):
+        """
+        The formatted message without the row prefix.
+        """
+        return MESSAGES[self.code].format(*self.args, field=self.field)
+
+    @property
+    def summary(self):
+        """
+        The message without the offending value (same for all errors of a rule and context).
+        """
+        return SUMMARIES[self.code].format(*self.args, field=self.field)
+
+    def __str__(self):
+        return f"Row {self.row}: {self.message}"
+
+    def __repr__(self):
+        return (
+            f"ErrorRecord({self.row!r}, {self.code!r}, {self.field!r}, {self.args!r}, {self.severity!r}, {self.box!r})"
+        )
+
+    def key(self):
+        return self.row, self.code, self.field, self.args, self.severity, self.box
+
+    def __eq__(self, other):
+        if isinstance(other, ErrorRecord):
+            return self.key() == other.key()
+        if isinstance(other, str):  # comparable with the old error strings
+            return str(self) == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __reduce__(self):  # compact pickling for the process pool (parallel.py)
+        return ErrorRecord, self.key()
+
+    def as_dict(self):
+        """
+        The error as JSON-compatible dictionary (validation service, service.py).
+        """
+        return {
+            "row": self.row, "code": self.code, "field": self.field, "args": list(self.args),
+            "severity": self.severity, "box": list(self.box) if self.box else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds an error from as_dict().
+        """
+        box = data.get("box")
+        return cls(
+            data["row"], data["code"], data.get("field", ""), tuple(data.get("args", ())),
+            data.get("severity", ERROR), tuple(box) if box else None,
+        )
+
+
+def set_box(errors, box):
+    """
+    Helper function. Notes the storage box of a failing row on all of its errors.
+
+    Args:
+        errors (List[ErrorRecord]): Errors of one row
+        box (Tuple[str, str, str]): (freezer, rack, box) of the row
+    """
+    for error in errors:
+        error.box = box
+
+
+def box_label(box):
+    """
+    Helper function. Readable name of a (freezer, rack, box) key, e.g. "freezer 1 / rack 3 / box 12".
+    """
+    if not box or not any(box):
+        return "unknown box"
+    return " / ".join(f"{name} {value}" for name, value in zip(("freezer", "rack", "box"), box) if value)
+
+
+def iter_errors(errors):
+    """
+    Helper function. Iterates the errors of a flat list or of per-row error lists (reference errors).
+    Plain string messages (e.g. the missing columns of a file) have no rule and are skipped.
+    """
+    for error in errors:
+        if isinstance(error, ErrorRecord):
+            yield error
+        elif not isinstance(error, str):
+            for row_error in error:
+                if isinstance(row_error, ErrorRecord):
+                    yield row_error
+
+
+def aggregate(errors):
+    """
+    Core function. Counts the errors per rule and context without formatting the single messages.
+
+    Args:
+        errors (Iterable[ErrorRecord | List[ErrorRecord]]): Errors or per-row error lists
+
+    Returns:
+        List[Tuple[int, str, str]]: (count, summary, code), most frequent first
+    """
+    counts = Counter((error.code, error.field, error.args[1:]) for error in iter_errors(errors))
+    return sorted(
+        ((n, SUMMARIES[code].format(None, *context, field=field), code)
+         for (code, field, context), n in counts.items()),
+        key=lambda item: (-item[0], item[1]),
+    )
+
+
+def filter_errors(errors, code=None, field=None, severity=None, rows=None):
+    """
+    Core function. Selects errors by rule code (or code prefix ending with ".", e.g. "dna."), field,
+    severity and row numbers.
+
+    Args:
+        errors (Iterable[ErrorRecord | List[ErrorRecord]]): Errors or per-row error lists
+        code (str, optional): Rule code or prefix
+        field (str, optional): Field name
+        severity (str, optional): ERROR or WARNING
+        rows (Container[int], optional): Row numbers
+
+    Returns:
+        List[ErrorRecord]: Matching errors in their original order
+    """
+    selected = []
+    for error in iter_errors(errors):
+        if code is not None and not (error.code == code or code.endswith(".") and error.code.startswith(code)):
+            continue
+        if field is not None and error.field != field:
+            continue
+        if severity is not None and error.severity != severity:
+            continue
+        if rows is not None and error.row not in rows:
+            continue
+        selected.append(error)
+    return selected
+
+
+def sort_errors(errors):
+    """
+    Core function. Sorts errors by row, then rule code.
+
+    Returns:
+        List[ErrorRecord]: Sorted errors
+    """
+    return sorted(iter_errors(errors), key=lambda error: (error.row, error.code))
+
@@ -0,0 +1,169 @@
+"""
+Local stand-in for the REDCap API.
+
+Serves the records of a reference CSV the way the REDCap record export does (POST form data, JSON
+answer), including the dateRangeBegin filter of delta exports. It is meant for trying out the download
+code (snapshots.py, cli.py --download) without VPN or a real token:
+
+    python fake_redcap.py data/Ref_file_test.csv --port 8765 --token TEST
+    python cli.py -r /tmp/ref.csv --download --api-url http://127.0.0.1:8765/ --token TEST --cache-dir /tmp/snapshots
+
+It can also be started from Python (FakeRedcap(records).start()), records can be changed while it runs.
+"""
+import argparse
+import gzip
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from utils import read_csv
+
+REDCAP_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class FakeRedcap:
+    """
+    In-memory REDCap project served over HTTP.
+
+    Attributes:
+        records (List[Dict]): Flat record rows of the project
+        modified (Dict[str, datetime]): Last modification time per record (study_id)
+        token (str): Accepted API token
+        requests (List[Dict]): Form data of all received requests
+        fail_next (List[int]): HTTP status codes answered to the next requests instead of the data,
+            e.g. [503, 503] to try out retries
+        delay (float): Seconds every request takes, e.g. to try out concurrent batch exports
+    """
+
+    def __init__(self, records, token="TEST", id_field="study_id", delay=0.0):
+        self.records = list(records)
+        self.token = token
+        self.id_field = id_field
+        self.delay = delay
+        self.requests = []
+        self.fail_next = []
+        now = datetime.now()
+        self.modified = {row.get(id_field, ""): now for row in self.records}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def set_record(self, record_id, rows):
+        """
+        Replaces all rows of a record (an empty list deletes it) and marks it as modified now.
+        """
+        with self.lock:
+            kept = [row for row in self.records if row.get(self.id_field, "") != record_id]
+            self.records = kept + list(rows)
+            if rows:
+                self.modified[record_id] = datetime.now()
+            else:
+                self.modified.pop(record_id, None)
+
+    def export_records(self, form):
+        """
+        Helper function. Returns the rows of a record export request. Supports the records[i] and
+        dateRangeBegin filters; a request with fields but without forms returns only these fields
+        (one row per record, e.g. the record ID list).
+        """
+        with self.lock:
+            records = self.records
+            record_ids = {value for key, value in form.items() if key.startswith("records[")}
+            if record_ids:
+                records = [row for row in records if row.get(self.id_field, "") in record_ids]
+            since = form.get("dateRangeBegin")
+            if since:
+                since = datetime.strptime(since, REDCAP_TIME_FORMAT)
+                records = [row for row in records if self.modified[row.get(self.id_field, "")] >= since]
+            if not any(key.startswith("forms[") for key in form):
+                fields = [value for key, value in form.items() if key.startswith("fields[")]
+                if fields:
+                    unique = {}
+                    for row in records:
+                        unique.setdefault(row.get(self.id_field, ""), {field: row.get(field, "") for field in fields})
+                    records = list(unique.values())
+            return list(records)
+
+    def handle(self, form):
+        """
+        Helper function. Answers one API request.
+
+        Returns:
+            Tuple[int, object]: HTTP status and JSON body
+        """
+        self.requests.append(form)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_next:
+            return self.fail_next.pop(0), {"error": "Service temporarily unavailable"}
+        if form.get("token") != self.token:
+            return 403, {"error": "You do not have permissions to use the API"}
+        if form.get("content") == "record" and form.get("action", "export") == "export":
+            return 200, self.export_records(form)
+        return 400, {"error": f"Unsupported request content={form.get('content')!r}"}
+
+    def start(self, host="127.0.0.1", port=0):
+        """
+        Starts the server in a background thread.
+
+        Returns:
+            str: API URL of the server
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                form = {key: values[-1] for key, values in parse_qs(body, keep_blank_values=True).items()}
+                status, answer = fake.handle(form)
+                payload = json.dumps(answer).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    payload = gzip.compress(payload)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_port}/"
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a reference CSV like the REDCap record export API.")
+    parser.add_argument("reference", help="Reference CSV with the records to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token", default="TEST", help="Accepted API token (default: TEST)")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds every request takes (default: 0)")
+    args = parser.parse_args(argv)
+
+    _, rows = read_csv(args.reference)
+    fake = FakeRedcap(rows, token=args.token, delay=args.delay)
+    url = fake.start(args.host, args.port)
+    print(f"Serving {len(fake.records)} records at {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
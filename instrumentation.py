@@ -0,0 +1,243 @@
+"""
+Lightweight timing and counter instrumentation of the validation stages.
+
+The stages (download, CSV parsing, row validation, duplicate checks, assignments, report) are wrapped
+in spans, work items are counted with counters:
+
+    with instrumentation.span("import.validate_rows", rows=len(rows)):
+        ...
+    instrumentation.count("redcap.retries")
+
+Recording is off by default. Disabled, span returns one shared no-op object and count returns at
+once, so the calls cost about as much as an attribute lookup; they are only placed around whole
+stages and requests, never per row. Enabled (instrumentation.enable(), cli.py --metrics), every span
+adds up its time, rows and calls per name and notes the peak RSS of the process when it ends. summary()
+returns everything as JSON-ready dictionary; utils.write_report appends it to the report.
+"""
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Helper function. Peak resident memory of this process in MB, None if the platform does not tell.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Span:
+    """
+    One running stage; adds its time to the recorder when the with block ends (also on errors).
+
+    Attributes:
+        name (str): Stage name, e.g. "import.validate_rows"
+        rows (int): Rows processed by the stage, for rows/s (can be set inside the with block)
+    """
+
+    __slots__ = ("recorder", "name", "rows", "start")
+
+    def __init__(self, recorder, name, rows):
+        self.recorder = recorder
+        self.name = name
+        self.rows = rows
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.add_span(self.name, time.perf_counter() - self.start, self.rows)
+        return False
+
+
+class NullSpan:
+    """
+    Span of the disabled recorder; does nothing.
+    """
+
+    __slots__ = ("rows",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Recorder:
+    """
+    Collects spans and counters.
+
+    Attributes:
+        enabled (bool): Recording is on
+        spans (Dict[str, Dict]): Calls, seconds, rows and peak RSS per stage name, in first-seen order
+        counters (Dict[str, int]): Counter values
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all recorded spans and counters.
+        """
+        self.spans = {}
+        self.counters = {}
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+
+    def add_span(self, name, seconds, rows):
+        """
+        Helper function. Adds one finished span.
+        """
+        peak = peak_rss_mb()
+        with self.lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                entry = self.spans[name] = {"calls": 0, "seconds": 0.0, "rows": 0, "peak_rss_mb": None}
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["rows"] += rows or 0
+            entry["peak_rss_mb"] = peak
+
+    def count(self, name, n=1):
+        """
+        Helper function. Adds n to a counter.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        Core function. Returns the recorded numbers as JSON-ready dictionary.
+
+        Returns:
+            Dict: started, wall_seconds, peak_rss_mb, spans (list with name, calls, seconds, rows,
+            rows_per_second, peak_rss_mb) and counters
+        """
+        with self.lock:
+            spans = [
+                dict(
+                    name=name, **entry,
+                    rows_per_second=entry["rows"] / entry["seconds"] if entry["rows"] and entry["seconds"] else None,
+                )
+                for name, entry in self.spans.items()
+            ]
+            counters = dict(self.counters)
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "spans": spans,
+            "counters": counters,
+        }
+
+
+RECORDER = Recorder()
+
+
+def enable(reset=True):
+    """
+    Switches recording on (by default with empty spans and counters).
+    """
+    if reset:
+        RECORDER.reset()
+    RECORDER.enabled = True
+
+
+def disable():
+    """
+    Switches recording off; the recorded numbers are kept.
+    """
+    RECORDER.enabled = False
+
+
+def is_enabled():
+    return RECORDER.enabled
+
+
+def span(name, rows=0):
+    """
+    Core function. Times a stage: with span("name", rows=n) as s: ... (s.rows can be set inside).
+
+    Args:
+        name (str): Stage name; spans with the same name are added up
+        rows (int): Rows processed by the stage
+
+    Returns:
+        Span | NullSpan: Context manager
+    """
+    if not RECORDER.enabled:
+        return NULL_SPAN
+    return Span(RECORDER, name, rows)
+
+
+def count(name, n=1):
+    """
+    Core function. Adds n to a counter (no-op while recording is off).
+    """
+    if RECORDER.enabled:
+        RECORDER.count(name, n)
+
+
+def summary():
+    """
+    Returns the recorded numbers, see Recorder.summary.
+    """
+    return RECORDER.summary()
+
+
+def report_lines(metrics):
+    """
+    Helper function. Formats a summary as text lines for the validation report.
+
+    Args:
+        metrics (Dict): Result of summary()
+
+    Returns:
+        List[str]: Lines without line breaks
+    """
+    lines = []
+    for entry in metrics["spans"]:
+        line = f" - {entry['name']:<28} {entry['seconds']:9.3f}s"
+        if entry["calls"] > 1:
+            line += f" ({entry['calls']} calls)"
+        if entry["rows_per_second"]:
+            line += f"  {entry['rows']} rows, {entry['rows_per_second']:.0f} rows/s"
+        lines.append(line)
+    for name, value in metrics["counters"].items():
+        lines.append(f" - {name}: {value}")
+    lines.append(f" - total: {metrics['wall_seconds']:.3f}s")
+    if metrics["peak_rss_mb"] is not None:
+        lines.append(f" - peak RSS: {metrics['peak_rss_mb']:.1f} MB")
+    return lines
+
+
+def save_json(path, metrics=None):
+    """
+    Core function. Writes the recorded numbers (or a given summary) as JSON, e.g. for monitoring.
+
+    Args:
+        path (str): Path of the JSON file
+        metrics (Dict, optional): Result of summary(), by default the current numbers
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(metrics or summary(), f, indent=2)
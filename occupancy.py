@@ -0,0 +1,422 @@
+"""
+Persistent occupancy index of the storage boxes.
+
+positions.get_occupied_positions rebuilds a set of (freezer, rack, box, pos) tuples from the whole
+reference data on every run. The OccupancyIndex keeps one fixed-width bitmap per (freezer, rack, box)
+of a biomaterial instead, sized from the rows x cols grid in STORAGE_RULES (bit i = slot i in storage
+order, e.g. A1, A2, ..., H12). "Is this slot free" and "free slots in this box" are bit operations.
+
+The index is saved to disk between runs together with the REDCap snapshot it reflects (snapshots.py).
+When the next delta export arrives, load_or_build only looks at the positions of the changed records
+(apply_changes, occupy / release) instead of packing the whole reference again. Without a delta from
+the snapshot the index is rebuilt; an index kept in memory is brought up to date with sync.
+
+Next to the bitmaps the index maintains the free capacity of every box in a bucket queue (one list of
+boxes in storage order per free count). "First k boxes with at least m free slots" (first fit) and "boxes
+with the fewest free slots that still fit m" (best fit) are answered from the buckets directly.
+"""
+import bisect
+import heapq
+import json
+import os
+from itertools import islice
+
+from config import STORAGE_RULES, FREEZER_ORDER
+from records import iter_records
+from diagnostics import get_logger
+
+log = get_logger("occupancy")
+
+
+INDEX_VERSION = 1
+
+
+def slot_sort_key(pos):
+    """
+    Helper function. Sort key of a slot name inside a box (row letter, then column as number).
+    """
+    return pos[0], int(pos[1:])
+
+
+def box_sort_key(box_key):
+    """
+    Helper function. Sort key of a (freezer, rack, box) in storage order, see positions.position_sort_key.
+    """
+    freezer, rack, box = box_key
+    return FREEZER_ORDER.get(freezer, 99), int(rack), int(box)
+
+
+def grid_of(material):
+    """
+    Helper function. Describes the storage grid of a biomaterial from STORAGE_RULES.
+
+    Args:
+        material (str): Biomaterial key of STORAGE_RULES
+
+    Returns:
+        Dict: freezers, racks, boxes (per rack), rows and cols of the material
+    """
+    if material not in STORAGE_RULES:
+        raise ValueError(f"Material '{material}' has no defined STORAGE_RULE.")
+    rules = STORAGE_RULES[material]
+    return {
+        "freezers": list(rules["freezers"]),
+        "racks": list(rules["racks"]),
+        "boxes": rules.get("boxes_per_rack", 1),
+        "rows": list(rules["rows"]),
+        "cols": list(rules["cols"]),
+    }
+
+
+class OccupancyIndex:
+    """
+    Occupancy bitmaps of all boxes of one biomaterial.
+
+    Attributes:
+        material (str): Biomaterial key of STORAGE_RULES
+        slots (List[str]): Slot names of a box in storage order (bit i <-> slots[i])
+        width (int): Number of slots per box (rows x cols)
+        boxes (List[Tuple]): All (freezer, rack, box) of the material in storage order
+        bitmaps (Dict[Tuple, int]): Occupancy bitmap per box, a set bit is an occupied slot
+        free_counts (Dict[Tuple, int]): Number of free slots per box
+        buckets (List[List[int]]): buckets[n] = storage order numbers of the boxes with n free slots
+        synced_to (str | None): last_sync of the reference snapshot the bitmaps reflect, if known
+    """
+
+    def __init__(self, material):
+        self.material = material
+        self.grid = grid_of(material)
+        self.slots = sorted(
+            (row + col for row in self.grid["rows"] for col in self.grid["cols"]), key=slot_sort_key
+        )
+        self.slot_bit = {pos: i for i, pos in enumerate(self.slots)}
+        self.width = len(self.slots)
+        self.full = (1 << self.width) - 1
+        self.boxes = sorted(
+            {
+                (freezer, rack, str(box))
+                for freezer in self.grid["freezers"]
+                for rack in self.grid["racks"]
+                for box in range(1, self.grid["boxes"] + 1)
+            },
+            key=box_sort_key,
+        )
+        self.box_number = {box_key: i for i, box_key in enumerate(self.boxes)}
+        self.synced_to = None
+        self.set_bitmaps(dict.fromkeys(self.boxes, 0))
+
+    def set_bitmaps(self, bitmaps):
+        """
+        Helper function. Replaces all bitmaps and rebuilds the free capacity buckets.
+        """
+        self.bitmaps = bitmaps
+        self.free_counts = {box_key: self.width - bin(bitmap).count("1") for box_key, bitmap in bitmaps.items()}
+        self.buckets = [[] for _ in range(self.width + 1)]
+        for box_key in self.boxes:  # storage order, so every bucket is sorted
+            self.buckets[self.free_counts[box_key]].append(self.box_number[box_key])
+
+    def set_bitmap(self, box_key, bitmap):
+        """
+        Helper function. Replaces the bitmap of one box and moves the box to its new capacity bucket.
+        """
+        self.bitmaps[box_key] = bitmap
+        old_count = self.free_counts[box_key]
+        new_count = self.width - bin(bitmap).count("1")
+        if new_count != old_count:
+            number = self.box_number[box_key]
+            bucket = self.buckets[old_count]
+            del bucket[bisect.bisect_left(bucket, number)]
+            bisect.insort(self.buckets[new_count], number)
+            self.free_counts[box_key] = new_count
+
+    @classmethod
+    def from_positions(cls, material, occupied):
+        """
+        Builds the index from a set of occupied positions.
+
+        Args:
+            material (str): Biomaterial key of STORAGE_RULES
+            occupied (Iterable[Tuple]): Occupied (freezer, rack, box, pos), e.g. from get_occupied_positions
+
+        Returns:
+            OccupancyIndex: New index
+        """
+        index = cls(material)
+        index.set_bitmaps(index.build_bitmaps(occupied))
+        return index
+
+    def build_bitmaps(self, occupied):
+        """
+        Helper function. Packs occupied positions into bitmaps; positions outside of the grid of the
+        material are ignored (they can never be available for it).
+        """
+        bitmaps = dict.fromkeys(self.boxes, 0)
+        slot_bit = self.slot_bit
+        for freezer, rack, box, pos in occupied:
+            box_key = (freezer, rack, box)
+            bit = slot_bit.get(pos)
+            if bit is not None and box_key in bitmaps:
+                bitmaps[box_key] |= 1 << bit
+        return bitmaps
+
+    def sync(self, occupied):
+        """
+        Core function. Brings the index up to date with a new reference snapshot. Only the bitmaps of
+        boxes whose occupancy changed are replaced.
+
+        Args:
+            occupied (Iterable[Tuple]): Occupied positions of the new snapshot
+
+        Returns:
+            int: Number of slots that changed (occupied <-> free)
+        """
+        changed = 0
+        for box_key, bitmap in self.build_bitmaps(occupied).items():
+            diff = self.bitmaps[box_key] ^ bitmap
+            if diff:
+                changed += bin(diff).count("1")
+                self.set_bitmap(box_key, bitmap)
+        return changed
+
+    def apply_changes(self, positions, occupied):
+        """
+        Core function. Brings the slots of some positions, e.g. the positions of the changed records of a
+        delta export, up to date with the occupied positions of the new reference. A slot stays occupied
+        as long as any tube of the reference is stored there.
+
+        Args:
+            positions (Iterable[Tuple]): (freezer, rack, box, pos) that may have changed
+            occupied (Set[Tuple]): Occupied positions of the new reference
+
+        Returns:
+            int: Number of slots that changed (occupied <-> free)
+        """
+        changed = 0
+        for position in positions:
+            if self.locate(position) is None:
+                continue
+            stored = position in occupied
+            if stored == self.is_free(position):
+                changed += 1
+                if stored:
+                    self.occupy(position)
+                else:
+                    self.release(position)
+        return changed
+
+    def locate(self, position):
+        """
+        Helper function. Returns (box key, bit) of a position, None if it is not in the grid.
+        """
+        freezer, rack, box, pos = position
+        box_key = (freezer, rack, box)
+        bit = self.slot_bit.get(pos)
+        if bit is None or box_key not in self.bitmaps:
+            return None
+        return box_key, bit
+
+    def occupy(self, position):
+        """
+        Marks a position as occupied (e.g. a tube was stored). Positions outside the grid are ignored.
+        """
+        located = self.locate(position)
+        if located is not None:
+            box_key, bit = located
+            self.set_bitmap(box_key, self.bitmaps[box_key] | 1 << bit)
+
+    def release(self, position):
+        """
+        Marks a position as free (e.g. a tube was moved or used up). Positions outside the grid are ignored.
+        """
+        located = self.locate(position)
+        if located is not None:
+            box_key, bit = located
+            self.set_bitmap(box_key, self.bitmaps[box_key] & ~(1 << bit))
+
+    def is_free(self, position):
+        """
+        Checks if a (freezer, rack, box, pos) is a free slot of the material grid.
+        """
+        located = self.locate(position)
+        if located is None:
+            return False
+        box_key, bit = located
+        return not self.bitmaps[box_key] >> bit & 1
+
+    def free_count(self, box_key):
+        """
+        Returns the number of free slots in a box.
+        """
+        return self.free_counts[box_key]
+
+    def first_fit_boxes(self, k, min_free):
+        """
+        Core function. Returns the first k boxes in storage order with at least min_free free slots.
+
+        Args:
+            k (int): Number of boxes
+            min_free (int): Minimal number of free slots per box
+
+        Returns:
+            List[Tuple]: (freezer, rack, box) in storage order
+        """
+        fitting = heapq.merge(*self.buckets[max(min_free, 0):])
+        return [self.boxes[number] for number in islice(fitting, k)]
+
+    def best_fit_boxes(self, k, min_free):
+        """
+        Core function. Returns k boxes with the fewest free slots that still fit min_free, so partly used
+        boxes are filled up before empty boxes are opened. Boxes with the same free count are taken in
+        storage order.
+
+        Args:
+            k (int): Number of boxes
+            min_free (int): Minimal number of free slots per box
+
+        Returns:
+            List[Tuple]: (freezer, rack, box), fullest fitting box first
+        """
+        boxes = []
+        for bucket in self.buckets[max(min_free, 0):]:
+            for number in bucket:
+                boxes.append(self.boxes[number])
+                if len(boxes) >= k:
+                    return boxes
+        return boxes
+
+    def free_slots(self, box_key):
+        """
+        Returns the free slot names of a box in storage order.
+        """
+        free = ~self.bitmaps[box_key] & self.full
+        slots = self.slots
+        names = []
+        while free:
+            low = free & -free
+            names.append(slots[low.bit_length() - 1])
+            free ^= low
+        return names
+
+    def available_positions(self):
+        """
+        Core function. Returns all free positions of the material in storage order; the same list as
+        positions.get_available_positions.
+
+        Returns:
+            List[Tuple]: Free (freezer, rack, box, pos)
+        """
+        positions = []
+        for box_key in self.boxes:
+            freezer, rack, box = box_key
+            positions.extend((freezer, rack, box, pos) for pos in self.free_slots(box_key))
+        return positions
+
+    def occupied_positions(self):
+        """
+        Returns the occupied positions of the grid as set of (freezer, rack, box, pos).
+        """
+        occupied = set()
+        slots = self.slots
+        for (freezer, rack, box), bitmap in self.bitmaps.items():
+            while bitmap:
+                low = bitmap & -bitmap
+                occupied.add((freezer, rack, box, slots[low.bit_length() - 1]))
+                bitmap ^= low
+        return occupied
+
+    def save(self, path):
+        """
+        Saves the index as JSON. The bitmaps are stored as fixed-width hex strings in box order.
+
+        Args:
+            path (str): Path of the index file
+        """
+        digits = (self.width + 3) // 4
+        data = {
+            "version": INDEX_VERSION,
+            "material": self.material,
+            "grid": self.grid,
+            "synced_to": self.synced_to,
+            "bitmaps": [format(self.bitmaps[box_key], f"0{digits}x") for box_key in self.boxes],
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)  # never leave a half written index behind
+
+    @classmethod
+    def load(cls, path, material):
+        """
+        Loads a saved index.
+
+        Args:
+            path (str): Path of the index file
+            material (str): Expected biomaterial
+
+        Returns:
+            OccupancyIndex: Loaded index
+
+        Raises:
+            ValueError: If the file belongs to another material or the STORAGE_RULES grid changed
+        """
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(material)
+        if data.get("version") != INDEX_VERSION or data.get("material") != material:
+            raise ValueError(f"Occupancy index {path} does not belong to {material}.")
+        if data.get("grid") != index.grid:
+            raise ValueError(f"Occupancy index {path} was built for another {material} storage grid.")
+        index.set_bitmaps({box_key: int(bits, 16) for box_key, bits in zip(index.boxes, data["bitmaps"])})
+        index.synced_to = data.get("synced_to")
+        return index
+
+
+def changed_positions(rows):
+    """
+    Helper function. Positions of snapshot rows, whatever their tube status.
+
+    Returns:
+        Set[Tuple]: (freezer, rack, box, pos) of the rows with a complete position
+    """
+    return {record.position_key for record in iter_records(rows) if record.position_key is not None}
+
+
+def load_or_build(path, material, occupied, sync_stats=None):
+    """
+    Core function. Loads the saved index of a material and applies the changes of a delta export to
+    it, if the index reflects the snapshot the delta was merged into. Otherwise (first run, no snapshot
+    sync, a full export or an index of another snapshot) the index is built from the occupied
+    positions. The updated index is saved again.
+
+    Args:
+        path (str): Path of the index file
+        material (str): Biomaterial key of STORAGE_RULES
+        occupied (Set[Tuple]): Occupied positions of the current reference
+        sync_stats (Dict, optional): Stats of the snapshot sync of the reference (snapshots.sync_reference)
+
+    Returns:
+        index (OccupancyIndex): Up to date index
+        changed (int | None): Number of changed slots, None if the index was newly built
+    """
+    index = None
+    if sync_stats and sync_stats["mode"] == "delta" and os.path.exists(path):
+        try:
+            loaded = OccupancyIndex.load(path, material)
+        except (ValueError, KeyError) as e:
+            log.warning("Rebuilding occupancy index: %s", e)
+        else:
+            if loaded.synced_to == sync_stats["previous_sync"]:
+                index = loaded
+            else:
+                log.info("Rebuilding occupancy index: %s is not at the previous reference snapshot", path)
+
+    if index is None:
+        index, changed = OccupancyIndex.from_positions(material, occupied), None
+    else:
+        changed = index.apply_changes(
+            changed_positions(sync_stats["replaced"] + sync_stats["changed"]), occupied
+        )
+
+    index.synced_to = sync_stats["last_sync"] if sync_stats else None
+    index.save(path)
+    return index, changed
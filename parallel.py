@@ -0,0 +1,119 @@
+"""
+Multi-process row validation.
+
+Large files are split into row chunks which are validated in a process pool with the row-level rules
+(rules.validate_row_compiled). Each worker also extracts the partial indexes the dataset-level checks
+need (instance keys and storage positions of its chunk) and, for reference data, the ReferenceIndex
+entries of its rows, so the rows are normalized only once, in the workers. The results are collected strictly in chunk
+order, so the merged errors and indexes are in the same row order as a serial run and the report stays
+byte-identical.
+
+With the "spawn" start method (Windows, macOS) the worker processes import the __main__ module again;
+only use workers > 1 from scripts that guard their entry point with if __name__ == "__main__" (cli.py).
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from rules import validate_row_compiled
+from records import normalize_rows
+from utils import ReferenceIndex
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def chunk_rows(rows, chunk_size=DEFAULT_CHUNK_SIZE, start=2):
+    """
+    Helper function. Splits an iterable of rows into consecutive chunks.
+
+    Args:
+        rows (Iterable[Dict]): Rows of a file (a list or a streaming iterator)
+        chunk_size (int): Number of rows per chunk
+        start (int): Row number of the first row
+
+    Yields:
+        Tuple[int, List[Dict]]: Row number of the first row of the chunk and the chunk rows
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def scan_chunk(chunk, start, validate=True, index=False):
+    """
+    Worker function. Validates the rows of one chunk and extracts its partial indexes.
+
+    Args:
+        chunk (List[Dict]): Rows of the chunk
+        start (int): Row number of the first row of the chunk
+        validate (bool): Run the row-level rules (otherwise only the indexes are extracted)
+        index (bool): Also return the ReferenceIndex entries of the rows
+
+    Returns:
+        errors (List[List[ErrorRecord]] | None): Error list of every row of the chunk
+        instance_keys (List[Tuple]): (row number, (study_id, instance)) of the complete instance keys
+        positions (List[Tuple]): (row number, (freezer, rack, box, pos), tube_status) of every row
+        entries (List[Tuple] | None): ReferenceIndex.entry of every row, for ReferenceIndex.add_entry
+    """
+    records = normalize_rows(chunk)
+    errors = [validate_row_compiled(record, i) for i, record in enumerate(records, start=start)] if validate else None
+    instance_keys = []
+    positions = []
+    for i, record in enumerate(records, start=start):
+        if record.instance_key is not None:
+            instance_keys.append((i, record.instance_key))
+        positions.append((i, record.position_key, record.tube_status))
+    entries = list(map(ReferenceIndex.entry, records)) if index else None
+    return errors, instance_keys, positions, entries
+
+
+def scan_parallel(rows, workers, chunk_size=DEFAULT_CHUNK_SIZE, validate=True, index=False):
+    """
+    Core function. Scans the rows chunk by chunk in a process pool. At most 2 * workers chunks are in
+    flight, so a streaming row iterator is never read far ahead.
+
+    Args:
+        rows (Iterable[Dict]): Rows of a file
+        workers (int): Number of worker processes
+        chunk_size (int): Number of rows per chunk
+        validate (bool): Run the row-level rules in the workers
+        index (bool): Also extract the ReferenceIndex entries in the workers
+
+    Yields:
+        Tuple[List[Dict], Tuple]: The chunk rows and the result of scan_chunk, in chunk order
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for start, chunk in chunk_rows(rows, chunk_size):
+            pending.append((chunk, pool.submit(scan_chunk, chunk, start, validate, index)))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+def merge_scans(scans):
+    """
+    Helper function. Merges the chunk results of scan_parallel in chunk order.
+
+    Args:
+        scans (Iterable[Tuple]): Results of scan_parallel
+
+    Returns:
+        errors (List[List[ErrorRecord]]): Error list of every row
+        instance_keys (List[Tuple]): Merged instance key index
+        positions (List[Tuple]): Merged position index
+    """
+    errors, instance_keys, positions = [], [], []
+    for _, (chunk_errors, chunk_instances, chunk_positions, _) in scans:
+        if chunk_errors is not None:
+            errors.extend(chunk_errors)
+        instance_keys.extend(chunk_instances)
+        positions.extend(chunk_positions)
+    return errors, instance_keys, positions
@@ -0,0 +1,128 @@
+"""
+In-memory validation pipeline.
+
+The GUI used to write the downloaded REDCap records to the reference CSV and read the same file back
+for validation, while keeping the downloaded records for the other checks. Here the records are
+normalized and validated directly in one pass (validation.validate_reference_rows) into a ReferenceIndex;
+every later check and assignment works on that index. Writing the reference CSV is an optional side output that
+runs in a background thread while the validation continues.
+"""
+import threading
+
+import instrumentation
+import utils as u
+import validation as v
+from diagnostics import get_logger
+
+log = get_logger("pipeline")
+
+
+class CsvSideOutput:
+    """
+    Writes records to a CSV file in a background thread (utils.save_data_as_csv).
+
+    Attributes:
+        path (str): Path of the CSV file
+        error (Exception | None): Error of the writer thread, raised again by wait
+    """
+
+    def __init__(self, records, path):
+        self.path = path
+        self.error = None
+        self.thread = threading.Thread(target=self.write, args=(records,), daemon=True)
+        self.thread.start()
+
+    def write(self, records):
+        try:
+            u.save_data_as_csv(records, self.path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Waits until the file is written.
+
+        Raises:
+            Exception: The error of the writer thread, if any
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def validate_reference_records(records, label="Reference data", csv_path=None, workers=1, error_sink=None,
+                               cache=None, columnar=False):
+    """
+    Core function. Validates downloaded reference records without the CSV round trip. The records are
+    normalized once while they are validated and aggregated, the internal duplicate check runs in the
+    same pass.
+
+    Args:
+        records (List[Dict]): Flat REDCap records, e.g. from redcap_api.download_reference_from_redcap
+        label (str): Descriptive label
+        csv_path (str, optional): Also save the records to this CSV (in the background)
+        workers (int): Validate the rows in chunks on this many processes (parallel.py)
+        error_sink (function, optional): Called with the errors of every failing row (streaming report)
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py)
+        columnar (bool): Validate with the NumPy columnar engine (columnar.py)
+
+    Returns:
+        reference (ReferenceIndex): Index of the reference data
+        reference_errors (List[List[ErrorRecord]]): Validation errors of the failing reference rows
+        side_output (CsvSideOutput | None): Running CSV writer; call wait() before the file is used
+    """
+    if not records:
+        raise ValueError(f"No records in {label}.")
+
+    side_output = CsvSideOutput(records, csv_path) if csv_path else None
+    headers = list(records[0].keys())
+    log.info(" Checking %s: %d downloaded records", label, len(records))
+    reference, reference_errors = v.validate_reference_rows(
+        headers, iter(records), label, workers=workers, error_sink=error_sink, cache=cache, columnar=columnar
+    )
+    return reference, reference_errors, side_output
+
+
+def check_import(import_path, reference, label="Import file", workers=1, write_back=True, allocator=None,
+                 cache=None, columnar=False):
+    """
+    Core function. Validates one import file against the reference index, checks its positions
+    and assigns lab IDs and instances.
+
+    Args:
+        import_path (str): Path to the import CSV
+        reference (ReferenceIndex): Index of the reference data
+        label (str): Descriptive label
+        workers (int): Number of processes for the row validation
+        write_back (bool): Save the assigned lab IDs and instances into the import file
+        allocator (IdAllocator, optional): Shared allocator for the new lab IDs and instances (allocator.py)
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py)
+        columnar (bool): Validate the rows with the NumPy columnar engine (columnar.py)
+
+    Returns:
+        import_rows (List[TubeRecord]): Normalized import rows with the assignments
+        import_errors (List[ErrorRecord]): Validation errors of the import file
+        labid_messages (List[str]): Lab ID assignment messages
+        instance_messages (List[str]): Instance assignment messages
+        duplicate_positions_count (int): Number of invalid position duplicates
+    """
+    import_rows, import_errors = v.validate_import_file(
+        import_path, label, reference, columnar=columnar, workers=workers, cache=cache
+    )
+
+    v.check_internal_duplicates(import_rows, label, workers=workers)
+    with instrumentation.span("duplicates.positions", rows=len(import_rows)):
+        duplicate_positions_count = v.check_duplicate_positions(import_rows, None, reference)
+
+    with instrumentation.span("assign.lab_ids", rows=len(import_rows)):
+        import_rows, labid_messages = u.assign_lab_patient_ids(import_rows, reference, allocator=allocator)
+    with instrumentation.span("assign.instances", rows=len(import_rows)):
+        import_rows, instance_messages = u.assign_instances(import_rows, reference, allocator=allocator)
+    if write_back:
+        with instrumentation.span("import.write_back", rows=len(import_rows)):
+            u.save_data_as_csv(import_rows, import_path)
+    instrumentation.count("import.rows", len(import_rows))
+    instrumentation.count("import.errors", len(import_errors))
+    instrumentation.count("import.duplicate_positions", duplicate_positions_count)
+
+    return import_rows, import_errors, labid_messages, instance_messages, duplicate_positions_count
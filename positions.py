@@ -1,8 +1,15 @@
 from config import STORAGE_RULES, FREEZER_ORDER, STUDY_ID_PATTERN
-from itertools import product
+from itertools import product, islice, groupby
+from operator import itemgetter
 import csv
 from collections import defaultdict
 
+from records import iter_records
+from utils import ReferenceIndex
+from occupancy import OccupancyIndex
+
+BOX_POLICIES = ("first-fit", "best-fit")
+
 
 
 def get_occupied_positions(rows):
@@ -11,29 +18,23 @@ def get_occupied_positions(rows):
     they match the tube_status stored. 
 
     Args:
-        rows (List[Dict]): Data rows (e.g. from reference file)
+        rows (List[Dict] | ReferenceIndex): Data rows (e.g. from reference file) or the reference index
 
     Returns:
         positions Set[Tuple[str, str, str, str]]: Set of (freezer, rack, box, pos)
     """
-    positions = set()
+    if isinstance(rows, ReferenceIndex):
+        return rows.occupied_positions
 
-    for row in rows:
-        status = str(row.get("tube_status", "")).strip()
+    positions = set()
 
+    for record in iter_records(rows):
         # Only "Stored" tubes occupy a position
-        if status != "1":
+        if record.tube_status != "1":
             continue
 
-        key = (
-            str(row.get("freezer", "")).strip(),
-            str(row.get("rack", "")).strip(),
-            str(row.get("box", "")).strip(),
-            str(row.get("tube_pos", "")).strip(),
-        )
-
-        if all(key):
-            positions.add(key)
+        if record.position_key is not None:
+            positions.add(record.position_key)
 
     return positions
 
@@ -66,20 +67,63 @@ def generate_positions_for_material(material_key):
     return positions
 
 
-def get_available_positions(material_key, reference_rows):
+def iter_free_positions(material_key, occupied=None, index=None):
+    """
+    Core function. Walks the positions of a biomaterial lazily in storage order (freezer, rack, box, row,
+    col) and yields only the free ones. Nothing is materialized or sorted, so the first free positions
+    are found after touching only the boxes that are needed.
+
+    Args:
+        material_key (str): Biomaterial intended to store.
+        occupied (Set[Tuple], optional): Occupied positions, e.g. from get_occupied_positions
+        index (OccupancyIndex, optional): Up to date occupancy index of the material (occupancy.py);
+            used instead of occupied
+
+    Yields:
+        Tuple[str, str, str, str]: Free (freezer, rack, box, pos), in the order of position_sort_key
+    """
+    if index is not None:
+        for box_key in index.boxes:
+            freezer, rack, box = box_key
+            for pos in index.free_slots(box_key):
+                yield freezer, rack, box, pos
+        return
+
+    rules = STORAGE_RULES[material_key]
+    if occupied is None:
+        occupied = set()
+    slots = sorted((row + col for row in rules["rows"] for col in rules["cols"]), key=pos_sort_key)
+    freezers = sorted(set(rules["freezers"]), key=lambda freezer: FREEZER_ORDER.get(freezer, 99))
+    racks = sorted(set(rules["racks"]), key=int)
+    boxes = [str(box) for box in range(1, rules.get("boxes_per_rack", 1) + 1)]
+
+    for freezer, rack, box in product(freezers, racks, boxes):
+        for pos in slots:
+            position = (freezer, rack, box, pos)
+            if position not in occupied:
+                yield position
+
+
+def get_available_positions(material_key, reference_rows, occupied=None, index=None):
     """
     GUI core Function. Generates the matrices for different Biomaterial according to the freezer
     set-ups. Calculates which positions are occupied and returns the sorted positions.
 
     Args:
         material_key (str): Biomaterial intended to store.
-        reference_rows (List[Dict]): Existing REDCap data
+        reference_rows (List[Dict] | ReferenceIndex): Existing REDCap data or its index
+        occupied (Set[Tuple], optional): Precomputed occupied positions; reference_rows is then not scanned
+        index (OccupancyIndex, optional): Up to date occupancy index of the material (occupancy.py); the
+            free positions are then read from its bitmaps
  
     Returns:
         positions (list): Avaialbe positions for the selected Biomaterial.    
     """
+    if index is not None:
+        return index.available_positions()
     all_pos = generate_positions_for_material(material_key)
-    occupied = get_occupied_positions(reference_rows)
+    if occupied is None:
+        occupied = get_occupied_positions(reference_rows)
     return sorted(all_pos - occupied, key=position_sort_key)
 
 
@@ -189,6 +233,104 @@ def select_positions_single(material, available_positions, positionnumber = 20):
     return sorted(available_positions, key=position_sort_key)[:positionnumber]
 
 
+def select_free_positions(material, occupied=None, index=None, box_policy="first-fit"):
+    """
+    GUI core function. Selects available positions like select_positions_for_material, but walks the
+    free positions lazily (iter_free_positions) and stops as soon as enough are found.
+
+    Args:
+        material (str): Biomaterial (must exist in STORAGE_RULES (Global var))
+        occupied (Set[Tuple], optional): Occupied positions, e.g. from get_occupied_positions
+        index (OccupancyIndex, optional): Up to date occupancy index of the material (occupancy.py)
+        box_policy (str): Box choice for BIOFLUID: "first-fit" takes the first boxes in storage order with
+            at least 15 free slots (as select_positions_biofluids), "best-fit" the boxes with the fewest
+            free slots that still fit 15, so partly used boxes are filled up first
+
+    Returns:
+        list: Selected positions
+
+    Raises:
+        ValueError: If material has no storage rule
+    """
+    material = material.strip().upper()
+
+    if material not in STORAGE_RULES:
+        raise ValueError(
+            f"Material '{material}' has no defined STORAGE_RULE."
+        )
+
+    if box_policy not in BOX_POLICIES:
+        raise ValueError(f"Unknown box policy '{box_policy}', use one of {BOX_POLICIES}.")
+
+    if material == "BIOFLUID" and (index is not None or box_policy == "best-fit"):
+        if index is None:
+            index = OccupancyIndex.from_positions(material, occupied or ())
+        return take_boxes_biofluids(index, box_policy)
+
+    free_positions = iter_free_positions(material, occupied, index)
+    if material == "BIOFLUID":
+        return take_positions_biofluids(free_positions)
+    return list(islice(free_positions, 20))
+
+
+def take_boxes_biofluids(index, box_policy="first-fit", min_free=15, box_number=3, max_positions=300):
+    """
+    Helper function. Selects BIOFLUID positions from the box capacity buckets of an occupancy index;
+    only the chosen boxes are read.
+
+    Args: 
+        index (OccupancyIndex): Up to date occupancy index of BIOFLUID
+        box_policy (str): "first-fit" or "best-fit", see select_free_positions
+        min_free (int): Minimal number of free slots of a box
+        box_number (int): Number of boxes
+        max_positions (int): Maximal number of selected positions
+    Returns:
+        list: Selected positions, box by box    
+    """
+    if box_policy == "best-fit":
+        boxes = index.best_fit_boxes(box_number, min_free)
+    else:
+        boxes = index.first_fit_boxes(box_number, min_free)
+
+    selected = []
+    for freezer, rack, box in boxes:
+        for pos in index.free_slots((freezer, rack, box)):
+            selected.append((freezer, rack, box, pos))
+            if len(selected) >= max_positions:
+                return selected
+    return selected
+
+
+def take_positions_biofluids(free_positions):
+    """
+    Helper function. Same selection as select_positions_biofluids for free positions that are already
+    in storage order; they are grouped box by box while they are consumed.
+
+    Args: 
+        free_positions (Iterable[Tuple]): Free positions in storage order (iter_free_positions)
+    Returns:
+        list: Selected sorted positions    
+    """
+    selected = []
+    box_count = 0
+
+    for _, positions in groupby(free_positions, key=itemgetter(0, 1, 2)):
+        positions = list(positions)
+        if len(positions) < 15:
+            continue
+
+        box_count += 1
+        for position in positions:
+            selected.append(position)
+            if len(selected) >= 300:
+                return selected
+
+        if box_count >= 3:
+            break
+
+    return selected
+
+
 def select_positions_biofluids(available_positions):
     """
     Helper function. Selects positions per box sequentially for BIOFLUIDS. 
@@ -237,15 +379,3 @@ def group_positions_by_box(positions):
         box_map[key] = sorted(box_map[key], key=pos_sort_key)
 
     return box_map
-
-
-
-
-
-
-
-
-
-
-
-
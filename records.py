@@ -0,0 +1,182 @@
+"""
+Normalized tube records.
+
+Every CSV row or REDCap record is normalized once into a compact TubeRecord: all REQUIRED_FIELDS are
+stripped strings (low-cardinality codes such as freezer, rack, box and tube_pos are interned), numbers
+are parsed to integers and the instance, position and tube keys are precomputed. The validation and
+assignment functions work on these records instead of stripping the same dictionary values again and
+again. They still accept plain row dictionaries, which are normalized on the fly.
+"""
+import sys
+
+from config import REQUIRED_FIELDS
+
+FIELDS = tuple(REQUIRED_FIELDS)
+FIELD_SET = frozenset(FIELDS)
+
+# Fields normalized explicitly in TubeRecord.from_row; fields added to REQUIRED_FIELDS later are
+# normalized generically
+KNOWN_FIELDS = (
+    "study_id", "study", "lab_id", "redcap_event_name", "sampling_date", "biomaterial", "tube_pos",
+    "redcap_repeat_instrument", "redcap_repeat_instance", "tube_id", "box_id", "freezer", "rack",
+    "box", "tube_status",
+)
+EXTRA_FIELDS = tuple(field for field in FIELDS if field not in KNOWN_FIELDS)
+
+
+def clean(value):
+    """
+    Helper function. Normalizes one raw value to a stripped string (None -> "").
+    """
+    if value is None:
+        return ""
+    return str(value).strip()
+
+
+def to_int(value):
+    """
+    Helper function. Parses a stripped digit string, returns None for anything else.
+    """
+    return int(value) if value.isdigit() else None
+
+
+class TubeRecord:
+    """
+    Normalized row of import or reference data (one tube / one REDCap biorepository instance).
+
+    Attributes:
+        <REQUIRED_FIELDS> (str): Stripped values, e.g. record.study_id, record.freezer
+        instance_no, rack_no, box_no (int | None): Parsed numbers, None if not a positive digit string
+        instance_key (Tuple | None): (study_id, redcap_repeat_instance) if both are set
+        position_key (Tuple | None): (freezer, rack, box, tube_pos) if all are set
+        tube_key (str | Tuple | None): tube_id, else the position key (see utils.get_tube_key)
+        source (Dict | None): Original row, kept for import rows so that assignments are written back
+    """
+
+    __slots__ = tuple(dict.fromkeys(KNOWN_FIELDS + FIELDS)) + (
+        "instance_no", "rack_no", "box_no", "instance_key", "position_key", "tube_key", "source",
+    )
+
+    @classmethod
+    def from_row(cls, row, keep_source=False):
+        """
+        Normalizes a row dictionary (CSV row or REDCap record).
+
+        Args:
+            row (Dict): Raw row
+            keep_source (bool): Keep a reference to the row (needed to write assignments back)
+
+        Returns:
+            TubeRecord: Normalized record
+        """
+        record = cls.__new__(cls)
+        get = row.get
+        intern = sys.intern
+
+        record.study_id = clean(get("study_id"))
+        record.study = clean(get("study"))
+        record.lab_id = clean(get("lab_id"))
+        record.redcap_event_name = intern(clean(get("redcap_event_name")))
+        record.sampling_date = clean(get("sampling_date"))
+        record.biomaterial = intern(clean(get("biomaterial")))
+        record.tube_pos = intern(clean(get("tube_pos")))
+        record.redcap_repeat_instrument = intern(clean(get("redcap_repeat_instrument")))
+        record.redcap_repeat_instance = clean(get("redcap_repeat_instance"))
+        record.tube_id = clean(get("tube_id"))
+        record.box_id = clean(get("box_id"))
+        record.freezer = intern(clean(get("freezer")))
+        record.rack = intern(clean(get("rack")))
+        record.box = intern(clean(get("box")))
+        record.tube_status = intern(clean(get("tube_status")))
+        for field in EXTRA_FIELDS:
+            setattr(record, field, clean(get(field)))
+
+        record.rack_no = to_int(record.rack)
+        record.box_no = to_int(record.box)
+        record.source = row if keep_source else None
+        record._update_instance()
+        record._update_position()
+        return record
+
+    def _update_instance(self):
+        instance = self.redcap_repeat_instance
+        self.instance_no = to_int(instance)
+        self.instance_key = (self.study_id, instance) if self.study_id and instance else None
+
+    def _update_position(self):
+        position = (self.freezer, self.rack, self.box, self.tube_pos)
+        self.position_key = position if all(position) else None
+        self.tube_key = self.tube_id or self.position_key
+
+    def get(self, field, default=""):
+        """
+        Dictionary-style access, so records can be passed where row dictionaries are expected.
+        """
+        if field in FIELD_SET:
+            return getattr(self, field)
+        if self.source is not None:
+            return self.source.get(field, default)
+        return default
+
+    def set_lab_id(self, lab_id):
+        """
+        Sets the lab_id (also in the source row).
+        """
+        self.lab_id = lab_id
+        if self.source is not None:
+            self.source["lab_id"] = lab_id
+
+    def set_instance(self, instance):
+        """
+        Sets the redcap_repeat_instance (also in the source row).
+        """
+        self.redcap_repeat_instance = str(instance)
+        self._update_instance()
+        if self.source is not None:
+            self.source["redcap_repeat_instance"] = self.redcap_repeat_instance
+
+    def to_dict(self):
+        """
+        Returns the row as dictionary: the (updated) source row if kept, else the REQUIRED_FIELDS.
+        """
+        if self.source is not None:
+            return self.source
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def __repr__(self):
+        return f"TubeRecord(study_id={self.study_id!r}, instance={self.redcap_repeat_instance!r}, " \
+               f"position={self.position_key!r}, tube_id={self.tube_id!r})"
+
+
+def as_record(row):
+    """
+    Helper function. Returns row itself if it is already a TubeRecord, otherwise normalizes it.
+    """
+    if type(row) is TubeRecord:
+        return row
+    return TubeRecord.from_row(row)
+
+
+def iter_records(rows):
+    """
+    Helper function. Iterates rows as TubeRecords; records pass through, dictionaries are normalized.
+    """
+    for row in rows:
+        yield row if type(row) is TubeRecord else TubeRecord.from_row(row)
+
+
+def normalize_rows(rows, keep_source=False):
+    """
+    Core function. Normalizes all rows once.
+
+    Args:
+        rows (Iterable[Dict]): CSV rows or REDCap records
+        keep_source (bool): Keep the original rows for writing assignments back (import files)
+
+    Returns:
+        List[TubeRecord]: Normalized records
+    """
+    return [
+        row if type(row) is TubeRecord else TubeRecord.from_row(row, keep_source)
+        for row in rows
+    ]
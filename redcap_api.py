@@ -1,19 +1,67 @@
+import codecs
+import json
+import logging
+import random
+import statistics
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+from diagnostics import get_logger, log_limited
+
+log = get_logger("redcap_api")
+
+
+class RedcapError(Exception):
+    """Base class of all REDCap API errors."""
+
+
+class RedcapConnectionError(RedcapError):
+    """REDCap could not be reached (network, VPN, DNS) or the connection broke off."""
+
+
+class RedcapTimeoutError(RedcapConnectionError):
+    """REDCap did not answer in time."""
+
+
+class RedcapAuthError(RedcapError):
+    """The API token was rejected (HTTP 401 / 403)."""
+
+
+class RedcapHTTPError(RedcapError):
+    """REDCap answered with an unexpected HTTP status."""
 
+    def __init__(self, status_code, text):
+        super().__init__(f"REDCap API returned status code {status_code}: {text}")
+        self.status_code = status_code
 
-def download_reference_from_redcap(api_url, api_token,report_id = "27", form_name="biorepository"):
+
+class RedcapResponseError(RedcapError):
+    """The answer of REDCap could not be decoded or has an unexpected format."""
+
+
+# HTTP status codes of transient failures that are worth another attempt
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+def export_form_data(api_token, form_name="biorepository", date_range_begin=None, record_ids=None):
     """
-    Helper function from GUI. Downloads reference data directly from REDCap via API.
+    Helper function. Builds the form data of a record export of one instrument.
 
     Args:
-        api_url (str): The REDCap API endpoint URL
-        api_token (str): Your REDCap API token
+        api_token (str): REDCap API token
         form_name (str): The name of the REDCap instrument to export
+        date_range_begin (str, optional): Only export records created or modified after this time
+            ("YYYY-MM-DD HH:MM:SS", REDCap server time), see snapshots.sync_reference
+        record_ids (List[str], optional): Only export these records
 
     Returns:
-        records List[Dict]: A list of flat REDCap records
+        Dict: POST data of the request
     """
-
     data = {
         'token': api_token,
         'action': 'export',
@@ -32,30 +80,351 @@ def download_reference_from_redcap(api_url, api_token,report_id = "27", form_nam
         'exportCheckboxLabel': 'false',
         'returnFormat': 'json'
     }
-        
-    #EAFP style
-    try:
-        response = requests.post(api_url, data=data, timeout=20)
+    if date_range_begin:
+        data['dateRangeBegin'] = date_range_begin
+    for i, record_id in enumerate(record_ids or ()):
+        data[f'records[{i}]'] = record_id
+    return data
+
+
+def record_id_form_data(api_token, id_field="study_id"):
+    """
+    Helper function. Builds the form data of an export of the record IDs only (same event as
+    export_form_data).
+    """
+    return {
+        'token': api_token,
+        'action': 'export',
+        'content': 'record',
+        'format': 'json',
+        'fields[0]': id_field,
+        'events[0]': 'participant_regist_arm_1',
+        'rawOrLabel': 'raw',
+        'returnFormat': 'json'
+    }
+
+
+class ExportStats:
+    """
+    Throughput and latency of a batched export (RedcapClient.iter_records_batched).
+
+    Attributes:
+        batches (List[Tuple[int, float]]): (number of records, seconds) per batch, in batch order
+        seconds (float): Wall time of the whole export
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.seconds = 0.0
+
+    @property
+    def records(self):
+        return sum(count for count, _ in self.batches)
+
+    def summary(self):
+        """
+        Returns a one line summary for the console / report.
+        """
+        if not self.batches:
+            return "No batches exported."
+        latencies = [seconds for _, seconds in self.batches]
+        rate = self.records / self.seconds if self.seconds else 0.0
+        return (
+            f"Exported {self.records} records in {len(self.batches)} batches in {self.seconds:.1f} s "
+            f"({rate:.0f} records/s); batch latency min {min(latencies):.2f} s, "
+            f"median {statistics.median(latencies):.2f} s, max {max(latencies):.2f} s"
+        )
+
+
+def iter_json_array(chunks):
+    """
+    Helper function. Decodes a JSON array incrementally and yields its elements as soon as they are
+    complete, so records can be processed while the download is still running.
+
+    Args:
+        chunks (Iterable[bytes]): Raw (already decompressed) body of the response
+
+    Yields:
+        object: Elements of the array
+
+    Raises:
+        RedcapResponseError: If the body is not a JSON array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+    finished = False
 
-        # API communication errors
-        if response.status_code != 200:
-            raise Exception(f"REDCap API returned status code {response.status_code}: {response.text}")
+    def skip_whitespace(buffer, pos):
+        while pos < len(buffer) and buffer[pos] in " \t\r\n":
+            pos += 1
+        return pos
 
-        # JSON decode errors 
+    for chunk in chunks:
+        buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            pos = skip_whitespace(buffer, pos)
+            if pos >= len(buffer) or finished:
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise RedcapResponseError(
+                        "Unexpected API response format. Expected list of records. Response was:\n" + buffer[:500]
+                    )
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                finished = True
+                pos += 1
+                continue
+            if buffer[pos] == ",":
+                pos += 1
+                continue
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # element not complete yet, read more
+            if end == len(buffer) and not isinstance(element, (dict, list, str)):
+                break  # a number at the end of the buffer might continue in the next chunk
+            pos = end
+            yield element
+
+    buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+    if not finished or buffer.strip():
+        raise RedcapResponseError(
+            "Could not decode JSON returned from REDCap. Response was:\n" + buffer[:500]
+        )
+
+
+class RedcapClient:
+    """
+    Reusable REDCap API client. Connections are pooled in one requests session, answers are requested
+    gzip compressed and decoded incrementally, transient failures are retried with exponential backoff
+    and jitter, and failures are raised as typed RedcapError exceptions.
+
+    Attributes:
+        api_url (str): The REDCap API endpoint URL
+        api_token (str): REDCap API token
+        timeout (Tuple[float, float]): (connect, read) timeout in seconds; the read timeout applies
+            between two received blocks, not to the whole download
+        retries (int): Further attempts after a transient failure
+        backoff (float): Base delay in seconds, doubled with every attempt
+    """
+
+    def __init__(self, api_url, api_token, timeout=(10, 20), retries=3, backoff=0.5, pool_size=4):
+        self.api_url = api_url
+        self.api_token = api_token
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def retry_delay(self, attempt):
+        """
+        Helper function. Exponential backoff with full jitter (0 .. backoff * 2^attempt seconds).
+        """
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def post(self, data):
+        """
+        Core function. Sends one API request and returns the streamed response. Connection errors,
+        timeouts and the status codes in RETRY_STATUS are retried.
+
+        Args:
+            data (Dict): POST form data
+
+        Returns:
+            requests.Response: Response with status 200; the body is not read yet
+
+        Raises:
+            RedcapAuthError, RedcapHTTPError, RedcapTimeoutError, RedcapConnectionError
+        """
+        attempt = 0
+        while True:
+            instrumentation.count("redcap.requests")
+            try:
+                response = self.session.post(self.api_url, data=data, timeout=self.timeout, stream=True)
+            except requests.exceptions.Timeout as e:
+                error = RedcapTimeoutError(f"Connection timed out while contacting REDCap API: {e}")
+            except requests.exceptions.ConnectionError as e:
+                error = RedcapConnectionError(f"Could not connect to REDCap. Check VPN, URL, or internet: {e}")
+            else:
+                if response.status_code == 200:
+                    return response
+                text = response.text[:500]
+                response.close()
+                if response.status_code in (401, 403):
+                    raise RedcapAuthError(f"REDCap rejected the API token ({response.status_code}): {text}")
+                error = RedcapHTTPError(response.status_code, text)
+                if response.status_code not in RETRY_STATUS:
+                    raise error
+
+            if attempt >= self.retries:
+                raise error
+            instrumentation.count("redcap.retries")
+            delay = self.retry_delay(attempt)
+            log_limited(log, logging.WARNING, "REDCap request failed (%s), retry in %.1fs", error, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def iter_records(self, data, chunk_size=64 * 1024):
+        """
+        Core function. Sends a record export and yields the records while they arrive. Only the
+        request itself is retried; a connection that breaks off during the download raises
+        RedcapConnectionError, because records were already handed out.
+
+        Args:
+            data (Dict): POST form data of a record export (export_form_data)
+            chunk_size (int): Size of the read blocks in bytes
+
+        Yields:
+            Dict: Flat REDCap records
+
+        Raises:
+            RedcapError: see post and iter_json_array
+        """
+        response = self.post(data)
         try:
-            records = response.json()
-        except Exception:
-            raise Exception("Could not decode JSON returned from REDCap. Response was:\n" + response.text)
-
-        if not isinstance(records, list):
-            raise Exception("Unexpected API response format. Expected list of records.")
-
-        print(f"Successfully downloaded {len(records)} records from REDCap.")
-        return records
-
-    except requests.exceptions.ConnectTimeout:
-        raise Exception("Connection timed out while contacting REDCap API.")
-    except requests.exceptions.ConnectionError:
-        raise Exception("Could not connect to REDCap. Check VPN, URL, or internet.")
-    except Exception as e:
-        raise Exception(f"REDCap API error: {str(e)}")
+            for record in iter_json_array(response.iter_content(chunk_size)):
+                if not isinstance(record, dict):
+                    raise RedcapResponseError("Unexpected API response format. Expected list of records.")
+                yield record
+        except requests.exceptions.Timeout as e:
+            raise RedcapTimeoutError(f"REDCap stopped sending during the download: {e}")
+        except requests.exceptions.RequestException as e:
+            raise RedcapConnectionError(f"Connection to REDCap broke off during the download: {e}")
+        finally:
+            response.close()
+
+    def export_records(self, form_name="biorepository", date_range_begin=None, record_ids=None):
+        """
+        Streams the records of one instrument, see export_form_data and iter_records.
+        """
+        data = export_form_data(self.api_token, form_name, date_range_begin, record_ids)
+        return self.iter_records(data)
+
+    def export_record_ids(self, id_field="study_id"):
+        """
+        Exports the list of record IDs of the project, in REDCap order and without duplicates.
+        """
+        record_ids = {}
+        for record in self.iter_records(record_id_form_data(self.api_token, id_field)):
+            record_ids.setdefault(record.get(id_field, ""), None)
+        return [record_id for record_id in record_ids if record_id]
+
+    def export_batch(self, form_name, record_ids):
+        """
+        Helper function. Exports one batch of records completely and measures its latency.
+
+        Returns:
+            Tuple[List[Dict], float]: Records of the batch and seconds it took
+        """
+        start = time.perf_counter()
+        records = list(self.export_records(form_name, record_ids=record_ids))
+        return records, time.perf_counter() - start
+
+    def iter_records_batched(self, form_name="biorepository", batch_size=500, concurrency=4, stats=None):
+        """
+        Core function. Exports a large instrument in record ID batches instead of one request: the record
+        ID list is exported first, then several batches are exported at the same time (thread pool,
+        at most concurrency requests at once). The records are yielded batch by batch in record ID
+        order, the same order as one full export. At most 2 * concurrency batches are in flight.
+
+        Args:
+            form_name (str): The name of the REDCap instrument to export
+            batch_size (int): Number of record IDs per request
+            concurrency (int): Maximal number of requests at the same time
+            stats (ExportStats, optional): Filled with the batch latencies and the throughput
+
+        Yields:
+            Dict: Flat REDCap records
+        """
+        if stats is None:
+            stats = ExportStats()
+        start = time.perf_counter()
+        record_ids = self.export_record_ids()
+        batches = [record_ids[i:i + batch_size] for i in range(0, len(record_ids), batch_size)]
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(self.export_batch, form_name, batch))
+                if len(pending) >= 2 * concurrency:
+                    records, seconds = pending.popleft().result()
+                    stats.batches.append((len(records), seconds))
+                    yield from records
+            while pending:
+                records, seconds = pending.popleft().result()
+                stats.batches.append((len(records), seconds))
+                yield from records
+        stats.seconds = time.perf_counter() - start
+
+
+def download_reference_batched(api_url, api_token, form_name="biorepository", date_range_begin=None,
+                               batch_size=500, concurrency=4):
+    """
+    Helper function. Like download_reference_from_redcap, but a full export is split into concurrent
+    record ID batches (RedcapClient.iter_records_batched); delta exports (date_range_begin) are small
+    and use one request.
+
+    Returns:
+        records List[Dict]: A list of flat REDCap records
+    """
+    if date_range_begin:
+        return download_reference_from_redcap(api_url, api_token, form_name=form_name,
+                                              date_range_begin=date_range_begin)
+    stats = ExportStats()
+    with instrumentation.span("reference.download") as stage, \
+            RedcapClient(api_url, api_token, pool_size=concurrency) as client:
+        records = list(client.iter_records_batched(form_name, batch_size, concurrency, stats))
+        stage.rows = len(records)
+    log.info("%s", stats.summary())
+    return records
+
+
+def download_reference_from_redcap(api_url, api_token,report_id = "27", form_name="biorepository",
+                                   date_range_begin=None, client=None):
+    """
+    Helper function from GUI. Downloads reference data directly from REDCap via API.
+
+    Args:
+        api_url (str): The REDCap API endpoint URL
+        api_token (str): Your REDCap API token
+        form_name (str): The name of the REDCap instrument to export
+        date_range_begin (str, optional): Only export records created or modified after this time
+            ("YYYY-MM-DD HH:MM:SS", REDCap server time), see snapshots.sync_reference
+        client (RedcapClient, optional): Client to reuse (connection pool); a new one is used otherwise
+
+    Returns:
+        records List[Dict]: A list of flat REDCap records
+
+    Raises:
+        RedcapError: Typed error of the failed download (subclass of Exception)
+    """
+    with instrumentation.span("reference.download") as stage:
+        if client is None:
+            with RedcapClient(api_url, api_token) as client:
+                records = list(client.export_records(form_name, date_range_begin))
+        else:
+            records = list(client.export_records(form_name, date_range_begin))
+        stage.rows = len(records)
+
+    log.info("Successfully downloaded %d records from REDCap.", len(records))
+    return records
@@ -0,0 +1,578 @@
+"""
+Streaming validation reports in text, CSV, JSON Lines and HTML format.
+
+A ReportWriter takes the errors while they are produced (e.g. as error_sink of
+validation.validate_reference_rows) instead of one materialized list. Every error is counted per rule
+and per storage box; only the first max_details errors are listed in detail, page_size per page. The
+first page follows the summary in the report file, further pages go to <report>_page2.<ext>, ... The
+detail lines are spooled to temporary files, so the summary can be put at the top when the report is
+closed. If the with block fails, the spooled parts are dropped and an existing report stays as it was:
+
+    with open_report("report.html", inputs=[("Reference", path)]) as report:
+        with report.section("reference", "Errors / Warnings Referencefile:", "Reference file"):
+            validate_reference_stream(path, "Reference data", error_sink=report.add_row_errors)
+
+utils.write_report writes the usual report of an import file with it.
+"""
+import csv
+import html
+import io
+import json
+import os
+import shutil
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import REPORT_SUMMARY_RULES, REPORT_DETAIL_LIMIT, REPORT_PAGE_SIZE
+from error_records import ErrorRecord, SUMMARIES, box_label
+from instrumentation import report_lines
+
+
+TITLE = "Biorepository Data Validation Report"
+FORMATS = ("text", "csv", "jsonl", "html")
+EXTENSIONS = {".txt": "text", ".csv": "csv", ".jsonl": "jsonl", ".html": "html", ".htm": "html"}
+DEFAULT_EXTENSIONS = {"text": ".txt", "csv": ".csv", "jsonl": ".jsonl", "html": ".html"}
+
+
+def format_from_path(path):
+    """
+    Helper function. Report format of a file name by its extension, text for unknown extensions.
+    """
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "text")
+
+
+def page_path(path, page):
+    """
+    Helper function. File of a further detail page, e.g. report.html, 2 -> report_page2.html.
+    """
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_page{page}{extension}"
+
+
+class ReportWriter:
+    """
+    Base class of the report formats; the subclasses only render the single parts.
+
+    Attributes:
+        path (str): Report file
+        inputs (List[Tuple[str, str]]): (label, path) of the validated files
+        facts (List[Tuple[str, object]]): Further summary lines, e.g. the number of import rows
+        max_details (int): Number of errors listed in detail, the rest is only counted
+        page_size (int): Errors per page
+        summary_limit (int): Rules and boxes listed per source in the summary
+        pages (List[str]): Files of the report, the report itself first
+    """
+
+    def __init__(self, path, inputs=(), title=TITLE, max_details=REPORT_DETAIL_LIMIT,
+                 page_size=REPORT_PAGE_SIZE, summary_limit=REPORT_SUMMARY_RULES):
+        self.path = path
+        self.inputs = list(inputs)
+        self.title = title
+        self.facts = []
+        self.max_details = max_details
+        self.page_size = max(1, page_size)
+        self.summary_limit = summary_limit
+        self.created = datetime.now()
+        self.pages = [path]
+
+        self.sources = {}              # source -> label, in first-seen order
+        self.error_counts = Counter()  # source -> errors
+        self.row_counts = Counter()    # source -> failing rows (grouped errors)
+        self.rule_counts = Counter()   # (source, code, field, context) -> errors
+        self.box_counts = Counter()    # (source, box) -> errors
+        self.listed = 0
+        self.unlisted = 0
+
+        # page 1 is spooled and copied behind the summary on close
+        self.body = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+        self.out = self.body
+        self.source = None
+        self.section_title = None
+        self.section_items = 0
+        self.section_unlisted = 0
+        self.last_row = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+    def add_fact(self, label, value):
+        """
+        Adds a line to the summary, e.g. add_fact("Number of import rows processed", 120).
+        """
+        self.facts.append((label, value))
+
+    @contextmanager
+    def section(self, source, title, label=None):
+        """
+        Core function. Opens a section of the detail list; errors and messages added inside belong to it.
+
+        Args:
+            source (str): Key of the section, e.g. "import" or "reference"
+            title (str): Heading of the section
+            label (str, optional): Name of the source in the summary (errors are only summarized with a label)
+        """
+        if label:
+            self.sources.setdefault(source, label)
+        self.source = source
+        self.section_title = title
+        self.section_items = 0
+        self.section_unlisted = 0
+        self.last_row = None
+        self.out.write(self.section_start(title))
+        try:
+            yield self
+        finally:
+            if self.section_unlisted:
+                self.out.write(self.unlisted_note(self.section_unlisted))
+            elif not self.section_items:
+                self.out.write(self.none_item())
+            self.out.write(self.section_end())
+            self.section_title = None
+
+    def add_errors(self, errors, grouped=False):
+        """
+        Core function. Counts the errors of the current section and lists them while below max_details.
+
+        Args:
+            errors (Iterable[ErrorRecord | str]): Errors (plain strings are listed, but not counted)
+            grouped (bool): The errors are the errors of one row (listed under a row heading in text)
+        """
+        source = self.source
+        n = 0
+        for error in errors:
+            if not isinstance(error, ErrorRecord):
+                self.add_messages([error])
+                continue
+            n += 1
+            self.rule_counts[source, error.code, error.field, error.args[1:]] += 1
+            self.box_counts[source, error.box] += 1
+            if self.listed >= self.max_details:
+                self.unlisted += 1
+                self.section_unlisted += 1
+                continue
+            if self.listed and self.listed % self.page_size == 0:
+                self.next_page()
+            self.listed += 1
+            self.section_items += 1
+            self.out.write(self.error_item(error, error.row != self.last_row if grouped else None))
+            self.last_row = error.row
+        self.error_counts[source] += n
+        if grouped and n:
+            self.row_counts[source] += 1
+
+    def add_row_errors(self, errors):
+        """
+        Adds the errors of one failing row, see add_errors. Usable as error_sink of the validators.
+        """
+        self.add_errors(errors, grouped=True)
+
+    def add_messages(self, messages):
+        """
+        Core function. Lists plain messages (e.g. lab ID assignments) in the current section; they are
+        neither counted nor capped.
+        """
+        for message in messages:
+            self.section_items += 1
+            self.out.write(self.message_item(str(message)))
+
+    def next_page(self):
+        """
+        Helper function. Continues the detail list in the next page file.
+        """
+        self.out.write(self.section_end())
+        if self.out is not self.body:
+            self.out.write(self.page_end())
+            self.out.close()
+        path = page_path(self.path, len(self.pages) + 1)
+        self.pages.append(path)
+        # written under a temporary name, renamed on close
+        self.out = open(path + ".tmp", "w", encoding="utf-8", newline="")
+        self.out.write(self.page_start(len(self.pages)))
+        self.out.write(self.section_start(f"{self.section_title} (continued)"))
+        self.last_row = None
+
+    def close(self, metrics=None):
+        """
+        Core function. Writes the report file: header, summary, first page of the details and the
+        optional stage timings.
+
+        Args:
+            metrics (Dict, optional): Stage timings and counters (instrumentation.summary)
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.out is not self.body:
+            self.out.write(self.page_end())
+            self.out.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            f.write(self.header())
+            f.write(self.summary())
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, f)
+            if metrics:
+                f.write(self.metrics_part(metrics))
+            f.write(self.footer())
+        self.body.close()
+        os.replace(tmp_path, self.path)
+        for path in self.pages[1:]:
+            os.replace(path + ".tmp", path)
+
+        # pages of an earlier, longer report with the same name would look like part of this one
+        page = len(self.pages) + 1
+        while os.path.exists(page_path(self.path, page)):
+            os.remove(page_path(self.path, page))
+            page += 1
+
+    def discard(self):
+        """
+        Helper function. Drops the spooled report after an error; an existing report with the same name
+        and its pages are not touched.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.out is not self.body:
+            self.out.close()
+        self.body.close()
+        for path in self.pages[1:]:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+    def rule_summary(self, source):
+        """
+        Helper function. Most frequent rules of a source.
+
+        Returns:
+            List[Tuple[int, str, str]]: (count, summary, code), at most summary_limit
+        """
+        counts = sorted(
+            ((n, SUMMARIES[code].format(None, *context, field=field), code)
+             for (rule_source, code, field, context), n in self.rule_counts.items() if rule_source == source),
+            key=lambda item: (-item[0], item[1]),
+        )
+        return counts[:self.summary_limit]
+
+    def box_summary(self, source):
+        """
+        Helper function. Boxes with the most errors of a source.
+
+        Returns:
+            List[Tuple[int, str]]: (count, box label), at most summary_limit
+        """
+        counts = sorted(
+            ((n, box_label(box)) for (box_source, box), n in self.box_counts.items() if box_source == source),
+            key=lambda item: (-item[0], item[1]),
+        )
+        return counts[:self.summary_limit]
+
+    def total_errors(self):
+        return sum(self.error_counts.values())
+
+    # Rendering of the single parts, implemented by the formats
+    def header(self):
+        return ""
+
+    def summary(self):
+        return ""
+
+    def section_start(self, title):
+        return ""
+
+    def section_end(self):
+        return ""
+
+    def error_item(self, error, heading):
+        """
+        Renders one listed error; heading is None for flat lists, for the errors of one row True at
+        the first error of the row.
+        """
+        return ""
+
+    def message_item(self, message):
+        return ""
+
+    def none_item(self):
+        return ""
+
+    def unlisted_note(self, n):
+        return ""
+
+    def metrics_part(self, metrics):
+        return ""
+
+    def footer(self):
+        return ""
+
+    def page_start(self, page):
+        return ""
+
+    def page_end(self):
+        return ""
+
+
+class TextReportWriter(ReportWriter):
+    """
+    Plain text report, the layout of the original utils.write_report.
+    """
+
+    def header(self):
+        lines = [self.title, f"Date: {self.created.strftime('%Y-%m-%d %H:%M')}", "=" * 50, "", "Input files:"]
+        lines += [f" - {label}: {value}" for label, value in self.inputs]
+        return "\n".join(lines) + "\n\n"
+
+    def summary(self):
+        lines = ["Summary:"]
+        lines += [f" - {label}: {value}" for label, value in self.facts]
+        for source, label in self.sources.items():
+            n = self.error_counts[source]
+            if not n:
+                continue
+            rows = f" in {self.row_counts[source]} rows" if self.row_counts[source] else ""
+            lines.append(f" - {label} errors: {n}{rows}")
+            lines += [f"    {count:>7,} × {summary}" for count, summary, _ in self.rule_summary(source)]
+            boxes = self.box_summary(source)
+            if boxes and any(label != "unknown box" for _, label in boxes):
+                lines.append(f" - {label} errors per box:")
+                lines += [f"    {count:>7,} × {box}" for count, box in boxes]
+        if self.unlisted:
+            lines.append(f" - Listed in detail: first {self.listed} of {self.total_errors()} errors")
+        if len(self.pages) > 1:
+            lines.append(f" - Detail pages: {', '.join(os.path.basename(page) for page in self.pages)}")
+        return "\n".join(lines) + "\n\n"
+
+    def section_start(self, title):
+        return f"{title}\n"
+
+    def section_end(self):
+        return "\n"
+
+    def error_item(self, error, heading):
+        if heading is None:
+            return f" - {error}\n"
+        if heading:
+            return f"\nRow {error.row}:\n  - {error.message}\n"
+        return f"  - {error.message}\n"
+
+    def message_item(self, message):
+        return f" - {message}\n"
+
+    def none_item(self):
+        return " - None\n"
+
+    def unlisted_note(self, n):
+        return f" ... {n} more errors not listed (see the summary)\n"
+
+    def metrics_part(self, metrics):
+        return "Performance:\n" + "".join(f"{line}\n" for line in report_lines(metrics)) + "\n"
+
+    def page_start(self, page):
+        return f"{self.title} - page {page}\n{'=' * 50}\n\n"
+
+
+class CsvReportWriter(ReportWriter):
+    """
+    CSV report: one line per summary entry, error and message; the kind column tells them apart.
+    """
+
+    COLUMNS = ("kind", "source", "row", "severity", "code", "field", "box", "count", "message")
+
+    def __init__(self, *args, **kwargs):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        super().__init__(*args, **kwargs)
+
+    def line(self, kind, source="", row="", severity="", code="", field="", box="", count="", message=""):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerow((kind, source, row, severity, code, field, box, count, message))
+        return self.buffer.getvalue()
+
+    def header(self):
+        parts = [self.line(*self.COLUMNS), self.line("title", message=self.title),
+                 self.line("date", message=self.created.isoformat(timespec="seconds"))]
+        parts += [self.line("input", field=label, message=value) for label, value in self.inputs]
+        return "".join(parts)
+
+    def summary(self):
+        parts = [self.line("fact", field=label, count=value) for label, value in self.facts]
+        for source in self.sources:
+            parts.append(self.line("total", source, count=self.error_counts[source],
+                                   message=f"{self.row_counts[source]} rows" if self.row_counts[source] else ""))
+            parts += [self.line("rule", source, code=code, count=count, message=summary)
+                      for count, summary, code in self.rule_summary(source)]
+            parts += [self.line("box", source, box=box, count=count) for count, box in self.box_summary(source)]
+        if self.unlisted:
+            parts.append(self.line("unlisted", count=self.unlisted))
+        parts += [self.line("page", count=i, message=os.path.basename(page)) for i, page in enumerate(self.pages, 1)]
+        return "".join(parts)
+
+    def error_item(self, error, heading):
+        return self.line("error", self.source, error.row, error.severity, error.code, error.field,
+                         box_label(error.box) if error.box else "", "", error.message)
+
+    def message_item(self, message):
+        return self.line("message", self.source, message=message)
+
+    def metrics_part(self, metrics):
+        return "".join(self.line("performance", message=line.strip(" -")) for line in report_lines(metrics))
+
+    def page_start(self, page):
+        return self.line(*self.COLUMNS)
+
+
+class JsonLinesReportWriter(ReportWriter):
+    """
+    JSON Lines report: one JSON object per line with a "type" key (report, summary, rule, box, pages,
+    error, message, metrics).
+    """
+
+    @staticmethod
+    def line(**values):
+        return json.dumps(values, ensure_ascii=False) + "\n"
+
+    def header(self):
+        return self.line(type="report", title=self.title, created=self.created.isoformat(timespec="seconds"),
+                         inputs=dict(self.inputs), facts=dict(self.facts))
+
+    def summary(self):
+        parts = []
+        for source, label in self.sources.items():
+            parts.append(self.line(type="summary", source=source, label=label, errors=self.error_counts[source],
+                                   rows=self.row_counts[source]))
+            parts += [self.line(type="rule", source=source, code=code, count=count, summary=summary)
+                      for count, summary, code in self.rule_summary(source)]
+            parts += [self.line(type="box", source=source, box=box, count=count)
+                      for count, box in self.box_summary(source)]
+        parts.append(self.line(type="pages", listed=self.listed, unlisted=self.unlisted,
+                               files=[os.path.basename(page) for page in self.pages]))
+        return "".join(parts)
+
+    def error_item(self, error, heading):
+        return self.line(type="error", source=self.source, row=error.row, severity=error.severity, code=error.code,
+                         field=error.field, box=list(error.box) if error.box else None, message=error.message)
+
+    def message_item(self, message):
+        return self.line(type="message", source=self.source, message=message)
+
+    def metrics_part(self, metrics):
+        return self.line(type="metrics", **metrics)
+
+
+class HtmlReportWriter(ReportWriter):
+    """
+    Self-contained HTML report (inline style, no scripts); further pages are linked from the summary.
+    """
+
+    STYLE = (
+        "body{font-family:sans-serif;margin:2em;color:#222}"
+        "table{border-collapse:collapse;margin-bottom:1.5em}"
+        "th,td{border:1px solid #ccc;padding:2px 8px;text-align:left;vertical-align:top}"
+        "th{background:#eee}td.n{text-align:right}.error{color:#a00}.warning{color:#a60}"
+    )
+
+    def document_start(self, title):
+        return (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>'
+                f"<style>{self.STYLE}</style></head><body>\n<h1>{html.escape(title)}</h1>\n")
+
+    def header(self):
+        items = "".join(f"<li>{html.escape(label)}: {html.escape(str(value))}</li>" for label, value in self.inputs)
+        return (self.document_start(self.title)
+                + f"<p>Date: {self.created.strftime('%Y-%m-%d %H:%M')}</p>\n<h2>Input files</h2><ul>{items}</ul>\n")
+
+    @staticmethod
+    def count_table(heading, column, rows):
+        body = "".join(f'<tr><td class="n">{count:,}</td><td>{html.escape(text)}</td></tr>' for count, text in rows)
+        return f"<h3>{html.escape(heading)}</h3><table><tr><th>Errors</th><th>{column}</th></tr>{body}</table>\n"
+
+    def summary(self):
+        parts = ["<h2>Summary</h2><ul>"]
+        parts += [f"<li>{html.escape(label)}: {html.escape(str(value))}</li>" for label, value in self.facts]
+        for source, label in self.sources.items():
+            rows = f" in {self.row_counts[source]} rows" if self.row_counts[source] else ""
+            parts.append(f"<li>{html.escape(label)} errors: {self.error_counts[source]}{rows}</li>")
+        if self.unlisted:
+            parts.append(f"<li>Listed in detail: first {self.listed} of {self.total_errors()} errors</li>")
+        parts.append("</ul>\n")
+        for source, label in self.sources.items():
+            if self.error_counts[source]:
+                parts.append(self.count_table(f"{label} errors per rule", "Rule",
+                                              [(count, summary) for count, summary, _ in self.rule_summary(source)]))
+                parts.append(self.count_table(f"{label} errors per box", "Box", self.box_summary(source)))
+        if len(self.pages) > 1:
+            links = " ".join(f'<a href="{html.escape(os.path.basename(page))}">{i}</a>'
+                             for i, page in enumerate(self.pages, 1))
+            parts.append(f"<p>Detail pages: {links}</p>\n")
+        return "".join(parts)
+
+    def section_start(self, title):
+        return (f"<h2>{html.escape(title)}</h2>\n<table><tr><th>Row</th><th>Severity</th><th>Rule</th>"
+                "<th>Field</th><th>Message</th></tr>\n")
+
+    def section_end(self):
+        return "</table>\n"
+
+    def error_item(self, error, heading):
+        return (f'<tr class="{error.severity}"><td>{error.row}</td><td>{error.severity}</td><td>{error.code}</td>'
+                f"<td>{html.escape(error.field)}</td><td>{html.escape(error.message)}</td></tr>\n")
+
+    def message_item(self, message):
+        return f'<tr><td colspan="5">{html.escape(message)}</td></tr>\n'
+
+    def none_item(self):
+        return '<tr><td colspan="5">None</td></tr>\n'
+
+    def unlisted_note(self, n):
+        return f'<tr><td colspan="5">... {n} more errors not listed (see the summary)</td></tr>\n'
+
+    def metrics_part(self, metrics):
+        items = "".join(f"<li>{html.escape(line.strip(' -'))}</li>" for line in report_lines(metrics))
+        return f"<h2>Performance</h2><ul>{items}</ul>\n"
+
+    def footer(self):
+        return "</body></html>\n"
+
+    def page_start(self, page):
+        return self.document_start(f"{self.title} - page {page}") + \
+            f'<p><a href="{html.escape(os.path.basename(self.path))}">Summary</a></p>\n'
+
+    def page_end(self):
+        return self.footer()
+
+
+WRITERS = {
+    "text": TextReportWriter,
+    "csv": CsvReportWriter,
+    "jsonl": JsonLinesReportWriter,
+    "html": HtmlReportWriter,
+}
+
+
+def open_report(path, fmt=None, **options):
+    """
+    Core function. Opens a streaming report writer.
+
+    Args:
+        path (str): Report file
+        fmt (str, optional): One of FORMATS; by default chosen by the file extension (.csv, .jsonl,
+            .html, otherwise text)
+        **options: ReportWriter options (inputs, title, max_details, page_size, summary_limit)
+
+    Returns:
+        ReportWriter: Writer of the format; use as context manager or call close()
+    """
+    fmt = fmt or format_from_path(path)
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown report format '{fmt}' (use one of {', '.join(FORMATS)})")
+    return WRITERS[fmt](path, **options)
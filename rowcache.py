@@ -0,0 +1,201 @@
+"""
+On-disk cache of the row-level validation results.
+
+When an import file fails, the operator fixes a few rows and validates everything again. The row rules
+(rules.validate_row_compiled) only look at the stripped REQUIRED_FIELDS of one row, so their result is
+a function of that content: the RowCache keys it by a hash of the normalized values and reuses the
+errors of every unchanged row. Only new or changed rows are checked with the rules again. Cached
+errors are stored without their row number and get the number of the row they are reused for.
+
+The dataset-level checks (instance keys, positions, study / lab IDs) are not cached. They depend on
+all rows of the file and on the current reference, and they are set lookups on the keys that the
+normalization extracts anyway, so they always run on the current data.
+
+The cache file belongs to one rule set: it stores a fingerprint of the rules of config.py (fields,
+events, instruments, STORAGE_RULES, valid racks, boxes and positions, the study ID pattern) and of the
+rule code (rules.py). If either changes, the cached results are dropped. The number of cached rows is
+limited; the rows that were not seen for the most runs are evicted first.
+
+    with RowCache("bioval_rows.cache") as cache:
+        rows, errors = validate_import_file(path, "Import file", reference, cache=cache)
+"""
+import hashlib
+import inspect
+import os
+import pickle
+import re
+
+import config
+import rules
+from rules import validate_row_compiled
+from records import TubeRecord
+from error_records import ErrorRecord
+from diagnostics import get_logger
+import instrumentation
+
+log = get_logger("rowcache")
+
+CACHE_VERSION = 1
+MAX_ROWS = 1000000  # cached rows, about 100 bytes each
+
+# config.py settings the row rules depend on
+RULE_SETTINGS = (
+    "REQUIRED_FIELDS", "BIOFLUIDS", "DNA", "PAXGENE", "CELLS", "STORAGE_RULES", "FREEZER_ORDER",
+    "VALID_POS_PAXGENE", "VALID_POS_FLUIDS", "VALID_POS_DNA_CELLS_PBMC", "VALID_RACK", "VALID_BOX",
+    "REDCAP_EVENT_NAME", "REDCAP_REPEAT_INSTRUMENTS", "VALID_TUBE_STATUS", "STUDY_ID_PATTERN",
+)
+
+_record_values = rules._record_values
+
+
+def canonical(value):
+    """
+    Helper function. Converts a setting into a representation that does not depend on the set order of
+    the process (string hashes are randomized per run).
+    """
+    if isinstance(value, dict):
+        return sorted((repr(key), canonical(item)) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, re.Pattern):
+        return value.pattern
+    return repr(value)
+
+
+def rules_fingerprint():
+    """
+    Core function. Fingerprint of the current rule set: the RULE_SETTINGS of config.py and the code
+    of rules.py (not available in a frozen build, there the settings decide alone).
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(canonical([getattr(config, name, None) for name in RULE_SETTINGS])).encode("utf-8"))
+    try:
+        digest.update(inspect.getsource(rules).encode("utf-8"))
+    except (OSError, TypeError):
+        pass
+    return digest.hexdigest()
+
+
+def row_key(row):
+    """
+    Helper function. Hash of the normalized REQUIRED_FIELDS of a row.
+
+    Args:
+        row (Dict | TubeRecord): A row or its normalized record
+
+    Returns:
+        bytes: 16 byte digest
+    """
+    if type(row) is TubeRecord:
+        values = _record_values(row)
+    else:
+        values = tuple(str(row.get(field, "")).strip() for field in config.REQUIRED_FIELDS)
+    return hashlib.blake2b("\x1f".join(values).encode("utf-8"), digest_size=16).digest()
+
+
+class RowCache:
+    """
+    Row-level validation results of earlier runs, loaded from and saved to one file.
+
+    Attributes:
+        path (str): Path of the cache file
+        max_rows (int): Maximal number of cached rows
+        fingerprint (str): Rule set the results belong to
+        entries (Dict[bytes, Tuple[int, Tuple]]): row key -> (run of the last use, error keys without row)
+        run (int): Number of the current run
+        hits, misses (int): Reused and newly validated rows of this run
+    """
+
+    def __init__(self, path, max_rows=MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        self.fingerprint = rules_fingerprint()
+        self.entries = {}
+        self.run = 1
+        self.hits = self.misses = 0
+        self.load()
+
+    def load(self):
+        """
+        Helper function. Reads the cache file; a missing, unreadable or outdated file gives an empty cache.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.warning("Row cache %s is unreadable, starting empty: %s", self.path, e)
+            return
+        if data.get("version") != CACHE_VERSION or data.get("fingerprint") != self.fingerprint:
+            log.info("Validation rules changed, row cache %s cleared", self.path)
+            return
+        self.entries = data["entries"]
+        self.run = data["run"] + 1
+
+    def validate(self, row, index):
+        """
+        Core function. Drop-in for rules.validate_row_compiled: the errors of an unchanged row are
+        taken from the cache, other rows are validated and added.
+
+        Args:
+            row (Dict | TubeRecord): A row from the CSV as a dictionary or a normalized record
+            index (int): The row number (for error reporting)
+
+        Returns:
+            errors List[ErrorRecord]: Validation errors of this row
+        """
+        key = row_key(row)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries[key] = (self.run, entry[1])
+            return [ErrorRecord(index, *error) for error in entry[1]]
+        self.misses += 1
+        errors = validate_row_compiled(row, index)
+        self.entries[key] = (self.run, tuple(error.key()[1:] for error in errors))
+        return errors
+
+    def evict(self):
+        """
+        Helper function. Keeps the max_rows most recently used rows.
+
+        Returns:
+            int: Number of evicted rows
+        """
+        excess = len(self.entries) - self.max_rows
+        if excess <= 0:
+            return 0
+        entries = self.entries
+        for key in sorted(entries, key=lambda key: entries[key][0])[:excess]:
+            del entries[key]
+        return excess
+
+    def save(self):
+        """
+        Core function. Evicts the least recently used rows above max_rows and writes the cache file.
+        """
+        evicted = self.evict()
+        data = {"version": CACHE_VERSION, "fingerprint": self.fingerprint, "run": self.run, "entries": self.entries}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)  # never leave a half written cache behind
+        instrumentation.count("rowcache.hits", self.hits)
+        instrumentation.count("rowcache.misses", self.misses)
+        log.info(
+            "Row cache: %d rows reused, %d validated, %d evicted (%d cached)",
+            self.hits, self.misses, evicted, len(self.entries),
+        )
+        self.hits = self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
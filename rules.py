@@ -0,0 +1,228 @@
+"""
+Precompiled row validation rules.
+
+validation.validate_row strips every field several times per row and checks membership in long lists
+(e.g. the 1000 racks of VALID_RACK). Here the rules are compiled once at import time from config.py and
+STORAGE_RULES into one set-based validator per material. A row is stripped once and dispatched to the
+validator of its biomaterial with a single dictionary lookup. validate_row_compiled returns exactly the
+same errors (rule codes, messages and order) as validation.validate_row, as error_records.ErrorRecord.
+"""
+from config import (
+    REQUIRED_FIELDS, BIOFLUIDS, DNA, PAXGENE, CELLS, STORAGE_RULES, FREEZER_ORDER,
+    VALID_POS_DNA_CELLS_PBMC, VALID_RACK, VALID_BOX, REDCAP_EVENT_NAME, REDCAP_REPEAT_INSTRUMENTS,
+    VALID_TUBE_STATUS, STUDY_ID_PATTERN,
+)
+from operator import attrgetter
+
+from error_records import ErrorRecord, set_box
+from records import TubeRecord
+
+# Kinds of material checks
+ALLOWED = "allowed"      # value must be in the allowed set
+FILLED = "filled"        # value must not be empty
+EMPTY = "empty"          # value must be empty
+
+# Field positions in the stripped value tuple of a row
+FIELD_INDEX = {field: i for i, field in enumerate(REQUIRED_FIELDS)}
+
+
+def storage_positions(material_key):
+    """
+    Helper function. Valid tube positions (e.g. A1) of a material according to STORAGE_RULES.
+    """
+    rules = STORAGE_RULES[material_key]
+    return [f"{row}{col}" for row in rules["rows"] for col in rules["cols"]]
+
+
+def storage_freezer_codes(material_key):
+    """
+    Helper function. REDCap freezer codes of a material according to STORAGE_RULES, e.g. 4deg -> "4".
+    """
+    return [str(FREEZER_ORDER[freezer]) for freezer in STORAGE_RULES[material_key]["freezers"]]
+
+
+# Material-specific storage rules: (material names, [(field, kind, allowed values, rule code)]).
+# The codes are keys of error_records.MESSAGES, formatted with the field value and the biomaterial.
+MATERIAL_RULES = {
+    "BIOFLUID": (BIOFLUIDS, [
+        ("tube_pos", ALLOWED, storage_positions("BIOFLUID"), "biofluid.tube_pos"),
+        ("freezer", ALLOWED, storage_freezer_codes("BIOFLUID"), "biofluid.freezer"),
+        ("rack", ALLOWED, VALID_RACK, "biofluid.rack"),
+        ("box", ALLOWED, VALID_BOX, "biofluid.box"),
+        ("box_id", FILLED, None, "biofluid.box_id"),
+    ]),
+    "PAXGENE": (PAXGENE, [
+        ("tube_pos", ALLOWED, storage_positions("PAXGENE"), "paxgene.tube_pos"),
+        ("freezer", ALLOWED, storage_freezer_codes("PAXGENE"), "paxgene.freezer"),
+        # validate_row compares the box string with range(1, 501), kept identical here
+        ("box", ALLOWED, range(1, 501), "paxgene.box"),
+        ("rack", EMPTY, None, "paxgene.rack"),
+        ("box_id", EMPTY, None, "paxgene.box_id"),
+    ]),
+    "DNA": (DNA, [
+        ("tube_pos", ALLOWED, storage_positions("DNA"), "dna.tube_pos"),
+        ("freezer", ALLOWED, storage_freezer_codes("DNA"), "dna.freezer"),
+        ("rack", EMPTY, None, "dna.rack"),
+        ("box_id", EMPTY, None, "dna.box_id"),
+    ]),
+    # CELLS have no STORAGE_RULES entry yet
+    "CELLS": (CELLS, [
+        ("tube_pos", ALLOWED, VALID_POS_DNA_CELLS_PBMC, "cells.tube_pos"),
+        ("freezer", ALLOWED, [str(FREEZER_ORDER["nitrogen"])], "cells.freezer"),
+        ("box_id", EMPTY, None, "cells.box_id"),
+        # validate_row compares the rack string with range(1, 101), kept identical here
+        ("rack", ALLOWED, range(1, 101), "cells.rack"),
+    ]),
+}
+
+# Materials are matched in this order, the first match wins (as the if/elif chain of validate_row)
+MATERIAL_PRECEDENCE = ["BIOFLUID", "PAXGENE", "DNA", "CELLS"]
+
+
+def compile_material_validator(checks):
+    """
+    Helper function. Compiles the checks of one material into a validator function.
+
+    Args:
+        checks (List[Tuple]): (field, kind, allowed values, rule code) of the material
+
+    Returns:
+        function: validator(values, biomaterial, index, errors) appending ErrorRecords to errors
+    """
+    compiled = tuple(
+        (FIELD_INDEX[field], kind, frozenset(allowed) if allowed is not None else None, field, code)
+        for field, kind, allowed, code in checks
+    )
+
+    def validator(values, biomaterial, index, errors):
+        for i, kind, allowed, field, code in compiled:
+            value = values[i]
+            if kind is ALLOWED:
+                failed = value not in allowed
+            elif kind is FILLED:
+                failed = not value
+            else:
+                failed = bool(value)
+            if failed:
+                errors.append(ErrorRecord(index, code, field, (value, biomaterial)))
+
+    return validator
+
+
+def material_lookup():
+    """
+    Helper function. Maps every biomaterial name or REDCap code of MATERIAL_RULES to its material key.
+
+    Returns:
+        Dict[str, str]: Mapping from biomaterial -> material key (e.g. "serum" -> "BIOFLUID")
+    """
+    lookup = {}
+    # reverse order so that materials with higher precedence overwrite shared names
+    for material in reversed(MATERIAL_PRECEDENCE):
+        names, _ = MATERIAL_RULES[material]
+        for name in names:
+            lookup[name] = material
+    return lookup
+
+
+def compile_rules():
+    """
+    Core function. Compiles MATERIAL_RULES into one validator per material and a dispatch table from
+    every (lower-cased) biomaterial name or REDCap code to its validator.
+
+    Returns:
+        dispatch Dict[str, function]: Mapping from biomaterial -> material validator
+    """
+    validators = {
+        material: compile_material_validator(checks)
+        for material, (_, checks) in MATERIAL_RULES.items()
+    }
+    return {name: validators[material] for name, material in material_lookup().items()}
+
+
+MATERIAL_OF = material_lookup()
+MATERIAL_VALIDATORS = compile_rules()
+VALID_EVENTS = frozenset(REDCAP_EVENT_NAME)
+VALID_INSTRUMENTS = frozenset(REDCAP_REPEAT_INSTRUMENTS)
+VALID_STATUS = frozenset(VALID_TUBE_STATUS)
+
+_BIOMATERIAL = FIELD_INDEX["biomaterial"]
+_TUBE_POS = FIELD_INDEX["tube_pos"]
+_EVENT = FIELD_INDEX["redcap_event_name"]
+_INSTRUMENT = FIELD_INDEX["redcap_repeat_instrument"]
+_INSTANCE = FIELD_INDEX["redcap_repeat_instance"]
+_TUBE_STATUS = FIELD_INDEX["tube_status"]
+_STUDY_ID = FIELD_INDEX["study_id"]
+_FREEZER = FIELD_INDEX["freezer"]
+_RACK = FIELD_INDEX["rack"]
+_BOX = FIELD_INDEX["box"]
+
+# Values of a TubeRecord in REQUIRED_FIELDS order
+_record_values = attrgetter(*REQUIRED_FIELDS)
+
+
+def validate_row_compiled(row, index):
+    """
+    Validation function. Validates a single row with the precompiled rules. Returns the same errors
+    as validation.validate_row, but strips every field only once and dispatches the material
+    specific checks with one lookup.
+
+    Args:
+        row (Dict | TubeRecord): A row from the CSV as a dictionary or a normalized record
+        index (int): The row number (for error reporting)
+
+    Returns:
+        errors List[ErrorRecord]: Validation errors of this row
+    """
+    if type(row) is TubeRecord:
+        values = _record_values(row)  # already stripped
+    else:
+        values = tuple(row.get(field, "").strip() for field in REQUIRED_FIELDS)
+
+    biomaterial = values[_BIOMATERIAL].lower()
+    instrument = values[_INSTRUMENT]
+
+    # SKIP LOGIC: empty REDCap rows in the reference file are ignored
+    if not biomaterial and not instrument and not values[_TUBE_POS]:
+        return []
+
+    # (1) Required fields
+    errors = [
+        ErrorRecord(index, "missing_value", field)
+        for field, value in zip(REQUIRED_FIELDS, values) if value == ""
+    ]
+
+    if values[_EVENT] not in VALID_EVENTS:
+        errors.append(ErrorRecord(index, "invalid_event", "redcap_event_name", (values[_EVENT],)))
+
+    if instrument not in VALID_INSTRUMENTS:
+        errors.append(ErrorRecord(index, "invalid_instrument", "redcap_repeat_instrument", (instrument,)))
+
+    instance = values[_INSTANCE]
+    if instance:
+        if not instance.isdigit():
+            errors.append(ErrorRecord(index, "instance_not_integer", "redcap_repeat_instance", (instance,)))
+        elif int(instance) <= 0:
+            errors.append(ErrorRecord(index, "instance_not_positive", "redcap_repeat_instance", (instance,)))
+
+    # (2) Material-specific storage rules
+    validator = MATERIAL_VALIDATORS.get(biomaterial)
+    if validator is None:
+        errors.append(ErrorRecord(index, "unknown_material", "biomaterial", (biomaterial,)))
+    else:
+        validator(values, biomaterial, index, errors)
+
+    # General checks
+    tube_status = values[_TUBE_STATUS]
+    if tube_status not in VALID_STATUS:
+        errors.append(ErrorRecord(index, "invalid_tube_status", "tube_status", (tube_status, biomaterial)))
+
+    study_id = values[_STUDY_ID]
+    if not study_id:
+        errors.append(ErrorRecord(index, "missing_study_id", "study_id"))
+    elif not STUDY_ID_PATTERN.fullmatch(study_id):
+        errors.append(ErrorRecord(index, "invalid_study_id", "study_id", (study_id,)))
+
+    if errors:
+        set_box(errors, (values[_FREEZER], values[_RACK], values[_BOX]))
+    return errors
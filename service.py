@@ -0,0 +1,442 @@
+"""
+Local validation service: one parsed reference kept in memory for several workstations.
+
+Instead of every BioVal run downloading and parsing the whole registry, the service loads the
+reference once (file or REDCap download, same options as cli.py), keeps its ReferenceIndex and one
+occupancy index per biomaterial in memory and refreshes them in the background (watcher.WarmReference).
+Requests are answered in threads; they only read the shared indexes (assignments go to overlays, the
+reservations to the allocator database), so concurrent requests never redo the per-run work.
+
+    python service.py -r data/Ref_file.csv --port 8766
+    python cli.py --service http://127.0.0.1:8766/ import_1.csv
+    (GUI: SERVICE_URL in config.py)
+
+Endpoints (JSON answers, errors as {"error": message}):
+
+    GET  /status                    reference label, rows, load time
+    GET  /reference-errors          validation errors of the reference rows
+    GET  /positions?material=M      selected available positions of a STORAGE_RULES material
+                                    (&policy=best-fit, &all=1 for all free positions)
+    POST /validate-import?name=F    body: import CSV; errors, assignments and rows with lab IDs / instances
+    POST /assign                    body: import CSV; only the lab ID / instance assignment
+    POST /refresh                   reload the reference now (in the background)
+
+The service binds to 127.0.0.1 by default; use --host 0.0.0.0 to serve other workstations (there is no
+authentication, keep it inside the institute network).
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from config import STORAGE_RULES, ALLOCATOR_DB
+import utils as u
+import positions as p
+from occupancy import OccupancyIndex
+from pipeline import check_import
+from error_records import ErrorRecord
+from diagnostics import get_logger, report_suppressed
+
+log = get_logger("service")
+
+DEFAULT_PORT = 8766
+REFRESH_CHECK_SECONDS = 10
+
+
+@contextmanager
+def uploaded_csv(body):
+    """
+    Helper function. Saves an uploaded CSV to a temporary file, so it is read exactly like a local
+    import file (utils.read_csv); the file is removed afterwards.
+    """
+    handle, path = tempfile.mkstemp(suffix=".csv", prefix="bioval_upload_")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(body)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def row_dicts(rows):
+    """
+    Helper function. The rows as JSON-compatible dictionaries (TubeRecords as their source rows).
+    """
+    return [row.to_dict() if hasattr(row, "to_dict") else row for row in rows]
+
+
+class BioValService:
+    """
+    The requests of the validation service, answered from a warm reference.
+
+    Attributes:
+        warm (WarmReference): Reference index kept in memory and refreshed in the background
+        allocator (IdAllocator | None): Allocator of the new lab IDs and instances
+        workers (int): Number of processes for the row validation of one request
+        occupancy (Dict[str, Tuple[ReferenceIndex, OccupancyIndex]]): Occupancy index per material and
+            the reference it is synced with
+    """
+
+    def __init__(self, warm, allocator=None, workers=1):
+        self.warm = warm
+        self.allocator = allocator
+        self.workers = workers
+        self.occupancy = {}
+        self.occupancy_lock = threading.Lock()
+        self.server = None
+        self.stopped = threading.Event()
+
+    def reference_label(self):
+        """
+        Helper function. Reference file, or the API URL for downloaded data.
+        """
+        args = self.warm.args
+        return args.api_url if args.download else args.reference
+
+    def occupancy_index(self, material, reference):
+        """
+        Helper function. Occupancy index of a material, built once and synced with a refreshed
+        reference (only the changed boxes are updated). The caller holds occupancy_lock.
+        """
+        synced_with, index = self.occupancy.get(material, (None, None))
+        if index is None:
+            index = OccupancyIndex.from_positions(material, reference.occupied_positions)
+        elif synced_with is not reference:
+            index.sync(reference.occupied_positions)
+        self.occupancy[material] = (reference, index)
+        return index
+
+    def status(self):
+        """
+        Returns:
+            Dict: Reference label, number of reference rows and errors, load time and materials
+        """
+        reference, reference_errors = self.warm.current()
+        return {
+            "reference": self.reference_label(),
+            "rows": reference.row_count,
+            "reference_errors": len(reference_errors),
+            "loaded_at": datetime.fromtimestamp(self.warm.loaded_at).isoformat(timespec="seconds"),
+            "materials": sorted(STORAGE_RULES),
+        }
+
+    def reference_errors(self):
+        """
+        Returns:
+            List[List[Dict]]: Validation errors of the failing reference rows (ErrorRecord.as_dict)
+        """
+        _, reference_errors = self.warm.current()
+        return [[error.as_dict() for error in row_errors] for row_errors in reference_errors]
+
+    def available_positions(self, material, box_policy="first-fit", all_free=False):
+        """
+        Core function. Available positions of a material, like positions.select_free_positions.
+
+        Raises:
+            ValueError: If the material has no storage rule or the policy is unknown
+        """
+        material = material.strip().upper()
+        if material not in STORAGE_RULES:
+            raise ValueError(f"Material '{material}' has no defined STORAGE_RULE.")
+        reference, _ = self.warm.current()
+        with self.occupancy_lock:  # the selection reads the index while a refresh could sync it
+            index = self.occupancy_index(material, reference)
+            if all_free:
+                selected = index.available_positions()
+            else:
+                selected = p.select_free_positions(material, index=index, box_policy=box_policy)
+        return [list(position) for position in selected]
+
+    def validate_import(self, body, name="Import file"):
+        """
+        Core function. Validates an uploaded import CSV (pipeline.check_import without write back).
+
+        Returns:
+            Dict: rows, errors, labid_messages, instance_messages, duplicate_positions
+        """
+        reference, _ = self.warm.current()
+        try:
+            with uploaded_csv(body) as path:
+                import_rows, import_errors, labid_messages, instance_messages, duplicate_count = check_import(
+                    path, reference, label=name, workers=self.workers, write_back=False, allocator=self.allocator
+                )
+        finally:
+            report_suppressed(log)
+        return {
+            "rows": row_dicts(import_rows),
+            "errors": [error.as_dict() for error in import_errors],
+            "labid_messages": labid_messages,
+            "instance_messages": instance_messages,
+            "duplicate_positions": duplicate_count,
+        }
+
+    def assign(self, body):
+        """
+        Core function. Assigns lab IDs and instances to the rows of an uploaded import CSV.
+
+        Returns:
+            Dict: rows, labid_messages, instance_messages
+        """
+        reference, _ = self.warm.current()
+        with uploaded_csv(body) as path:
+            _, rows = u.read_csv(path)
+        rows, labid_messages = u.assign_lab_patient_ids(rows, reference, allocator=self.allocator)
+        rows, instance_messages = u.assign_instances(rows, reference, allocator=self.allocator)
+        return {"rows": rows, "labid_messages": labid_messages, "instance_messages": instance_messages}
+
+    def handle(self, method, path, query, body):
+        """
+        Helper function. Answers one request.
+
+        Returns:
+            Tuple[int, object]: HTTP status and JSON body
+        """
+        route = (method, path.rstrip("/") or "/")
+
+        def option(key, default=""):
+            return query.get(key, [default])[-1]
+
+        try:
+            if route in (("GET", "/"), ("GET", "/status")):
+                return 200, self.status()
+            if route == ("GET", "/reference-errors"):
+                return 200, self.reference_errors()
+            if route == ("GET", "/positions"):
+                if not option("material"):
+                    return 400, {"error": "Missing parameter material"}
+                return 200, self.available_positions(
+                    option("material"), option("policy", "first-fit"), option("all") in ("1", "true")
+                )
+            if route == ("POST", "/validate-import"):
+                return 200, self.validate_import(body, option("name", "Import file"))
+            if route == ("POST", "/assign"):
+                return 200, self.assign(body)
+            if route == ("POST", "/refresh"):
+                self.warm.refresh_in_background(force=True)
+                return 202, {"refreshing": True}
+        except Exception as e:  # hard errors of the request (missing columns, unknown material, ...)
+            log.error("%s %s: %s", method, path, e)
+            return 422, {"error": str(e)}
+        return 404, {"error": f"Unknown endpoint {method} {path}"}
+
+    def keep_fresh(self):
+        while not self.stopped.wait(REFRESH_CHECK_SECONDS):
+            self.warm.refresh_in_background()
+
+    def start(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """
+        Starts the server and the reference refresh in background threads.
+
+        Returns:
+            str: URL of the service
+        """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def answer(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                status, answer = service.handle(method, url.path, parse_qs(url.query), body)
+                payload = json.dumps(answer, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    payload = gzip.compress(payload)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.answer("GET")
+
+            def do_POST(self):
+                self.answer("POST")
+
+            def log_message(self, format, *args):
+                log.debug("%s %s", self.address_string(), format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.stopped.clear()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.keep_fresh, name="reference-refresh-check", daemon=True).start()
+        return f"http://{host}:{self.server.server_port}/"
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class ServiceClient:
+    """
+    Client of the validation service for the CLI and the GUI; returns the same values as the local
+    functions (pipeline.check_import, positions.select_free_positions).
+
+    Attributes:
+        url (str): Base URL of the service, e.g. http://127.0.0.1:8766/
+        timeout (float): Seconds to wait for an answer
+    """
+
+    def __init__(self, url, timeout=600.0):
+        self.url = url.rstrip("/") + "/"
+        self.timeout = timeout
+
+    def request(self, method, endpoint, query=None, body=None):
+        """
+        Helper function. Sends one request and returns the decoded JSON answer.
+
+        Raises:
+            Exception: If the service is not reachable or answers with an error
+        """
+        url = self.url + endpoint + (f"?{urlencode(query)}" if query else "")
+        headers = {"Accept-Encoding": "gzip"}
+        if body is not None:
+            headers["Content-Type"] = "text/csv"
+        request = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                payload = response.read()
+                if response.headers.get("Content-Encoding") == "gzip":
+                    payload = gzip.decompress(payload)
+        except urllib.error.HTTPError as e:
+            payload = e.read()
+            if e.headers.get("Content-Encoding") == "gzip":
+                payload = gzip.decompress(payload)
+            try:
+                message = json.loads(payload)["error"]
+            except (ValueError, KeyError, TypeError):
+                message = f"HTTP {e.code}"
+            raise Exception(f"Validation service: {message}") from None
+        except urllib.error.URLError as e:
+            raise Exception(f"Validation service {self.url} not reachable: {e.reason}") from None
+        return json.loads(payload)
+
+    def status(self):
+        return self.request("GET", "status")
+
+    def reference_errors(self):
+        """
+        Returns:
+            List[List[ErrorRecord]]: Validation errors of the failing reference rows
+        """
+        return [
+            [ErrorRecord.from_dict(error) for error in row_errors]
+            for row_errors in self.request("GET", "reference-errors")
+        ]
+
+    def available_positions(self, material, box_policy="first-fit"):
+        """
+        Returns:
+            List[Tuple]: Selected (freezer, rack, box, pos), as positions.select_free_positions
+        """
+        answer = self.request("GET", "positions", {"material": material, "policy": box_policy})
+        return [tuple(position) for position in answer]
+
+    def check_import(self, import_path, write_back=True):
+        """
+        Core function. Validates an import file on the service, like pipeline.check_import.
+
+        Returns:
+            import_rows (List[Dict]): Import rows with the assignments
+            import_errors (List[ErrorRecord]): Validation errors of the import file
+            labid_messages (List[str]): Lab ID assignment messages
+            instance_messages (List[str]): Instance assignment messages
+            duplicate_positions_count (int): Number of invalid position duplicates
+        """
+        with open(import_path, "rb") as f:
+            body = f.read()
+        answer = self.request("POST", "validate-import", {"name": os.path.basename(import_path)}, body)
+        import_rows = answer["rows"]
+        if write_back and import_rows:
+            u.save_data_as_csv(import_rows, import_path)
+        return (
+            import_rows,
+            [ErrorRecord.from_dict(error) for error in answer["errors"]],
+            answer["labid_messages"],
+            answer["instance_messages"],
+            answer["duplicate_positions"],
+        )
+
+
+def build_parser():
+    """
+    Helper function. Builds the argument parser of the service.
+    """
+    # imported here: the client part of this module is used by cli.py itself
+    from cli import add_reference_arguments, add_log_arguments
+
+    parser = argparse.ArgumentParser(
+        prog="bioval-service",
+        description="Serve validations against one reference kept in memory to several workstations.",
+    )
+    add_reference_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind (default: 127.0.0.1, this computer only).")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port (default: {DEFAULT_PORT}).")
+    parser.add_argument(
+        "--refresh", type=float, default=15,
+        help="Reload the reference every N minutes (default: 15); a reference file also when it changes.",
+    )
+    parser.add_argument(
+        "--allocator-db", metavar="FILE", default=ALLOCATOR_DB or ".bioval_ids.sqlite",
+        help="SQLite file of the lab ID / instance reservations (default: ALLOCATOR_DB of config.py, "
+             "else .bioval_ids.sqlite).",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Processes for the row validation of a request.")
+    add_log_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the service; runs until interrupted (Ctrl+C).
+
+    Returns:
+        int: Exit code - 0 on a regular end, 2 if the reference could not be loaded
+    """
+    from cli import configure_logging
+    from watcher import WarmReference
+    from allocator import IdAllocator
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.refresh <= 0 or args.workers < 1:
+        parser.error("--refresh must be positive, --workers at least 1")
+    configure_logging(parser, args)
+
+    allocator = IdAllocator(args.allocator_db)
+    try:
+        warm = WarmReference(args, args.refresh * 60, allocator)
+    except Exception as e:
+        log.error("Could not load the reference data: %s", e)
+        return 2
+    service = BioValService(warm, allocator, args.workers)
+    url = service.start(args.host, args.port)
+    log.info("Serving %s at %s (Ctrl+C to stop)", service.reference_label(), url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        service.stop()
+        log.info("Stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
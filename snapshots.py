@@ -0,0 +1,167 @@
+"""
+Local REDCap reference snapshots.
+
+download_reference_from_redcap exports the whole biorepository form on every run. The SnapshotStore keeps
+the last export per project and form on disk. sync_reference then only asks REDCap for the records that
+were created or modified since the last sync (dateRangeBegin) and merges them into the snapshot.
+
+REDCap returns all rows of a modified record, so the rows of every returned record replace its old
+rows (deleted instances of a modified record disappear as well). Records that were deleted completely
+are not reported by a delta export; a full export (full=True, CLI --full-download) removes them.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from diagnostics import get_logger
+
+log = get_logger("snapshots")
+
+
+SNAPSHOT_VERSION = 1
+REDCAP_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# The delta export starts a bit before the last sync, so changes saved while the last export was
+# running (or a small clock offset to the REDCap server) are not missed. Merging is idempotent.
+SYNC_MARGIN = timedelta(minutes=5)
+
+
+def project_key(api_url, api_token):
+    """
+    Helper function. Identifies a REDCap project by its API URL and token (a token belongs to exactly
+    one project) without storing the token itself.
+    """
+    return hashlib.sha256(f"{api_url}\n{api_token}".encode("utf-8")).hexdigest()[:16]
+
+
+def merge_records(records, changed, id_field="study_id"):
+    """
+    Core function. Merges the rows of a delta export into the snapshot rows. All rows of a returned
+    record replace the old rows of that record at its old place; new records are appended.
+
+    Args:
+        records (List[Dict]): Rows of the snapshot
+        changed (List[Dict]): Rows of the delta export
+        id_field (str): Record ID field of the project
+
+    Returns:
+        List[Dict]: Merged rows
+    """
+    by_record = {}
+    for row in records:
+        by_record.setdefault(row.get(id_field, ""), []).append(row)
+
+    changed_by_record = {}
+    for row in changed:
+        changed_by_record.setdefault(row.get(id_field, ""), []).append(row)
+    by_record.update(changed_by_record)
+
+    return [row for rows in by_record.values() for row in rows]
+
+
+class SnapshotStore:
+    """
+    Directory with one JSON snapshot per (project, form).
+
+    Attributes:
+        directory (str): Directory of the snapshot files
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, project, form_name):
+        """
+        Returns the file path of the snapshot of a project and form.
+        """
+        return os.path.join(self.directory, f"reference_{project}_{form_name}.json")
+
+    def load(self, project, form_name):
+        """
+        Loads a snapshot.
+
+        Returns:
+            Dict | None: {"last_sync": str, "records": List[Dict]}, None if there is no usable snapshot
+        """
+        path = self.path(project, form_name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except ValueError:
+            log.warning("Ignoring unreadable snapshot %s", path)
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def save(self, project, form_name, records, last_sync):
+        """
+        Saves a snapshot; the file is replaced atomically.
+
+        Args:
+            project (str): Project key (project_key)
+            form_name (str): REDCap instrument
+            records (List[Dict]): Rows of the snapshot
+            last_sync (str): Time the export was requested ("YYYY-MM-DD HH:MM:SS")
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(project, form_name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": SNAPSHOT_VERSION, "form": form_name, "last_sync": last_sync, "records": records}, f
+            )
+        os.replace(tmp_path, path)
+
+
+def sync_reference(store, api_url, api_token, form_name="biorepository", full=False, download=None):
+    """
+    Core function. Returns the current reference records of a project, using the local snapshot and a
+    delta export where possible.
+
+    Args:
+        store (SnapshotStore): Local snapshot store
+        api_url (str): The REDCap API endpoint URL
+        api_token (str): REDCap API token
+        form_name (str): The name of the REDCap instrument to export
+        full (bool): Ignore the snapshot and export everything
+        download (Callable, optional): Export function with the signature of
+            redcap_api.download_reference_from_redcap (default)
+
+    Returns:
+        records (List[Dict]): All reference records
+        stats (Dict): mode ("full" or "delta"), the number of downloaded rows, last_sync of the new
+            snapshot and, for a delta, previous_sync of the snapshot it was merged into, the replaced rows
+            of the changed records and the changed rows (e.g. for occupancy.load_or_build)
+    """
+    if download is None:
+        from redcap_api import download_reference_from_redcap as download
+
+    project = project_key(api_url, api_token)
+    snapshot = None if full else store.load(project, form_name)
+
+    # taken before the request, so nothing changed during the export is skipped next time
+    sync_time = datetime.now()
+
+    if snapshot is None:
+        records = download(api_url, api_token, form_name=form_name)
+        stats = {"mode": "full", "downloaded": len(records), "previous_sync": None}
+    else:
+        since = datetime.strptime(snapshot["last_sync"], REDCAP_TIME_FORMAT) - SYNC_MARGIN
+        changed = download(
+            api_url, api_token, form_name=form_name, date_range_begin=since.strftime(REDCAP_TIME_FORMAT)
+        )
+        changed_ids = {row.get("study_id", "") for row in changed}
+        replaced = [row for row in snapshot["records"] if row.get("study_id", "") in changed_ids]
+        records = merge_records(snapshot["records"], changed)
+        stats = {
+            "mode": "delta", "downloaded": len(changed), "previous_sync": snapshot["last_sync"],
+            "replaced": replaced, "changed": changed,
+        }
+
+    stats["last_sync"] = sync_time.strftime(REDCAP_TIME_FORMAT)
+    store.save(project, form_name, records, stats["last_sync"])
+    return records, stats
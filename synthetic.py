@@ -0,0 +1,351 @@
+"""
+Synthetic biorepository data for benchmarks and load tests.
+
+Generates reference exports and import files that look like the RD registry data: one REDCap event row
+per patient followed by the biorepository rows of its tubes, with codes from config.py (REQUIRED_FIELDS,
+REDCAP_EVENT_NAME, material codes, VALID_TUBE_STATUS, STUDY_ID_PATTERN). The rows are generated lazily,
+so files from 1k up to 10M rows can be written without holding them in memory.
+
+Every material is stored in its STORAGE_RULES grid: stored tubes fill the grid up to the requested
+occupancy in random slots, all further tubes go to the racks behind the grid, so occupancy stays under
+control at every size. Clean BIOFLUID rows pass validation.validate_row; with error_rate > 0 that share of
+the rows gets one typical error (INJECTED_ERRORS).
+
+    python synthetic.py --rows 100000 --import-rows 1000 --occupancy 0.7 --error-rate 0.01 --out-dir /tmp/synthetic
+"""
+import argparse
+import csv
+import os
+import random
+from array import array
+from operator import itemgetter
+
+from config import REDCAP_EVENT_NAME, REDCAP_REPEAT_INSTRUMENTS, VALID_RACK, VALID_BOX, VALID_TUBE_STATUS
+from occupancy import grid_of, slot_sort_key
+
+
+# Column order of the REDCap export (data/Ref_file_test.csv)
+HEADERS = [
+    "study_id", "redcap_event_name", "redcap_repeat_instrument", "redcap_repeat_instance", "lab_id", "study",
+    "sampling_date", "biomaterial", "volume_cell_number", "tube_id", "box_id", "tube_pos", "box", "rack",
+    "freezer", "tube_status", "fibro_passage", "sent_date", "sent_project", "reserved_date", "reserved_for",
+    "comment", "biorepository_complete",
+]
+
+# Share of the tubes per material. validate_row rejects every DNA and PAXgene row (REQUIRED_FIELDS needs
+# rack and box_id, the material rules forbid them), so only BIOFLUID is generated by default.
+MATERIAL_MIX = {"BIOFLUID": 1.0, "DNA": 0.0, "PAXGENE": 0.0}
+MATERIAL_CODES = {"BIOFLUID": ["1", "2", "3", "7", "8"], "DNA": ["4"], "PAXGENE": ["5"]}
+STUDIES = ["POLR3A", "HSP", "ATAXIA", "LEUKO"]
+
+
+def corrupt_material(row):
+    row["biomaterial"] = "xyz"
+
+
+def corrupt_position(row):
+    row["tube_pos"] = "K13"
+
+
+def corrupt_study_id(row):
+    row["study_id"] = row["study_id"][1:]
+    row["lab_id"] = ""  # keeps the lab ID -> study ID mapping of the reference unique
+
+
+def corrupt_status(row):
+    row["tube_status"] = "9"
+
+
+def corrupt_missing(row):
+    row["sampling_date"] = ""
+
+
+def corrupt_freezer(row):
+    row["freezer"] = "nitrogen"
+
+
+# One of these is applied to an erroneous row; each one causes at least one validate_row error
+INJECTED_ERRORS = [
+    corrupt_material, corrupt_position, corrupt_study_id, corrupt_status, corrupt_missing, corrupt_freezer,
+]
+
+
+def study_id_of(patient):
+    """
+    Helper function. Study ID of the n-th synthetic patient in the XXX-XXX-XXX format.
+    """
+    return f"{patient // 1000000 % 1000:03d}-{patient // 1000 % 1000:03d}-{patient % 1000:03d}"
+
+
+class SyntheticStorage:
+    """
+    Position source of one material: random free slots of its STORAGE_RULES grid up to the target
+    occupancy, then the slots of the racks behind the grid in storage order.
+
+    Attributes:
+        grid (List[Tuple]): All (freezer, rack, box, pos) of the grid in random order
+        target (int): Number of grid slots the reference fills
+        used (int): Number of grid slots handed out
+        taken (Set[Tuple]): Grid slots taken by any material (the PAXGENE and BIOFLUID grids overlap)
+        overflow_used (int): Number of overflow slots handed out
+    """
+
+    def __init__(self, material, occupancy, rnd, taken, part=0, parts=1):
+        grid = grid_of(material)
+        self.freezers = grid["freezers"]
+        self.slots = sorted((row + col for row in grid["rows"] for col in grid["cols"]), key=slot_sort_key)
+        self.grid = [
+            (freezer, rack, str(box), pos)
+            for freezer in grid["freezers"]
+            for rack in grid["racks"]
+            for box in range(1, grid["boxes"] + 1)
+            for pos in self.slots
+        ]
+        rnd.shuffle(self.grid)
+        self.target = int(len(self.grid) * occupancy)
+        self.used = 0
+        self.next_slot = 0
+        self.taken = taken
+        # every material gets its own share of the racks behind the grids
+        last_rack = max(int(rack) for rack in grid["racks"])
+        self.overflow_racks = [rack for rack in VALID_RACK if int(rack) > last_rack][part::parts]
+        self.overflow_used = 0
+
+    def position(self, stored, fill_grid=False):
+        """
+        Returns the position of the next tube. Only stored tubes take grid slots: while the grid is
+        below the target occupancy, or as long as there are free slots if fill_grid.
+        """
+        if stored and (fill_grid or self.used < self.target):
+            while self.next_slot < len(self.grid):
+                position = self.grid[self.next_slot]
+                self.next_slot += 1
+                if position not in self.taken:
+                    self.taken.add(position)
+                    self.used += 1
+                    return position
+        n = self.overflow_used
+        self.overflow_used += 1
+        n, pos = divmod(n, len(self.slots))
+        n, box = divmod(n, len(VALID_BOX))
+        n, rack = divmod(n, len(self.overflow_racks))
+        return self.freezers[n % len(self.freezers)], self.overflow_racks[rack], VALID_BOX[box], self.slots[pos]
+
+
+class SyntheticBiorepository:
+    """
+    Deterministic generator of one synthetic registry: first the reference rows (reference_rows), then
+    import files with new tubes of known and new patients (import_rows) that fit the reference.
+
+    Attributes:
+        rows (int): Number of tube rows of the reference
+        tubes_per_patient (float): Mean number of tubes per patient (at least 1)
+        occupancy (float): Share of the STORAGE_RULES grid of each material filled by stored reference tubes
+        error_rate (float): Share of the rows with one injected error
+        inactive_ratio (float): Share of the tubes that are not stored (tube_status 2-5)
+        materials (Dict[str, float]): Share of the tubes per material, see MATERIAL_MIX
+        seed (int): Seed of the random generator
+    """
+
+    def __init__(self, rows, tubes_per_patient=8.0, occupancy=0.5, error_rate=0.0, inactive_ratio=0.1,
+                 materials=None, seed=0):
+        if not 0 <= occupancy <= 1 or not 0 <= error_rate <= 1 or not 0 <= inactive_ratio <= 1:
+            raise ValueError("occupancy, error_rate and inactive_ratio must be between 0 and 1.")
+        if tubes_per_patient < 1:
+            raise ValueError("tubes_per_patient must be at least 1.")
+        self.rows = rows
+        self.tubes_per_patient = tubes_per_patient
+        self.occupancy = occupancy
+        self.error_rate = error_rate
+        self.inactive_ratio = inactive_ratio
+        self.materials = dict(materials or MATERIAL_MIX)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        self.material_names = [name for name, share in self.materials.items() if share > 0]
+        self.material_weights = [self.materials[name] for name in self.material_names]
+        taken = set()
+        self.storage = {
+            name: SyntheticStorage(name, occupancy, self.random, taken, part, len(self.material_names))
+            for part, name in enumerate(self.material_names)
+        }
+        self.tube_counts = array("I")  # tubes per patient of the reference, index = patient
+        self.next_tube_id = 100000
+
+    def patient_tubes(self):
+        """
+        Helper function. Draws the number of tubes of a patient (uniform, mean tubes_per_patient).
+        """
+        return self.random.randint(1, max(1, round(2 * self.tubes_per_patient) - 1))
+
+    def tube_row(self, patient, instance, lab_id, fill_grid=False):
+        """
+        Helper function. One biorepository row of a tube.
+        """
+        rnd = self.random
+        material = rnd.choices(self.material_names, self.material_weights)[0]
+        stored = rnd.random() >= self.inactive_ratio
+        status = "1" if stored else rnd.choice(VALID_TUBE_STATUS[1:])
+        freezer, rack, box, pos = self.storage[material].position(stored, fill_grid)
+        self.next_tube_id += 1
+
+        row = dict.fromkeys(HEADERS, "")
+        row.update({
+            "study_id": study_id_of(patient),
+            "redcap_event_name": REDCAP_EVENT_NAME[0],
+            "redcap_repeat_instrument": REDCAP_REPEAT_INSTRUMENTS[0],
+            "redcap_repeat_instance": str(instance),
+            "lab_id": lab_id,
+            "study": STUDIES[patient % len(STUDIES)],
+            "sampling_date": f"2025-{patient % 12 + 1:02d}-{instance % 28 + 1:02d}",
+            "biomaterial": rnd.choice(MATERIAL_CODES[material]),
+            "tube_id": str(self.next_tube_id),
+            "box_id": f"{material[0]}{freezer}-{rack}-{box}",
+            "tube_pos": pos,
+            "box": box,
+            "rack": rack,
+            "freezer": freezer,
+            "tube_status": status,
+            "biorepository_complete": "2",
+        })
+        if self.error_rate and rnd.random() < self.error_rate:
+            rnd.choice(INJECTED_ERRORS)(row)
+        return row
+
+    def reference_rows(self, event_rows=True):
+        """
+        Core function. Generates the reference export: per patient the event row (if event_rows, like the
+        REDCap export) and its tube rows with instances 1..n.
+
+        Args:
+            event_rows (bool): Also yield the event row without repeat instrument of every patient
+
+        Yields:
+            Dict: Rows with the HEADERS columns
+        """
+        remaining = self.rows
+        patient = 0
+        while remaining > 0:
+            tubes = min(self.patient_tubes(), remaining)
+            self.tube_counts.append(tubes)
+            if event_rows:
+                row = dict.fromkeys(HEADERS, "")
+                row.update({"study_id": study_id_of(patient), "redcap_event_name": REDCAP_EVENT_NAME[0]})
+                yield row
+            lab_id = f"{patient + 1:05d}"
+            for instance in range(1, tubes + 1):
+                yield self.tube_row(patient, instance, lab_id)
+            remaining -= tubes
+            patient += 1
+
+    def import_rows(self, rows, new_patient_ratio=0.2):
+        """
+        Core function. Generates an import file with new tubes that fits the generated reference (call
+        after reference_rows was consumed): tubes of known patients continue their instances, new patients
+        get the next lab IDs. Stored tubes take free grid slots. Several import files can be
+        generated one after the other.
+
+        Args:
+            rows (int): Number of rows
+            new_patient_ratio (float): Share of the rows that belong to new patients
+
+        Yields:
+            Dict: Rows with the HEADERS columns
+        """
+        rnd = self.random
+        remaining = rows
+        while remaining > 0:
+            known = len(self.tube_counts)
+            if known and rnd.random() >= new_patient_ratio:
+                patient = rnd.randrange(known)
+            else:
+                patient = known
+                self.tube_counts.append(0)
+            tubes = min(self.patient_tubes(), remaining)
+            first = self.tube_counts[patient] + 1
+            self.tube_counts[patient] += tubes
+            lab_id = f"{patient + 1:05d}"
+            for instance in range(first, first + tubes):
+                yield self.tube_row(patient, instance, lab_id, fill_grid=True)
+            remaining -= tubes
+
+
+def write_rows(path, rows, headers=HEADERS):
+    """
+    Helper function. Writes generated rows to a CSV file while they are generated.
+
+    Returns:
+        int: Number of written rows
+    """
+    count = 0
+    values = itemgetter(*headers)  # faster than csv.DictWriter, the rows have all columns
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(values(row))
+            count += 1
+    return count
+
+
+def generate_files(out_dir, rows, import_rows=0, new_patient_ratio=0.2, event_rows=True, **options):
+    """
+    Core function. Writes a synthetic reference.csv (and import.csv) to a directory.
+
+    Args:
+        out_dir (str): Output directory (created if missing)
+        rows (int): Number of tube rows of the reference
+        import_rows (int): Number of rows of the import file, 0 = no import file
+        new_patient_ratio (float): Share of the import rows that belong to new patients
+        event_rows (bool): Write the event row of every patient into the reference
+        **options: Further SyntheticBiorepository options (occupancy, error_rate, ...)
+
+    Returns:
+        Dict[str, str]: Paths of the written files ("reference", "import")
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    registry = SyntheticBiorepository(rows, **options)
+    paths = {"reference": os.path.join(out_dir, "reference.csv")}
+    write_rows(paths["reference"], registry.reference_rows(event_rows))
+    if import_rows:
+        paths["import"] = os.path.join(out_dir, "import.csv")
+        write_rows(paths["import"], registry.import_rows(import_rows, new_patient_ratio))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic biorepository reference and import files.")
+    parser.add_argument("--rows", type=int, default=10000, help="Tube rows of the reference (default: 10000)")
+    parser.add_argument("--import-rows", type=int, default=0, help="Rows of the import file (default: none)")
+    parser.add_argument("--out-dir", default="synthetic", help="Output directory (default: synthetic)")
+    parser.add_argument("--tubes-per-patient", type=float, default=8.0, help="Mean tubes per patient (default: 8)")
+    parser.add_argument("--occupancy", type=float, default=0.5,
+                        help="Filled share of the BIOFLUID storage grid (default: 0.5)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of erroneous rows (default: 0)")
+    parser.add_argument("--inactive-ratio", type=float, default=0.1,
+                        help="Share of tubes that are not stored (default: 0.1)")
+    parser.add_argument("--new-patient-ratio", type=float, default=0.2,
+                        help="Share of import rows of new patients (default: 0.2)")
+    parser.add_argument("--materials", default="BIOFLUID=1",
+                        help="Share of the tubes per material, e.g. BIOFLUID=0.8,DNA=0.1,PAXGENE=0.1")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    try:
+        materials = {name.strip().upper(): float(share) for name, share in
+                     (item.split("=") for item in args.materials.split(","))}
+    except ValueError:
+        parser.error("--materials must look like BIOFLUID=0.8,DNA=0.2")
+    if not set(materials) <= set(MATERIAL_CODES) or not any(materials.values()):
+        parser.error(f"--materials needs a positive share of {', '.join(MATERIAL_CODES)}")
+
+    paths = generate_files(
+        args.out_dir, args.rows, args.import_rows, args.new_patient_ratio,
+        tubes_per_patient=args.tubes_per_patient, occupancy=args.occupancy, error_rate=args.error_rate,
+        inactive_ratio=args.inactive_ratio, materials=materials, seed=args.seed,
+    )
+    for name, path in paths.items():
+        print(f"Wrote {name} file {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+The BioVal modules are flat modules in the repository root (python cli.py ...), not an installed package.
+"""
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_redcap import FakeRedcap  # noqa: E402
+
+
+def tube(study_id, instance, tube_pos="A1"):
+    """
+    A stored BIOFLUID tube row of a REDCap export.
+    """
+    return {
+        "study_id": study_id, "redcap_event_name": "", "redcap_repeat_instrument": "biorepository",
+        "redcap_repeat_instance": str(instance), "biomaterial": "1", "tube_pos": tube_pos,
+        "freezer": "1", "rack": "1", "box": "1", "tube_status": "1",
+    }
+
+
+@pytest.fixture
+def tube_row():
+    return tube
+
+
+@pytest.fixture
+def fake_redcap():
+    """
+    Starts local REDCap stand-ins (fake_redcap.py): fake_redcap(records, modified_ago=None, **options)
+    returns a running FakeRedcap with its API URL in fake.url. With modified_ago (timedelta) all records
+    count as modified that long ago, so a delta export only returns what the test changes. The servers
+    are stopped after the test.
+    """
+    servers = []
+
+    def start(records, modified_ago=None, **options):
+        fake = FakeRedcap(records, **options)
+        if modified_ago is not None:
+            fake.modified = dict.fromkeys(fake.modified, datetime.now() - modified_ago)
+        fake.url = fake.start()
+        servers.append(fake)
+        return fake
+
+    yield start
+    for fake in servers:
+        fake.stop()
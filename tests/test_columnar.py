@@ -0,0 +1,44 @@
+"""
+The columnar engine (columnar.py) must give the same errors as rules.validate_row_compiled, also when it
+is selected through the file validators that hand it normalized TubeRecords.
+"""
+import pytest
+
+import validation as v
+from synthetic import generate_files
+
+pytest.importorskip("numpy")
+
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    return generate_files(
+        str(tmp_path_factory.mktemp("synthetic")), 3000, import_rows=500, error_rate=0.05,
+        materials={"BIOFLUID": 0.8, "DNA": 0.1, "PAXGENE": 0.1},
+    )
+
+
+def test_reference_file_columnar_matches_compiled(files):
+    _, compiled = v.validate_reference_file(files["reference"], "Reference data")
+    _, columnar = v.validate_reference_file(files["reference"], "Reference data", columnar=True)
+    failing = [row_errors for row_errors in compiled if row_errors]
+    assert failing
+    assert columnar == failing
+    assert [[error.key() for error in row_errors] for row_errors in columnar] == \
+        [[error.key() for error in row_errors] for row_errors in failing]
+
+
+def test_import_file_columnar_matches_compiled(files):
+    reference, _ = v.validate_reference_stream(files["reference"], "Reference data", check_duplicates=False)
+    _, compiled = v.validate_import_file(files["import"], "Import file", reference)
+    _, columnar = v.validate_import_file(files["import"], "Import file", reference, columnar=True)
+    assert compiled
+    assert [error.key() for error in columnar] == [error.key() for error in compiled]
+
+
+def test_reference_stream_columnar_matches_compiled(files):
+    reference, compiled = v.validate_reference_stream(files["reference"], "Reference data")
+    columnar_reference, columnar = v.validate_reference_stream(files["reference"], "Reference data", columnar=True)
+    assert columnar == compiled
+    assert columnar_reference.occupied_positions == reference.occupied_positions
+    assert columnar_reference.study_to_lab == reference.study_to_lab
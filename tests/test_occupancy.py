@@ -0,0 +1,72 @@
+"""
+The saved occupancy index (occupancy.load_or_build) is updated from the delta export of the reference
+snapshot and must stay equal to an index built from the whole reference.
+"""
+from datetime import timedelta
+
+import pytest
+
+import cli
+from occupancy import OccupancyIndex
+from synthetic import generate_files
+from utils import read_csv, ReferenceIndex
+
+
+@pytest.fixture
+def fake(tmp_path, fake_redcap):
+    _, records = read_csv(generate_files(str(tmp_path / "synthetic"), 2000)["reference"])
+    return fake_redcap(records, modified_ago=timedelta(hours=1))
+
+
+def run_positions(fake, tmp_path):
+    cli.main([
+        "-r", str(tmp_path / "ref.csv"), "--download", "--api-url", fake.url, "--token", "TEST",
+        "--cache-dir", str(tmp_path / "snapshots"), "--material", "BIOFLUID",
+        "--positions-out", str(tmp_path / "positions.csv"), "--occupancy-index", str(tmp_path / "occupancy.json"),
+        "-q",
+    ])
+    return OccupancyIndex.load(str(tmp_path / "occupancy.json"), "BIOFLUID")
+
+
+def built_index(tmp_path):
+    _, rows = read_csv(str(tmp_path / "ref.csv"))
+    return OccupancyIndex.from_positions("BIOFLUID", ReferenceIndex.build(rows).occupied_positions)
+
+
+def test_delta_export_updates_saved_index(fake, tmp_path, capsys, monkeypatch):
+    index, expected = run_positions(fake, tmp_path), built_index(tmp_path)
+    assert index.bitmaps == expected.bitmaps
+    assert "Built occupancy index" in capsys.readouterr().out
+
+    # move a stored tube to a free slot
+    row = next(row for row in fake.records if row["tube_status"] == "1" and row["biomaterial"] == "1")
+    box = (row["freezer"], row["rack"], row["box"])
+    free = next(position for position in expected.available_positions() if position[:3] == box)
+    moved = [dict(other) for other in fake.records if other["study_id"] == row["study_id"]]
+    for other in moved:
+        if other["tube_id"] == row["tube_id"]:
+            other["tube_pos"] = free[3]
+    fake.set_record(row["study_id"], moved)
+
+    # the saved index is updated without packing the whole reference again
+    monkeypatch.setattr(OccupancyIndex, "build_bitmaps", lambda self, occupied: pytest.fail("index rebuilt"))
+    index = run_positions(fake, tmp_path)
+    monkeypatch.undo()
+    expected = built_index(tmp_path)
+    assert index.bitmaps == expected.bitmaps
+    assert index.is_free(box + (row["tube_pos"],))
+    assert not index.is_free(free)
+    assert "2 slot(s) changed" in capsys.readouterr().out
+
+
+def test_index_of_another_snapshot_is_rebuilt(fake, tmp_path, capsys):
+    run_positions(fake, tmp_path)
+    stale = OccupancyIndex.load(str(tmp_path / "occupancy.json"), "BIOFLUID")
+    stale.synced_to = "2000-01-01 00:00:00"
+    stale.release(next(iter(stale.occupied_positions())))
+    stale.save(str(tmp_path / "occupancy.json"))
+    capsys.readouterr()
+
+    index, expected = run_positions(fake, tmp_path), built_index(tmp_path)
+    assert index.bitmaps == expected.bitmaps
+    assert "Built occupancy index" in capsys.readouterr().out
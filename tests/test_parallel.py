@@ -0,0 +1,20 @@
+"""
+Validation on several processes (parallel.py) must give the same errors and reference index as one process.
+"""
+import pytest
+
+import validation as v
+from synthetic import generate_files
+
+
+@pytest.fixture(scope="module")
+def reference_path(tmp_path_factory):
+    return generate_files(str(tmp_path_factory.mktemp("synthetic")), 12000, error_rate=0.02)["reference"]
+
+
+def test_reference_index_from_workers_matches_serial(reference_path):
+    reference, errors = v.validate_reference_stream(reference_path, "Reference data")
+    parallel_reference, parallel_errors = v.validate_reference_stream(reference_path, "Reference data", workers=2)
+    assert parallel_errors == errors
+    for name in reference.__slots__:
+        assert getattr(parallel_reference, name) == getattr(reference, name), name
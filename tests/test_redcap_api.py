@@ -0,0 +1,47 @@
+"""
+REDCap client (redcap_api.py) against the local REDCap stand-in (fake_redcap.py).
+"""
+import pytest
+
+from redcap_api import RedcapClient, RedcapAuthError, RedcapHTTPError
+
+
+@pytest.fixture
+def fake(fake_redcap, tube_row):
+    return fake_redcap([tube_row(f"000-001-{i:03d}", instance) for i in range(1, 12) for instance in (1, 2)])
+
+
+def test_transient_failure_is_retried(fake):
+    fake.fail_next = [503]
+    with RedcapClient(fake.url, "TEST", backoff=0) as client:
+        records = list(client.export_records())
+    assert records == fake.records
+    assert len(fake.requests) == 2
+
+
+def test_retries_are_limited(fake):
+    fake.fail_next = [503] * 3
+    with RedcapClient(fake.url, "TEST", retries=2, backoff=0) as client:
+        with pytest.raises(RedcapHTTPError):
+            list(client.export_records())
+    assert len(fake.requests) == 3
+
+
+def test_rejected_token_is_not_retried(fake):
+    with RedcapClient(fake.url, "WRONG", backoff=0) as client:
+        with pytest.raises(RedcapAuthError):
+            list(client.export_records())
+    assert len(fake.requests) == 1
+
+
+def test_batched_export_keeps_record_order(fake):
+    fake.delay = 0.02  # several batches are in flight at the same time
+    with RedcapClient(fake.url, "TEST") as client:
+        full = list(client.export_records())
+        fake.requests.clear()
+        batched = list(client.iter_records_batched(batch_size=2, concurrency=3))
+    assert batched == full
+    # one record ID list request, then one request per batch of 2 records
+    assert len(fake.requests) == 1 + 6
+    assert sorted(len([key for key in form if key.startswith("records[")]) for form in fake.requests[1:]) == \
+        [1, 2, 2, 2, 2, 2]
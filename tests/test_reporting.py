@@ -0,0 +1,45 @@
+"""
+Streaming reports (reporting.py): a failing report run must not replace the existing report.
+"""
+import os
+
+import pytest
+
+from error_records import ErrorRecord
+from reporting import open_report, page_path
+
+
+def errors(n):
+    return [ErrorRecord(i, "unknown_material", "biomaterial", ("xyz",)) for i in range(2, n + 2)]
+
+
+def write(path, n, fail=False):
+    with open_report(path, page_size=2, max_details=100) as report:
+        with report.section("import", "Errors / Warnings Importfile:", "Import file"):
+            report.add_errors(errors(n))
+            if fail:
+                raise ValueError("broken input")
+
+
+def files(folder):
+    return {name: open(os.path.join(folder, name), encoding="utf-8").read() for name in sorted(os.listdir(folder))}
+
+
+def test_failed_report_keeps_existing_report(tmp_path):
+    path = str(tmp_path / "r.txt")
+    write(path, 5)
+    assert os.path.exists(page_path(path, 3))
+    before = files(tmp_path)
+
+    with pytest.raises(ValueError):
+        write(path, 7, fail=True)
+    assert files(tmp_path) == before
+
+
+def test_shorter_report_removes_old_pages(tmp_path):
+    path = str(tmp_path / "r.txt")
+    write(path, 5)
+    write(path, 3)
+    assert sorted(os.listdir(tmp_path)) == ["r.txt", "r_page2.txt"]
+    assert "4 × Unknown or unsupported material" not in open(path, encoding="utf-8").read()
+    assert "3 × Unknown or unsupported material" in open(path, encoding="utf-8").read()
@@ -0,0 +1,63 @@
+"""
+Validation service (service.py): the answers over HTTP must be the same as the local functions.
+"""
+import glob
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+import positions as p
+import service
+from config import STORAGE_RULES
+from pipeline import check_import
+from watcher import WarmReference
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+REFERENCE = os.path.join(DATA, "Ref_file_test.csv")
+IMPORTS = sorted(glob.glob(os.path.join(DATA, "tests", "*.csv")))
+
+
+@pytest.fixture(scope="module")
+def running():
+    args = service.build_parser().parse_args(["-r", REFERENCE, "--port", "0"])
+    bioval = service.BioValService(WarmReference(args, 3600))
+    url = bioval.start(port=0)
+    yield bioval, service.ServiceClient(url)
+    bioval.stop()
+
+
+@pytest.mark.parametrize("import_path", IMPORTS, ids=os.path.basename)
+def test_check_import_matches_local(running, import_path):
+    bioval, client = running
+    reference, _ = bioval.warm.current()
+    rows, errors, labid_messages, instance_messages, duplicates = check_import(
+        import_path, reference, label=os.path.basename(import_path), write_back=False
+    )
+    remote_rows, remote_errors, remote_labid, remote_instance, remote_duplicates = client.check_import(
+        import_path, write_back=False
+    )
+    assert remote_rows == service.row_dicts(rows)
+    assert [error.key() for error in remote_errors] == [error.key() for error in errors]
+    assert (remote_labid, remote_instance, remote_duplicates) == (labid_messages, instance_messages, duplicates)
+
+
+@pytest.mark.parametrize("material", sorted(STORAGE_RULES))
+@pytest.mark.parametrize("box_policy", p.BOX_POLICIES)
+def test_available_positions_match_local(running, material, box_policy):
+    bioval, client = running
+    reference, _ = bioval.warm.current()
+    expected = p.select_free_positions(material, reference.occupied_positions, box_policy=box_policy)
+    assert client.available_positions(material, box_policy) == [tuple(position) for position in expected]
+
+
+def test_unknown_material(running):
+    _, client = running
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(client.url + "positions?material=PLASMA")
+    assert error.value.code == 422
+    assert json.loads(error.value.read()) == {"error": "Material 'PLASMA' has no defined STORAGE_RULE."}
+    with pytest.raises(Exception, match="Validation service: Material 'PLASMA' has no defined STORAGE_RULE"):
+        client.available_positions("PLASMA")
@@ -0,0 +1,56 @@
+"""
+Snapshot sync (snapshots.sync_reference) against the local REDCap stand-in (fake_redcap.py).
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from snapshots import SnapshotStore, sync_reference, REDCAP_TIME_FORMAT, SYNC_MARGIN
+
+
+@pytest.fixture
+def fake(fake_redcap, tube_row):
+    return fake_redcap(
+        [tube_row("000-001-001", 1, "A1"), tube_row("000-001-001", 2, "A2"), tube_row("000-001-002", 1, "A3")],
+        modified_ago=timedelta(hours=1),
+    )
+
+
+def test_delta_sync_merges_changed_records(fake, tmp_path, tube_row):
+    store = SnapshotStore(str(tmp_path))
+    records, stats = sync_reference(store, fake.url, "TEST")
+    assert stats["mode"] == "full" and records == fake.records
+    assert "dateRangeBegin" not in fake.requests[-1]
+
+    fake.set_record("000-001-001", [tube_row("000-001-001", 1, "B1")])
+    fake.set_record("000-001-003", [tube_row("000-001-003", 1, "B2")])
+    records, stats = sync_reference(store, fake.url, "TEST")
+
+    # only the changed records were exported, starting a bit before the last sync
+    since = datetime.strptime(fake.requests[-1]["dateRangeBegin"], REDCAP_TIME_FORMAT)
+    assert since == datetime.strptime(stats["previous_sync"], REDCAP_TIME_FORMAT) - SYNC_MARGIN
+    assert stats["mode"] == "delta" and stats["downloaded"] == 2
+    # all rows of a changed record are replaced, in its old place
+    assert [(row["study_id"], row["tube_pos"]) for row in records] == [
+        ("000-001-001", "B1"), ("000-001-002", "A3"), ("000-001-003", "B2"),
+    ]
+    assert [row["tube_pos"] for row in stats["replaced"]] == ["A1", "A2"]
+
+
+def test_full_sync_removes_deleted_records(fake, tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    sync_reference(store, fake.url, "TEST")
+    fake.set_record("000-001-002", [])
+
+    # a delta export does not report deleted records
+    records, stats = sync_reference(store, fake.url, "TEST")
+    assert stats["downloaded"] == 0
+    assert "000-001-002" in {row["study_id"] for row in records}
+
+    records, stats = sync_reference(store, fake.url, "TEST", full=True)
+    assert stats["mode"] == "full"
+    assert "dateRangeBegin" not in fake.requests[-1]
+    assert {row["study_id"] for row in records} == {"000-001-001"}
+    # the next delta starts from the full snapshot
+    records, _ = sync_reference(store, fake.url, "TEST")
+    assert {row["study_id"] for row in records} == {"000-001-001"}
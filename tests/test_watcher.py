@@ -0,0 +1,48 @@
+"""
+Watch folder (watcher.py): every dropped import file gets a report and a corrected file, the outputs are
+never validated as import files again.
+"""
+import glob
+import os
+import shutil
+
+import pytest
+
+import watcher
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+REFERENCE = os.path.join(DATA, "Ref_file_test.csv")
+
+
+@pytest.fixture
+def folder(tmp_path):
+    for path in glob.glob(os.path.join(DATA, "tests", "*.csv")):
+        shutil.copy(path, tmp_path)
+    return str(tmp_path)
+
+
+def test_watch_once_validates_every_import(folder):
+    imports = sorted(glob.glob(os.path.join(folder, "*.csv")))
+    contents = {path: open(path, "rb").read() for path in imports}
+    args = watcher.build_parser().parse_args([folder, "-r", REFERENCE])
+    warm = watcher.WarmReference(args, 60)
+
+    watcher.watch(folder, warm, once=True)
+    for path in imports:
+        report_path, validated_path = watcher.output_paths(path)
+        assert os.path.getsize(report_path) > 0
+        assert os.path.getsize(validated_path) > 0
+        assert open(path, "rb").read() == contents[path]  # the import file itself is not changed
+    outputs = set(os.listdir(folder))
+    assert len(outputs) == 3 * len(imports)
+
+    # the reports and corrected files are not picked up as imports
+    mtimes = {name: os.path.getmtime(os.path.join(folder, name)) for name in outputs}
+    watcher.watch(folder, warm, once=True)
+    assert {name: os.path.getmtime(os.path.join(folder, name)) for name in os.listdir(folder)} == mtimes
+
+
+def test_main_once(folder):
+    assert watcher.main([folder, "-r", REFERENCE, "--once", "-q"]) == 0
+    imports = [name for name in os.listdir(folder) if watcher.is_import_file(name)]
+    assert imports and all(os.path.exists(watcher.output_paths(os.path.join(folder, name))[0]) for name in imports)
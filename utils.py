@@ -1,6 +1,14 @@
 import csv
+import os
+from collections import ChainMap
+from itertools import chain
 from config import STUDY_ID_PATTERN
 from datetime import datetime
+from records import TubeRecord, iter_records
+from reporting import open_report
+from diagnostics import get_logger
+
+log = get_logger("utils")
 
 
 def read_csv(path):
@@ -18,6 +26,27 @@ def read_csv(path):
         rows = list(reader)
     return reader.fieldnames, rows
 
+def iter_csv(path):
+    """
+    Helper function. Opens a CSV file for streaming. Only the header is read directly; the rows are
+    read one by one while the returned iterator is consumed, so the file is never held in memory.
+
+    Args:
+        path (str): Path to the CSV file
+
+    Returns:
+        tuple: (List[str] headers, Iterator[Dict] rows)
+    """
+    f = open(path, newline='', encoding='utf-8')
+    reader = csv.DictReader(f)
+    headers = reader.fieldnames
+
+    def rows():
+        with f:
+            yield from reader
+
+    return headers, rows()
+
 def make_instance_key(row):
     """
     Helper function. Generates key for the instance validation.
@@ -28,94 +57,79 @@ def make_instance_key(row):
     Returns:
         Tupel: [Study_id(XXX-XXX-XXX), redcap_repeat_instance(int)] 
     """
+    if type(row) is TubeRecord:
+        return row.study_id, row.redcap_repeat_instance
     return (
         row.get("study_id", "").strip(),
         row.get("redcap_repeat_instance", "").strip(),
     )          
-            
+
+def make_position_key(row):
+    """
+    Helper function. Generates the storage position key of a row.
+
+    Args:
+        row (Dict): A row of import or reference data
+
+    Returns:
+        Tuple: (freezer, rack, box, tube_pos), stripped strings
+    """
+    if type(row) is TubeRecord:
+        return row.freezer, row.rack, row.box, row.tube_pos
+    return (
+        str(row.get("freezer", "")).strip(),
+        str(row.get("rack", "")).strip(),
+        str(row.get("box", "")).strip(),
+        str(row.get("tube_pos", "")).strip(),
+    )
+
 def write_report(filename, import_file, import_rows, reference_file, 
-                 error_input, error_reference, labid_messages = None, instance_messages = None, recommendation=None):
+                 error_input, error_reference, labid_messages = None, instance_messages = None, recommendation=None,
+                 metrics=None, fmt=None):
     """
-    Writes a validation report to a text file.
+    Writes a validation report. The errors are streamed into a reporting.ReportWriter, which puts the
+    per-rule and per-box summary at the top and caps and pages the detail list.
 
     Args:
-        filename (str): Path to save the report
+        filename (str): Path to save the report (the extension .csv, .jsonl or .html selects the format)
         import_file (str): Path to import CSV
         reference_file (str): Path to reference CSV
         import_rows (List[Dict], optional): Imported rows, for summary stats
-        errors (List[str], optional): List of error messages collected
+        error_input (List[ErrorRecord]): Validation errors of the import file
+        error_reference (List[List[ErrorRecord]]): Error lists of the failing reference rows
         recommendation (str, optional): Recommendation to upload or not
+        metrics (Dict, optional): Stage timings and counters (instrumentation.summary), appended at the end
+        fmt (str, optional): Report format (text, csv, jsonl, html), overrides the extension
     """
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write("Biorepository Data Validation Report\n")
-        f.write(f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
-        f.write("="*50 + "\n\n")
-
-        f.write("Input files:\n")
-        f.write(f" - Import: {import_file}\n")
-        f.write(f" - Reference: {reference_file}\n\n")
-
-        # Summary
-        f.write("Summary:\n")
+    with open_report(filename, fmt, inputs=[("Import", import_file), ("Reference", reference_file)]) as report:
         if import_rows:
-            f.write(f" - Number of import rows processed: {len(import_rows)}\n")
-        f.write("\n")
+            report.add_fact("Number of import rows processed", len(import_rows))
 
         # Errors Input file
-        f.write("Errors / Warnings Inputfile:\n")
-        if error_input and len(error_input) > 0:
-            for e in error_input:
-                f.write(f" - {e}\n")
-        else:
-            f.write(" - None\n")
-        f.write("\n")
-        
+        with report.section("import", "Errors / Warnings Inputfile:", "Import file"):
+            report.add_errors(error_input or [])
+
         # Lab Id assignment
-        f.write("Lab Id assignment ")
-        if labid_messages: 
-            for msg in labid_messages:
-                f.write(f" - {msg}\n")
-        else:
-            f.write(" - None\n")
-        f.write("\n")
-        
+        with report.section("labid", "Lab Id assignment:"):
+            report.add_messages(labid_messages or [])
+
         # Instance assignment
-        f.write("Red cap instance assignment \n")
-        if instance_messages: 
-            for msg in instance_messages:
-                f.write(f" - {msg}\n")
-        else:
-            f.write(" - None\n")
-        f.write("\n")
-        
+        with report.section("instance", "Red cap instance assignment:"):
+            report.add_messages(instance_messages or [])
+
         # Errors Reference file
-        f.write("Errors / Warnings Referencefile:\n")
-        if error_reference and len(error_reference) > 0:
-            for error_list in error_reference:
-                if not error_list:
-                    continue
-
-                row_prefix = error_list[0].split(":")[0]  # splitting rows
-                f.write(f"\n{row_prefix}:\n")
-
-                for error in error_list:
-                    message = error.split(":", 1)[1].strip()
-                    f.write(f"  - {message}\n")
-            
-            #for e in error_reference:
-            #    f.write(f" - {e}\n")
-        else:
-            f.write(" - None\n")
-        f.write("\n")
-        
-        
-        
+        with report.section("reference", "Errors / Warnings Referencefile:", "Reference file"):
+            for error_list in error_reference or []:
+                report.add_row_errors(error_list)
+
         # Recommendation
         #f.write("Recommendation:\n")
         #if recommendation:
         #    f.write(f"{recommendation}\n")
         #else:
         #    f.write("No recommendation provided.\n")
+
+        report.close(metrics)
             
             
 def save_data_as_csv(records, out_path):
@@ -129,6 +143,8 @@ def save_data_as_csv(records, out_path):
     if not records:
         raise Exception("No records to write.")
 
+    records = [record.to_dict() if type(record) is TubeRecord else record for record in records]
+
     keys = records[0].keys() #without sorted otherwise it is alphabetic
     
     #['study_id', 'redcap_event_name','redcap_repeat_instance','redcap_repeat_instrument','lab_id','study','sampling_date','biomaterial','volume_cell_number','tube_id','box_id','tube_pos','box','rack','freezer','tube_status','fibro_passage','sent_date','sent_project','reserved_date','reserved_for','comment','biorepository_complete']
@@ -138,8 +154,57 @@ def save_data_as_csv(records, out_path):
         writer.writeheader()
         writer.writerows(records)
 
-    print(f"Data saved to {out_path}")
+    log.info("Data saved to %s", out_path)
     
+def peek_headers(records):
+    """
+    Helper function. Takes the column names of a record stream from its first record.
+
+    Args:
+        records (Iterable[Dict]): Flat REDCap records
+
+    Returns:
+        tuple: (List[str] headers or None if there are no records, Iterator[Dict] all records)
+    """
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return None, iter(())
+    return list(first.keys()), chain([first], records)
+
+
+def write_csv_while_reading(records, out_path, headers):
+    """
+    Helper function. Passes records through and writes them to a CSV file at the same time, so a
+    download can be validated and saved in one pass. The file is written to out_path.tmp and only
+    replaces out_path once all records were read.
+
+    Args:
+        records (Iterable[Dict]): Flat REDCap records
+        out_path (str): Storage path
+        headers (List[str]): Column names
+
+    Yields:
+        Dict: The records
+    """
+    tmp_path = out_path + ".tmp"
+    complete = False
+    try:
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=headers)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+                yield record
+        complete = True
+    finally:
+        if complete:
+            os.replace(tmp_path, out_path)
+            log.info("Data saved to %s", out_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def build_patient_map(reference_rows):
     """
     Helper function. Builds study_id → lab_patient_id mapping from REDCap reference data.
@@ -159,9 +224,9 @@ def build_patient_map(reference_rows):
     lab_to_study = {}
     used_lab_ids = set()
 
-    for row in reference_rows:
-        study_id = row.get("study_id", "").strip()
-        lab_id = row.get("lab_id", "").strip()
+    for record in iter_records(reference_rows):
+        study_id = record.study_id
+        lab_id = record.lab_id
 
         if not study_id or not lab_id:
             continue
@@ -192,31 +257,55 @@ def get_next_lab_patient_id(used_lab_ids):
         return 1
     return max(used_lab_ids) + 1
 
-def assign_lab_patient_ids(import_rows, reference_rows):
+def assign_lab_patient_ids(import_rows, reference_rows, patient_map=None, allocator=None):
     """
     Core function from Gui. Assigns lab_id based on study_id and reference data. The lab id does not need to be plugged in; 
     BioVal finds the last lab id in the reference data and automatically asigns to the to be importated
     data the new lab id. 
     
     Args:
+        import_rows (List[Dict]): Rows from the import file
+        reference_rows (List[Dict] | ReferenceIndex): Rows of the reference data or their index
+            (ignored if patient_map is given)
+        patient_map (Tuple, optional): Precomputed (study_to_lab, lab_to_study, used_lab_ids), e.g. from
+            ReferenceIndex. They are not modified.
+        allocator (IdAllocator, optional): Shared allocator (allocator.py); the new lab IDs are reserved
+            there, so concurrent runs never hand out the same lab ID
     
     Returns:
-    
+        import_rows List[Dict]: Import rows with lab_id filled in
+        labid_messages List[str]: Assignment messages for the report
     """
     # !!!!!!!!!!!!!!! Make absolutley sure, that the labID is never filled in; also wenn mal eine "frei" wird sozusagen
-    study_to_lab, lab_to_study, used_lab_ids = build_patient_map(reference_rows)
+    if patient_map is None and isinstance(reference_rows, ReferenceIndex):
+        patient_map = reference_rows.patient_map
+    if patient_map is None:
+        study_to_lab, lab_to_study, used_lab_ids = build_patient_map(reference_rows)
+    else:
+        study_to_lab, lab_to_study, used_lab_ids = patient_map
+        study_to_lab, used_lab_ids = ChainMap({}, study_to_lab), set(used_lab_ids)
     next_id = get_next_lab_patient_id(used_lab_ids)
+    reserved = None
+    if allocator is not None:
+        # one reservation for all new study IDs of the file
+        reserved = allocator.reserve_lab_ids(
+            (record.study_id for record in iter_import_records(import_rows) if record.study_id not in study_to_lab),
+            used_lab_ids,
+        )
+        next_id = min(reserved.values()) if reserved else allocator.next_lab_id(used_lab_ids)
     labid_messages = [f"Next available lab patient ID: {next_id:05d}"]
 
     #ich checke hier actuell nur die imported rows! 
-    for i, row in enumerate(import_rows, start=2):
-        study_id = row.get("study_id", "").strip()
+    for i, record in enumerate(iter_import_records(import_rows), start=2):
+        study_id = record.study_id
 
         if study_id in study_to_lab:
-            row["lab_id"] = study_to_lab[study_id]
+            record.set_lab_id(study_to_lab[study_id])
         else:
+            if reserved is not None:
+                next_id = reserved[study_id]
             lab_id = f"{next_id:05d}"
-            row["lab_id"] = lab_id
+            record.set_lab_id(lab_id)
             study_to_lab[study_id] = lab_id
             used_lab_ids.add(next_id)
             next_id += 1
@@ -270,17 +359,25 @@ def build_instance_maps_old(reference_rows):
 
 
 def build_instance_maps(reference_rows):
+    """
+    Helper function. Builds the maps for the REDCap instances of the reference data.
+
+    Args:
+        reference_rows (Iterable[Dict | TubeRecord]): Reference rows or normalized records
+
+    Returns:
+        study_to_max_instance Dict: Mapping from study_id -> max instance
+        tube_map Dict: Mapping from (study_id, tube key) -> instance
+    """
     study_to_max_instance = {}
     tube_map = {}
 
-    for row in reference_rows:
-        study_id = str(row.get("study_id", "")).strip()
-        instance = str(row.get("redcap_repeat_instance", "")).strip()
-
-        if not study_id or not instance:
+    for record in iter_records(reference_rows):
+        if record.instance_key is None:
             continue
 
-        instance = int(instance)
+        study_id = record.study_id
+        instance = record_instance(record)
 
         # track max instance per study_id
         study_to_max_instance[study_id] = max(
@@ -288,62 +385,255 @@ def build_instance_maps(reference_rows):
             instance
         )
 
-        # --- build tube identifier ---
-        tube_id = str(row.get("tube_id", "")).strip()
-
-        if tube_id:
-            tube_key = tube_id
-        else:
-            freezer = str(row.get("freezer", "")).strip()
-            rack = str(row.get("rack", "")).strip()
-            box = str(row.get("box", "")).strip()
-            pos = str(row.get("tube_pos", "")).strip()
-
-            # only use position if complete
-            if all([freezer, rack, box, pos]):
-                tube_key = (freezer, rack, box, pos)
-            else:
-                continue  # cannot identify tube reliably
+        # --- tube identifier: tube_id, else the complete position ---
+        if record.tube_key is None:
+            continue  # cannot identify tube reliably
 
-        tube_map[(study_id, tube_key)] = instance
+        tube_map[(study_id, record.tube_key)] = instance
 
     return study_to_max_instance, tube_map
 
-def assign_instances(import_rows, reference_rows):
-    study_to_max, tube_map = build_instance_maps(reference_rows)
+def record_instance(record):
+    """
+    Helper function. Integer instance of a record; raises ValueError for a non-numeric instance
+    (as int() on the raw value did before).
+    """
+    if record.instance_no is not None:
+        return record.instance_no
+    return int(record.redcap_repeat_instance)
+
+class SetOverlay:
+    """
+    A set seen as the items of a base set plus added items; the base set is not modified.
+    """
+
+    __slots__ = ("base", "added")
+
+    def __init__(self, base):
+        self.base = base
+        self.added = set()
+
+    def add(self, item):
+        if item not in self.base:
+            self.added.add(item)
+
+    def __contains__(self, item):
+        return item in self.added or item in self.base
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.added
+
+    def __len__(self):
+        return len(self.base) + len(self.added)
+
+
+class ReferenceIndex:
+    """
+    Core class. Everything the checks and assignments need from the reference data, built in one pass
+    once per run (ReferenceIndex.build, or row by row while the reference is validated). The reference
+    rows themselves do not have to be kept in memory. The structures are the same as built by
+    build_patient_map, build_instance_maps, positions.get_occupied_positions and the reference instances
+    of validate_tube_instances; every check and assignment function accepts a ReferenceIndex in place
+    of the reference rows.
+
+    Attributes:
+        row_count (int): Number of reference rows added
+        occupied_positions Set[Tuple]: (freezer, rack, box, pos) of all stored tubes
+        instance_keys Set[Tuple]: Complete (study_id, redcap_repeat_instance) keys
+        study_to_lab Dict: Mapping from study_id -> lab_id
+        lab_to_study Dict: Mapping from lab_id -> study_id
+        used_lab_ids Set[int]: Used lab ids
+        study_to_max_instance Dict: Mapping from study_id -> max instance
+        tube_map Dict: Mapping from (study_id, tube key) -> instance
+    """
+
+    __slots__ = (
+        "row_count", "occupied_positions", "instance_keys", "study_to_lab", "lab_to_study",
+        "used_lab_ids", "study_to_max_instance", "tube_map",
+    )
+
+    def __init__(self):
+        self.row_count = 0
+        self.occupied_positions = set()
+        self.instance_keys = set()
+        self.study_to_lab = {}
+        self.lab_to_study = {}
+        self.used_lab_ids = set()
+        self.study_to_max_instance = {}
+        self.tube_map = {}
+
+    @classmethod
+    def build(cls, reference_rows):
+        """
+        Builds the index from the reference rows in one pass.
+
+        Args:
+            reference_rows (Iterable[Dict | TubeRecord]): Rows of the reference data
+
+        Returns:
+            ReferenceIndex: The index
+        """
+        index = cls()
+        for record in iter_records(reference_rows):
+            index.add(record)
+        return index
+
+    @classmethod
+    def overlay(cls, reference):
+        """
+        Index of the reference plus the rows added to it later (e.g. the import files of a batch that
+        were already checked); the reference index itself stays unchanged and can be shared.
+
+        Args:
+            reference (ReferenceIndex): Shared index of the reference data
+
+        Returns:
+            ReferenceIndex: The overlay index
+        """
+        index = cls()
+        index.row_count = reference.row_count
+        index.occupied_positions = SetOverlay(reference.occupied_positions)
+        index.instance_keys = SetOverlay(reference.instance_keys)
+        index.study_to_lab = ChainMap({}, reference.study_to_lab)
+        index.lab_to_study = ChainMap({}, reference.lab_to_study)
+        index.used_lab_ids = SetOverlay(reference.used_lab_ids)
+        index.study_to_max_instance = ChainMap({}, reference.study_to_max_instance)
+        index.tube_map = ChainMap({}, reference.tube_map)
+        return index
+
+    def add(self, row):
+        """
+        Adds one reference row to the index.
+
+        Args:
+            row (Dict | TubeRecord): A row of the reference data
+
+        Raises:
+            Exception: If a study ID or lab ID is linked to more than one partner (as build_patient_map)
+        """
+        record = row if type(row) is TubeRecord else TubeRecord.from_row(row)
+        self.add_entry(self.entry(record))
+
+    @staticmethod
+    def entry(record):
+        """
+        Helper function. The parts of a normalized row the index keeps, as a small tuple that worker
+        processes send back instead of the records (parallel.scan_chunk).
+
+        Args:
+            record (TubeRecord): A normalized reference row
+
+        Returns:
+            Tuple: (occupied position, study_id, lab_id, instance key, instance, tube key)
+        """
+        # occupied positions - only "Stored" tubes occupy a position
+        position = record.position_key if record.tube_status == "1" else None
+        if record.instance_key is None:
+            return position, record.study_id, record.lab_id, None, None, None
+        instance = record.instance_no if record.instance_no is not None else record.redcap_repeat_instance
+        return position, record.study_id, record.lab_id, record.instance_key, instance, record.tube_key
+
+    def add_entry(self, entry):
+        """
+        Adds one reference row to the index, given as its entry (see entry and add).
+        """
+        position, study_id, lab_id, instance_key, instance, tube_key = entry
+        self.row_count += 1
+
+        if position is not None:
+            self.occupied_positions.add(position)
+
+        # lab id maps
+        if study_id and lab_id:
+            if study_id in self.study_to_lab and self.study_to_lab[study_id] != lab_id:
+                raise Exception(f"Study ID {study_id} has multiple lab IDs.")
+            if lab_id in self.lab_to_study and self.lab_to_study[lab_id] != study_id:
+                raise Exception(f"Lab ID {lab_id} is linked to multiple study IDs.")
+            self.lab_to_study[lab_id] = study_id
+            self.study_to_lab[study_id] = lab_id
+            self.used_lab_ids.add(int(lab_id))
+
+        # instance maps
+        if instance_key is None:
+            return
+        self.instance_keys.add(instance_key)
+
+        instance = int(instance)  # raises ValueError for a non-numeric instance, see record_instance
+        self.study_to_max_instance[study_id] = max(self.study_to_max_instance.get(study_id, 0), instance)
+
+        if tube_key:
+            self.tube_map[(study_id, tube_key)] = instance
+
+    @property
+    def patient_map(self):
+        """Tuple (study_to_lab, lab_to_study, used_lab_ids) as returned by build_patient_map."""
+        return self.study_to_lab, self.lab_to_study, self.used_lab_ids
+
+    @property
+    def instance_maps(self):
+        """Tuple (study_to_max_instance, tube_map) as returned by build_instance_maps."""
+        return self.study_to_max_instance, self.tube_map
+
+
+def assign_instances(import_rows, reference_rows, instance_maps=None, allocator=None):
+    """
+    Core function from GUI. Assigns the REDCap repeat instance to every import row. Existing tubes
+    keep their instance, new tubes get the next free instance of their study ID.
+
+    Args:
+        import_rows (List[Dict]): Rows from the import file
+        reference_rows (List[Dict] | ReferenceIndex): Rows of the reference data or their index
+            (ignored if instance_maps is given)
+        instance_maps (Tuple, optional): Precomputed (study_to_max_instance, tube_map), e.g. from
+            ReferenceIndex. They are not modified.
+        allocator (IdAllocator, optional): Shared allocator (allocator.py); the new instances are reserved
+            there, so concurrent runs never hand out the same instance
+
+    Returns:
+        import_rows List[Dict]: Import rows with redcap_repeat_instance filled in
+        messages List[str]: Assignment messages for the report
+    """
+    if instance_maps is None and isinstance(reference_rows, ReferenceIndex):
+        instance_maps = reference_rows.instance_maps
+    if instance_maps is None:
+        study_to_max, tube_map = build_instance_maps(reference_rows)
+    else:
+        # new assignments go to the first map, the shared index stays untouched
+        study_to_max, tube_map = (ChainMap({}, m) for m in instance_maps)
 
     messages = []
+    reserved = None
+    if allocator is not None:
+        # one reservation for all new tubes of the file
+        reserved = allocator.reserve_instances(
+            (
+                (record.study_id, record.tube_key)
+                for record in iter_import_records(import_rows)
+                if record.study_id and record.tube_key is not None
+                and (record.study_id, record.tube_key) not in tube_map
+            ),
+            study_to_max,
+        )
 
-    for i, row in enumerate(import_rows, start=2):
-        study_id = str(row.get("study_id", "")).strip()
+    for i, record in enumerate(iter_import_records(import_rows), start=2):
+        study_id = record.study_id
 
         if not study_id:
             raise Exception(f"Row {i}: Missing study_id")
 
-        # --- build tube identifier ---
-        tube_id = str(row.get("tube_id", "")).strip()
-
-        if tube_id:
-            tube_key = tube_id
-        else:
-            freezer = str(row.get("freezer", "")).strip()
-            rack = str(row.get("rack", "")).strip()
-            box = str(row.get("box", "")).strip()
-            pos = str(row.get("tube_pos", "")).strip()
-
-            if all([freezer, rack, box, pos]):
-                tube_key = (freezer, rack, box, pos)
-            else:
-                raise Exception(
-                    f"Row {i}: Cannot identify tube (no tube_id and incomplete position)"
-                )
+        # --- tube identifier: tube_id, else the complete position ---
+        if record.tube_key is None:
+            raise Exception(
+                f"Row {i}: Cannot identify tube (no tube_id and incomplete position)"
+            )
 
-        key = (study_id, tube_key)
+        key = (study_id, record.tube_key)
 
         # CASE 1: existing tube → reuse instance
         if key in tube_map:
             instance = tube_map[key]
-            row["redcap_repeat_instance"] = str(instance)
+            record.set_instance(instance)
 
             messages.append(
                 f"Row {i}: Reused instance {instance} for existing tube"
@@ -351,9 +641,12 @@ def assign_instances(import_rows, reference_rows):
 
         # CASE 2: new tube → assign next instance
         else:
-            next_instance = study_to_max.get(study_id, 0) + 1
+            if reserved is not None:
+                next_instance = reserved[key]
+            else:
+                next_instance = study_to_max.get(study_id, 0) + 1
 
-            row["redcap_repeat_instance"] = str(next_instance)
+            record.set_instance(next_instance)
 
             study_to_max[study_id] = next_instance
             tube_map[key] = next_instance
@@ -401,7 +694,18 @@ def assign_instances_old(import_rows, reference_rows):
 
     return import_rows, messages
 
+def iter_import_records(import_rows):
+    """
+    Helper function. Iterates import rows as TubeRecords. Row dictionaries keep their source, so
+    assignments (lab_id, instance) are written back into them.
+    """
+    for row in import_rows:
+        yield row if type(row) is TubeRecord else TubeRecord.from_row(row, keep_source=True)
+
+
 def get_tube_key(row):
+    if type(row) is TubeRecord:
+        return row.tube_key
     tube_id = str(row.get("tube_id", "")).strip()
     if tube_id:
         return tube_id
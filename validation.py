@@ -1,8 +1,19 @@
+import logging
+
 from config import REQUIRED_FIELDS, VALID_POS_PAXGENE, VALID_POS_FLUIDS, VALID_POS_DNA_CELLS_PBMC, VALID_RACK
 from config import BIOFLUIDS, CELLS, DNA, PAXGENE, VALID_BOX, STUDY_ID_PATTERN, REDCAP_EVENT_NAME, REDCAP_REPEAT_INSTRUMENTS, VALID_TUBE_STATUS
-from utils import read_csv
+from utils import read_csv, iter_csv, ReferenceIndex
+from records import iter_records, normalize_rows
+from binary_snapshot import is_snapshot, iter_snapshot, read_snapshot
 from utils import make_instance_key
 from utils import get_tube_key, build_instance_maps
+from rules import validate_row_compiled
+from parallel import scan_parallel, merge_scans
+from error_records import ErrorRecord, set_box
+from diagnostics import get_logger, log_limited
+import instrumentation
+
+log = get_logger("validation")
 
 
 def check_structure(headers):
@@ -25,6 +36,9 @@ def validate_row(row, index):
     The validation process can be done for any type of data - to be uploaded ones or the RedCap Reference
     data. 
     
+    This is the reference implementation of the rules. The file validators use the precompiled
+    rules.validate_row_compiled, which returns the same errors per row.
+    
     Steps: 
     (1) Checks again for the Required fields (it does that to safe it as error message)
     (2) Checks the materialspecific storage rules. Checks 
@@ -34,14 +48,14 @@ def validate_row(row, index):
         index (int): The row number (for error reporting)
 
     Returns:
-        errors List[str]: List of validation error messages for this row
+        errors List[ErrorRecord]: Validation errors of this row (error_records.py)
     """
     errors = []
 
     # (1) Required fields
     for field in REQUIRED_FIELDS:
         if row.get(field, "").strip() == "":
-            errors.append(f"Row {index}: Missing value in '{field}'")
+            errors.append(ErrorRecord(index, "missing_value", field))
     # (2) Checks the Biomaterialspecific storage rules
     # Get material 
     biomaterial = row.get("biomaterial", "").strip().lower()
@@ -63,84 +77,84 @@ def validate_row(row, index):
    
     # Check if redcap_event_name is in RDregistry
     if redcap_event_name not in REDCAP_EVENT_NAME:
-        errors.append(f"Row {index}: Invalid Redcap Event name must be participant_regist_arm_1.")
+        errors.append(ErrorRecord(index, "invalid_event", "redcap_event_name", (redcap_event_name,)))
     
     if redcap_repeat_instrument not in REDCAP_REPEAT_INSTRUMENTS:
-        errors.append(f"Row {index}: Invalid Redcap Repeated instrument: must be biorepository.")
+        errors.append(ErrorRecord(index, "invalid_instrument", "redcap_repeat_instrument", (redcap_repeat_instrument,)))
     
     if redcap_repeat_instance:
         if not redcap_repeat_instance.isdigit():
             errors.append(
-                f"Row {index}: redcap_repeat_instance must be a positive integer"
+                ErrorRecord(index, "instance_not_integer", "redcap_repeat_instance", (redcap_repeat_instance,))
             )
         elif int(redcap_repeat_instance) <= 0:
             errors.append(
-                f"Row {index}: redcap_repeat_instance must be >= 1"
+                ErrorRecord(index, "instance_not_positive", "redcap_repeat_instance", (redcap_repeat_instance,))
             )
             
-    print(tube_pos)
+    log.debug("Row %s: tube_pos %s", index, tube_pos)
     # Unfortunately its different for the upload and import file!
     #  Material-specific storage rules - safe in errors if there is a mistake
     if biomaterial in BIOFLUIDS:  # fluids
         if tube_pos not in VALID_POS_FLUIDS:
-            errors.append(f"Row {index}: Invalid tube-pos '{tube_pos}' for {biomaterial} (must be A1–H10)")
+            errors.append(ErrorRecord(index, "biofluid.tube_pos", "tube_pos", (tube_pos, biomaterial)))
         if freezer not in ["1", "2", "3"]:
-            errors.append(f"Row {index}: {biomaterial} must be stored in -80 freezers (1–3).")
+            errors.append(ErrorRecord(index, "biofluid.freezer", "freezer", (freezer, biomaterial)))
         if rack not in VALID_RACK: 
-            errors.append(f"Row {index}: Invalid rack number '{rack}' for {biomaterial} (must be 1-100)")
+            errors.append(ErrorRecord(index, "biofluid.rack", "rack", (rack, biomaterial)))
         if box not in VALID_BOX: 
-            errors.append(f"Row {index}: Invalid box number '{box}' for {biomaterial} (must be 1-1000)")
+            errors.append(ErrorRecord(index, "biofluid.box", "box", (box, biomaterial)))
         if not box_id: 
-            errors.append(f"Row {index}: Invalid box or empty box ID '{box_id}' for {biomaterial} (must be unique ID)")
+            errors.append(ErrorRecord(index, "biofluid.box_id", "box_id", (box_id, biomaterial)))
 
     elif biomaterial in PAXGENE:
         if tube_pos not in VALID_POS_PAXGENE:
-            errors.append(f"Row {index}: Invalid tube-pos '{tube_pos}' for PAXgene (must be A1–G7)")
+            errors.append(ErrorRecord(index, "paxgene.tube_pos", "tube_pos", (tube_pos, biomaterial)))
         if freezer not in ["1", "2", "3"]:
-            errors.append(f"Row {index}: PAXgene must be stored in -80 freezers (1–3).")
+            errors.append(ErrorRecord(index, "paxgene.freezer", "freezer", (freezer, biomaterial)))
         if box not in range(1,501):  #das als string!
-            errors.append(f"Row {index}: Invalid box number '{box}' for {biomaterial} (must be 1-500)")
+            errors.append(ErrorRecord(index, "paxgene.box", "box", (box, biomaterial)))
         if rack:
-            errors.append(f"Row {index}: Rack must be empty for {biomaterial}") 
+            errors.append(ErrorRecord(index, "paxgene.rack", "rack", (rack, biomaterial))) 
         if box_id:   
-            errors.append(f"Row {index}: Box ID must be empty for {biomaterial}") 
+            errors.append(ErrorRecord(index, "paxgene.box_id", "box_id", (box_id, biomaterial))) 
 
 
     elif biomaterial in DNA:
         if tube_pos not in VALID_POS_DNA_CELLS_PBMC:
-            errors.append(f"Row {index}: Invalid tube-pos '{tube_pos}' for DNA (must be A1–J10)")
+            errors.append(ErrorRecord(index, "dna.tube_pos", "tube_pos", (tube_pos, biomaterial)))
         if freezer != "4": #here I need to be careful because this is exactly the problem
-            errors.append(f"Row {index}: DNA must be stored in 4-degree freezer.")
+            errors.append(ErrorRecord(index, "dna.freezer", "freezer", (freezer, biomaterial)))
         if rack:
-            errors.append(f"Row {index}: Rack must be empty for {biomaterial}") 
+            errors.append(ErrorRecord(index, "dna.rack", "rack", (rack, biomaterial))) 
         if box_id:   
-            errors.append(f"Row {index}: Box ID must be empty for {biomaterial}")
+            errors.append(ErrorRecord(index, "dna.box_id", "box_id", (box_id, biomaterial)))
 
     ####evtl brauche ich cells nicht                  
     elif biomaterial in CELLS:
         if tube_pos not in VALID_POS_DNA_CELLS_PBMC:
-            errors.append(f"Row {index}: Invalid tube-pos '{tube_pos}' for {biomaterial} (must be A1–J10)")
+            errors.append(ErrorRecord(index, "cells.tube_pos", "tube_pos", (tube_pos, biomaterial)))
         if freezer != "5": #here I need to be careful because this is exactly the problem
-            errors.append(f"Row {index}: {biomaterial} must be stored in nitrogen tank.")
+            errors.append(ErrorRecord(index, "cells.freezer", "freezer", (freezer, biomaterial)))
         if box_id:   
-            errors.append(f"Row {index}: Box ID must be empty for {biomaterial}")
+            errors.append(ErrorRecord(index, "cells.box_id", "box_id", (box_id, biomaterial)))
         if rack not in range(1,101): 
-            errors.append(f"Row {index}: Invalid rack number '{rack}' for {biomaterial} (must be 1-100)")
+            errors.append(ErrorRecord(index, "cells.rack", "rack", (rack, biomaterial)))
                                                
                           
     #Eception
     else:
-        errors.append(f"Row {index}: Unknown or unsupported material '{biomaterial}'")
+        errors.append(ErrorRecord(index, "unknown_material", "biomaterial", (biomaterial,)))
    
     # General checks
     if tube_status not in VALID_TUBE_STATUS: 
-        errors.append(f"Row {index}: Invalid tube_status '{tube_status}' for {biomaterial} (must be 1-5)")   
+        errors.append(ErrorRecord(index, "invalid_tube_status", "tube_status", (tube_status, biomaterial)))   
         
     if not study_id:
-        errors.append(f"Row {index}: Missing study_id")
+        errors.append(ErrorRecord(index, "missing_study_id", "study_id"))
 
     elif not STUDY_ID_PATTERN.fullmatch(study_id):
-        errors.append(f"Row {index}: Invalid study_id format '{study_id}'")
+        errors.append(ErrorRecord(index, "invalid_study_id", "study_id", (study_id,)))
         
     #print(
     #"DEBUG study_id:",
@@ -148,40 +162,171 @@ def validate_row(row, index):
     #"match:",
     #bool(STUDY_ID_PATTERN.fullmatch(study_id)))
 
+    if errors:
+        set_box(errors, (freezer, rack, box))
     return errors
 
 
-def validate_reference_file(path, label):
+def validate_reference_file(path, label, columnar=False, workers=1, cache=None):
     """
     Core function from GUI. Validates an entire CSV file and raises ValueError if anything is wrong. The validation
     is done line by line.
     
     Args:
-        path (str): Path to the CSV file
+        path (str): Path to the CSV file or binary snapshot (binary_snapshot.py)
         label (str): Descriptive label (e.g. "Reference File")
+        columnar (bool): Validate with the NumPy columnar engine (columnar.py). The error lists are then
+            only returned for the failing rows.
+        workers (int): Validate the rows in chunks on this many processes (parallel.py)
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py); single process only
 
     Returns:
-        rows List[dict]: List of rows from the reference file. The row is handeled like a dictionary.
+        rows List[TubeRecord]: Normalized rows from the reference file (records.py). The row can still be
+            handeled like a dictionary (record.get).
     """
     errors_list = []
-    print(f" Checking {label}: {path}")
-    headers, rows = read_csv(path)
+    log.info(" Checking %s: %s", label, path)
+    with instrumentation.span("reference.read_csv") as stage:
+        headers, rows = read_snapshot(path) if is_snapshot(path) else read_csv(path)
+        stage.rows = len(rows)
     
     # Check for required column headers - in validate row its done again so it can be passed to erros
     structure_errors = check_structure(headers)
     if structure_errors:
         raise ValueError(f"Missing required columns in {label}: {structure_errors}")
-    
-    for i, row in enumerate(rows, start=2):
-        errors_list.append(validate_row(row, i))  # will raise immediately if invalid; here errors need to be passed out! 
-        #otherwise the report will not see the errors!
+
+    with instrumentation.span("reference.validate_rows", rows=len(rows)):
+        rows = normalize_rows(rows)
+
+        if columnar:
+            from columnar import validate_rows_columnar  # imported here, it loads NumPy
+            errors_list = validate_rows_columnar(rows)
+        elif workers > 1:
+            errors_list, _, _ = merge_scans(scan_parallel(rows, workers))
+        else:
+            validate = cache.validate if cache is not None else validate_row_compiled
+            for i, row in enumerate(rows, start=2):
+                errors_list.append(validate(row, i))  # will raise immediately if invalid; here errors need to be passed out! 
+                #otherwise the report will not see the errors!
 
     ### Here fehlt aktuell der raise der validation checks das sollte ich morgen mit sophie besprechen
-    print(f" {label} passed all validation checks.\n")
+    log.info(" %s passed all validation checks.\n", label)
     return rows, errors_list  # return rows if valid; das ergibt keinen sinn? wofür gebe ich den rows zurück? habe das 
     #jetzt mal raus genommen
     
-def validate_import_file(path, label, reference_rows):
+def validate_reference_stream(path, label, check_duplicates=True, workers=1, error_sink=None, cache=None,
+                              columnar=False):
+    """
+    Core function for large reference files. Streaming version of validate_reference_file: the rows
+    are read, validated and aggregated one at a time, so only the ReferenceIndex the later stages need
+    (occupied positions, instance maps, lab id maps) and the errors of failing rows are kept in memory.
+    Optionally the internal duplicate check of the reference data runs in the same pass.
+
+    Args:
+        path (str): Path to the CSV file or binary snapshot (binary_snapshot.py)
+        label (str): Descriptive label (e.g. "Reference data")
+        check_duplicates (bool): Also run check_internal_duplicates in the same pass
+        workers (int): Validate the rows in chunks on this many processes (parallel.py); the
+            index and the duplicate check stay in this process and in row order
+        error_sink (function, optional): Called with the errors of every failing row as soon as the row
+            is validated, e.g. reporting.ReportWriter.add_row_errors
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py); single process only
+        columnar (bool): Validate with the NumPy columnar engine, see validate_reference_rows
+
+    Returns:
+        reference (ReferenceIndex): Index of the reference rows
+        errors_list List[List[ErrorRecord]]: Error lists of the failing rows only
+    """
+    log.info(" Checking %s: %s", label, path)
+    headers, rows = iter_snapshot(path) if is_snapshot(path) else iter_csv(path)
+    return validate_reference_rows(headers, rows, label, check_duplicates, workers, error_sink, cache, columnar)
+
+
+def validate_reference_rows(headers, rows, label, check_duplicates=True, workers=1, error_sink=None, cache=None,
+                            columnar=False):
+    """
+    Core function. Validates and aggregates reference rows from any iterator in one pass, e.g. the
+    records of a REDCap export while they are still downloading (redcap_api.RedcapClient).
+    See validate_reference_stream.
+
+    Args:
+        headers (List[str] | None): Column names of the rows
+        rows (Iterator[Dict]): Reference rows, consumed once
+        label (str): Descriptive label (e.g. "Reference data")
+        check_duplicates (bool): Also run check_internal_duplicates in the same pass
+        workers (int): Validate the rows in chunks on this many processes (parallel.py)
+        error_sink (function, optional): Called with the errors of every failing row, in row order
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py); single process only
+        columnar (bool): Validate with the NumPy columnar engine (columnar.py). The records are then
+            collected first (no streaming), workers and cache are not used.
+
+    Returns:
+        reference (ReferenceIndex): Index of the reference rows
+        errors_list List[List[ErrorRecord]]: Error lists of the failing rows only
+    """
+    structure_errors = check_structure(headers or [])
+    if structure_errors:
+        if hasattr(rows, "close"):
+            rows.close()
+        raise ValueError(f"Missing required columns in {label}: {structure_errors}")
+
+    reference = ReferenceIndex()
+    errors_list = []
+    seen_positions = {}
+    duplicate_count = 0
+
+    # the rows are read (or downloaded) while they are validated, so the span covers both
+    with instrumentation.span("reference.validate") as stage:
+        if columnar:
+            from columnar import validate_rows_columnar  # imported here, it loads NumPy
+            records = list(iter_records(rows))
+            errors_list = validate_rows_columnar(records)
+            if error_sink is not None:
+                for row_errors in errors_list:
+                    error_sink(row_errors)
+            for i, record in enumerate(records, start=2):
+                reference.add(record)
+                if check_duplicates:
+                    duplicate_count += check_position_reuse(
+                        seen_positions, record.position_key, record.tube_status, i, label
+                    )
+        elif workers > 1:
+            for _, (chunk_errors, _, chunk_positions, entries) in scan_parallel(rows, workers, index=True):
+                for row_errors in chunk_errors:
+                    if row_errors:
+                        errors_list.append(row_errors)
+                        if error_sink is not None:
+                            error_sink(row_errors)
+                # the workers normalized the rows already
+                for entry in entries:
+                    reference.add_entry(entry)
+                if check_duplicates:
+                    for i, key, status in chunk_positions:
+                        duplicate_count += check_position_reuse(seen_positions, key, status, i, label)
+        else:
+            validate = cache.validate if cache is not None else validate_row_compiled
+            for i, record in enumerate(iter_records(rows), start=2):
+                row_errors = validate(record, i)
+                if row_errors:
+                    errors_list.append(row_errors)
+                    if error_sink is not None:
+                        error_sink(row_errors)
+                reference.add(record)
+                if check_duplicates:
+                    duplicate_count += check_position_reuse(
+                        seen_positions, record.position_key, record.tube_status, i, label
+                    )
+        stage.rows = reference.row_count
+    instrumentation.count("reference.error_rows", len(errors_list))
+
+    if check_duplicates:
+        report_internal_duplicates(duplicate_count, label)
+
+    log.info(" %s passed all validation checks.\n", label)
+    return reference, errors_list
+
+
+def validate_import_file(path, label, reference_rows, ref_instances=None, columnar=False, workers=1, cache=None):
     """
     Core function from GUI. Validates the import CSV file and raises ValueError if anything is wrong. The validation
     is done line by line and for the tubeinstances accross the whole file. 
@@ -189,29 +334,58 @@ def validate_import_file(path, label, reference_rows):
     Args:
         path (str): Path to the CSV file
         label (str): Descriptive label (e.g. "Import file")
-        reference_rows List[Dict]: Reference rows from previous call of validate_reference_file.  
+        reference_rows List[Dict] | ReferenceIndex: Reference rows from previous call of validate_reference_file
+            or the ReferenceIndex from validate_reference_stream.  
+        ref_instances (Set[Tuple], optional): Precomputed reference instance keys. If given, reference_rows
+            is not needed.
+        columnar (bool): Validate the rows with the NumPy columnar engine (columnar.py)
+        workers (int): Validate the rows in chunks on this many processes (parallel.py); the
+            instance check then runs on the merged instance keys of the chunks
+        cache (RowCache, optional): Reuse the row results of unchanged rows (rowcache.py); single process
+            only, the instance check always runs on all rows
 
     Returns:
-        rows List[dict]: List of rows from the to be validated file. The row is handeled like a dictionary.
+        rows List[TubeRecord]: Normalized rows from the to be validated file (records.py). The row can still
+            be handeled like a dictionary (record.get), record.to_dict() returns the original row.
     """
     
-    headers, rows = read_csv(path)
+    with instrumentation.span("import.read_csv") as stage:
+        headers, rows = read_csv(path)
+        stage.rows = len(rows)
 
     # 1. structure
     structure_errors = check_structure(headers)
     if structure_errors:
         raise ValueError(f"Missing required columns in {label}: {structure_errors}")
-    
-    # 2. row-level validation
-    all_row_errors = []
-    for i, row in enumerate(rows, start=2):
-        all_row_errors.extend(validate_row(row, i))
+
+    # normalize once; the records write lab IDs and instances back to the original rows
+    with instrumentation.span("import.validate_rows", rows=len(rows)):
+        rows = normalize_rows(rows, keep_source=True)
+
+        # 2. row-level validation
+        all_row_errors = []
+        instance_keys = None
+        if columnar:
+            from columnar import validate_rows_columnar  # imported here, it loads NumPy
+            for row_errors in validate_rows_columnar(rows):
+                all_row_errors.extend(row_errors)
+        elif workers > 1:
+            errors_list, instance_keys, _ = merge_scans(scan_parallel(rows, workers))
+            for row_errors in errors_list:
+                all_row_errors.extend(row_errors)
+        else:
+            validate = cache.validate if cache is not None else validate_row_compiled
+            for i, row in enumerate(rows, start=2):
+                all_row_errors.extend(validate(row, i))
 
     # 3. dataset-level validation
-    instance_errors = validate_tube_instances(
-        import_rows=rows,
-        reference_rows=reference_rows
-    )
+    with instrumentation.span("import.validate_instances", rows=len(rows)):
+        instance_errors = validate_tube_instances(
+            import_rows=rows,
+            reference_rows=reference_rows,
+            ref_instances=ref_instances,
+            instance_keys=instance_keys,
+        )
 
     all_errors = all_row_errors + instance_errors + structure_errors
 
@@ -233,7 +407,7 @@ def validate_file(path, label):
     Returns:
         rows List[dict]: List of rows from the to be validated file. The row is handeled like a dictionary.
     """
-    print(f" Checking {label}: {path}")
+    log.info(" Checking %s: %s", label, path)
     headers, rows = read_csv(path)
     
     # Check for required column headers - so in the document not on the 
@@ -244,44 +418,52 @@ def validate_file(path, label):
     for i, row in enumerate(rows, start=2):
         validate_row(row, i)  # will raise immediately if invalid
 
-    print(f" {label} passed all validation checks.\n")
+    log.info(" %s passed all validation checks.\n", label)
     return rows  # return rows if valid
 
 
-def validate_tube_instances(import_rows, reference_rows):
+def validate_tube_instances(import_rows, reference_rows, ref_instances=None, instance_keys=None):
     """
     Validation function. Validates import and ref files for the instances. It is of
     utter importance that for each patient the RedCap instances are unique. 
 
     Args:
         import_rows (Dict): Imported rows from import file
-        ref_rows (Dict): Reference rows from RedCap Download.
+        ref_rows (Dict | ReferenceIndex): Reference rows from RedCap Download or their index.
+        ref_instances (Set[Tuple], optional): Precomputed (study_id, instance) keys of the reference
+            data, e.g. ReferenceIndex.instance_keys. If given, reference_rows is not scanned.
+        instance_keys (List[Tuple], optional): Precomputed (row number, (study_id, instance)) of the
+            complete import instance keys in row order, e.g. merged from parallel.scan_parallel.
+            If given, import_rows is not scanned.
 
     Returns:
-        errors List[str]: List of instance validation error messages in total. 
+        errors List[ErrorRecord]: Instance validation errors in total.
     """
     errors = []
 
-    ref_instances = set()
-    for row in reference_rows:
-        key = make_instance_key(row)
-        if all(key):
-            ref_instances.add(key)
+    if ref_instances is None and isinstance(reference_rows, ReferenceIndex):
+        ref_instances = reference_rows.instance_keys
+    if ref_instances is None:
+        ref_instances = set()
+        for record in iter_records(reference_rows):
+            if record.instance_key is not None:
+                ref_instances.add(record.instance_key)
     seen_import_instances = set()
 
-    for idx, row in enumerate(import_rows, start=1):
-        key = make_instance_key(row)
-
-        if not all(key):
-            continue  #fehlende Felder werden anderswo geprüft
+    if instance_keys is None:
+        instance_keys = (
+            (i, record.instance_key) for i, record in enumerate(iter_records(import_rows), start=2)
+            if record.instance_key is not None  #fehlende Felder werden anderswo geprüft
+        )
 
+    for i, key in instance_keys:
+        idx = i - 1  # instance errors count the data rows from 1
         study_id, instance = key
 
         #Doppelt im Importfile (pro Patient!)
         if key in seen_import_instances:
             errors.append(
-                f"Row {idx}: Duplicate tube instance {instance} "
-                f"for patient {study_id} in import file."
+                ErrorRecord(idx, "duplicate_instance", "redcap_repeat_instance", (instance, study_id))
             )
         else:
             seen_import_instances.add(key)
@@ -289,10 +471,10 @@ def validate_tube_instances(import_rows, reference_rows):
         #Überschreiben verhindern
         if key in ref_instances:
             errors.append(
-                f"Row {idx}: Tube instance {instance} for patient {study_id} "
-                f"already exists in REDCap and must not be overwritten."
+                ErrorRecord(idx, "instance_exists", "redcap_repeat_instance", (instance, study_id))
             )
-    print(errors)
+    for error in errors:
+        log_limited(log, logging.WARNING, "Instance check: %s", error)
     return errors
 
 
@@ -324,109 +506,139 @@ def check_duplicate_positions_old(import_rows, occupied_positions, label="Import
     if errors:
         raise ValueError(f"{label} – {len(errors)} duplicate position error(s):\n" + "\n".join(errors))
     else:
-        print(f"No duplicate positions found between import and reference data.")
+        log.info("No duplicate positions found between import and reference data.")
         return 0
 
-def check_duplicate_positions(import_rows, occupied_positions, reference_rows):
+def check_duplicate_positions(import_rows, occupied_positions, reference_rows, tube_map=None):
     """
     Allows duplicate positions IF the row refers to an existing tube (update case).
+
+    reference_rows can be a ReferenceIndex, its occupied positions and tube map are then used
+    (occupied_positions may be None). tube_map can also be passed precomputed; reference_rows is
+    then not scanned.
     """
 
     duplicate_count = 0
 
-    #  Build tube map to detect existing tubes
-    _, tube_map = build_instance_maps(reference_rows)
+    if isinstance(reference_rows, ReferenceIndex):
+        if occupied_positions is None:
+            occupied_positions = reference_rows.occupied_positions
+        if tube_map is None:
+            tube_map = reference_rows.tube_map
 
-    for i, row in enumerate(import_rows, start=2):
+    #  Build tube map to detect existing tubes
+    if tube_map is None:
+        _, tube_map = build_instance_maps(reference_rows)
 
-        study_id = str(row.get("study_id", "")).strip()
+    for i, record in enumerate(iter_records(import_rows), start=2):
 
-        # --- build tube key (same logic as before!) ---
-        tube_key = get_tube_key(row)
+        # --- tube key: tube_id, else the complete position ---
+        tube_key = record.tube_key
 
         if not tube_key:
-            print(f"Row {i}: Cannot determine tube identity.")
+            log_limited(log, logging.WARNING, "Row %s: Cannot determine tube identity.", i)
             duplicate_count += 1
             continue
 
-        is_existing_tube = (study_id, tube_key) in tube_map
+        is_existing_tube = (record.study_id, tube_key) in tube_map
 
-        key = (
-            str(row.get("freezer", "")).strip(),
-            str(row.get("rack", "")).strip(),
-            str(row.get("box", "")).strip(),
-            str(row.get("tube_pos", "")).strip(),
-        )
+        key = record.position_key
 
         #  MAIN LOGIC
         if key in occupied_positions:
 
             if is_existing_tube:
                 #  allowed → update of same tube
-                print(f"Row {i}: Position {key} already occupied (update allowed).")
+                log_limited(log, logging.INFO, "Row %s: Position %s already occupied (update allowed).", i, key)
                 continue
 
             else:
                 #  real conflict → new tube trying to overwrite
-                print(f"Row {i}: Position {key} is already occupied.")
+                log_limited(log, logging.WARNING, "Row %s: Position %s is already occupied.", i, key)
                 duplicate_count += 1
 
     if duplicate_count == 0:
-        print("No invalid duplicate positions found.")
+        log.info("No invalid duplicate positions found.")
     else:
-        print(f"{duplicate_count} duplicate position error(s) found.")
+        log.warning("%d duplicate position error(s) found.", duplicate_count)
 
     return duplicate_count
 
-def check_internal_duplicates(rows, file_label="File"):
+def check_internal_duplicates(rows, file_label="File", workers=1):
     """
     Checks for duplicate positions within a file.
     Allows duplicates if not both tubes are 'stored'.
+
+    With workers > 1 the positions are extracted chunk-wise in a process pool (parallel.py) and
+    checked on the merged position index in row order.
     """
 
     seen = {}
     duplicate_count = 0
 
-    for i, row in enumerate(rows, start=2):
+    with instrumentation.span("duplicates.internal", rows=len(rows) if hasattr(rows, "__len__") else 0):
+        if workers > 1:
+            _, _, positions = merge_scans(scan_parallel(rows, workers, validate=False))
+        else:
+            positions = (
+                (i, record.position_key, record.tube_status)
+                for i, record in enumerate(iter_records(rows), start=2)
+            )
 
-        key = (
-            str(row.get("freezer", "")).strip(),
-            str(row.get("rack", "")).strip(),
-            str(row.get("box", "")).strip(),
-            str(row.get("tube_pos", "")).strip(),
-        )
+        for i, key, status in positions:
+            duplicate_count += check_position_reuse(seen, key, status, i, file_label)
 
-        status = str(row.get("tube_status", "")).strip()
+    report_internal_duplicates(duplicate_count, file_label)
 
-        if not all(key):
-            continue
+    return #duplicate_count
 
-        if key in seen:
-            prev_status, prev_row = seen[key]
 
-            #  CRITICAL LOGIC
-            if status == "1" and prev_status == "1":
-                print(
-                    f"{file_label} Row {i}: Position {key} duplicated "
-                    f"(both stored) also seen in row {prev_row}"
-                )
-                duplicate_count += 1
-            else:
-                #  allowed duplicate
-                print(
-                    f"{file_label} Row {i}: Position {key} reused "
-                    f"(status change or inactive tube)"
-                )
+def check_position_reuse(seen, key, status, i, file_label="File"):
+    """
+    Helper function. Checks one row for an internal duplicate position against the positions
+    seen so far in the same file and remembers its position.
 
-        else:
-            seen[key] = (status, i)
+    Args:
+        seen (Dict): Mapping from (freezer, rack, box, pos) -> (tube_status, row number) of earlier rows
+        key (Tuple | None): (freezer, rack, box, pos) of the row, see TubeRecord.position_key
+        status (str): tube_status of the row
+        i (int): Row number of the row
+        file_label (str): Descriptive name for the output
+
+    Returns:
+        int: 1 if the position is duplicated by two stored tubes, otherwise 0
+    """
+    if key is None or not all(key):
+        return 0
 
+    if key in seen:
+        prev_status, prev_row = seen[key]
+
+        #  CRITICAL LOGIC
+        if status == "1" and prev_status == "1":
+            log_limited(
+                log, logging.WARNING, "%s Row %s: Position %s duplicated (both stored) also seen in row %s",
+                file_label, i, key, prev_row,
+            )
+            return 1
+        #  allowed duplicate
+        log_limited(
+            log, logging.INFO, "%s Row %s: Position %s reused (status change or inactive tube)", file_label, i, key
+        )
+        return 0
+
+    seen[key] = (status, i)
+    return 0
+
+
+def report_internal_duplicates(duplicate_count, file_label="File"):
+    """
+    Helper function. Logs the summary line of the internal duplicate check.
+    """
     if duplicate_count == 0:
-        print(f"No invalid internal duplicates in {file_label}.")
+        log.info("No invalid internal duplicates in %s.", file_label)
     else:
-        print(f"{duplicate_count} duplicate error(s) in {file_label}.")
-
-    return #duplicate_count
+        log.warning("%d duplicate error(s) in %s.", duplicate_count, file_label)
     
 def check_internal_duplicates_old(rows, label):
     """
@@ -460,6 +672,6 @@ def check_internal_duplicates_old(rows, label):
         details = "\n".join([f" - Position {k} found on rows {v}" for k, v in duplicates.items()])
         raise ValueError(f"Duplicate positions found within {label}:\n{details}")
     else:
-        print(f"No duplicate positions found within {label}.")
+        log.info("No duplicate positions found within %s.", label)
         
     return 
\ No newline at end of file
@@ -0,0 +1,323 @@
+"""
+Watch-folder daemon: validates every import CSV saved to a folder against a warm reference index.
+
+The reference data is loaded once (file or REDCap download, same options as cli.py) and kept in memory
+as ReferenceIndex; a background thread refreshes it every --refresh minutes (a reference file also
+when it changes) and swaps it in when it is complete, so validations never wait for a download. New
+files are picked up by polling (works on network shares, where file system events are unreliable):
+a file is processed once its size and modification time did not change between two polls and it
+ends with a complete row, i.e. within about a second when --interval is 0.5. For every import file it
+writes next to it
+
+    <name>_report.txt     the validation report (--report-format for csv, jsonl or html)
+    <name>_validated.csv  the import rows with lab_id and redcap_repeat_instance filled in
+
+The import file itself is not changed. Lab IDs and instances are reserved in an allocator database
+(allocator.py, by default .bioval_ids.sqlite in the folder), so files validated one after the other
+never get the same numbers before they are uploaded.
+
+    python watcher.py /shared/imports -r data/Ref_file.csv
+    python watcher.py /shared/imports -r /tmp/ref.csv --download --cache-dir snapshots --refresh 15
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import utils as u
+from cli import add_reference_arguments, add_log_arguments, configure_logging, load_reference
+from pipeline import check_import
+from batch import is_import_file
+from allocator import IdAllocator
+from reporting import FORMATS, DEFAULT_EXTENSIONS, open_report
+from diagnostics import get_logger, report_suppressed
+
+log = get_logger("watcher")
+
+SETTLE_SECONDS = 3.0
+
+
+def output_paths(import_path, report_format="text"):
+    """
+    Helper function. Report and corrected file of an import file.
+
+    Returns:
+        report_path (str): e.g. import_1.csv -> import_1_report.txt
+        validated_path (str): e.g. import_1.csv -> import_1_validated.csv
+    """
+    stem, _ = os.path.splitext(import_path)
+    return f"{stem}_report{DEFAULT_EXTENSIONS[report_format]}", f"{stem}_validated.csv"
+
+
+class WarmReference:
+    """
+    The reference index kept in memory, refreshed in a background thread.
+
+    Attributes:
+        reference (ReferenceIndex): Current index; replaced as a whole on refresh
+        errors (List[List[ErrorRecord]]): Validation errors of the current reference
+        loaded_at (float): time.time() of the last load
+    """
+
+    def __init__(self, args, refresh_seconds, allocator=None):
+        self.args = args
+        self.refresh_seconds = refresh_seconds
+        self.allocator = allocator
+        self.lock = threading.Lock()
+        self.refreshing = None
+        self.reference, self.errors = None, None
+        self.loaded_at = 0.0
+        self.source_mtime = None
+        self.load()
+
+    def source_changed(self):
+        """
+        Helper function. True if the reference file changed since the last load (not for downloads).
+        """
+        if self.args.download:
+            return False
+        try:
+            return os.path.getmtime(self.args.reference) != self.source_mtime
+        except OSError:
+            return False
+
+    def load(self):
+        """
+        Core function. Loads the reference and swaps in the new index.
+        """
+        start = time.perf_counter()
+        mtime = None if self.args.download else os.path.getmtime(self.args.reference)
+        reference, errors = load_reference(self.args)
+        if self.allocator is not None:
+            stats = self.allocator.reconcile(reference)
+            log.info(
+                "Allocator: %d uploaded, %d dropped, %d expired, %d pending",
+                stats["uploaded"], stats["dropped"], stats["expired"], stats["pending"],
+            )
+        with self.lock:
+            self.reference, self.errors = reference, errors
+            self.loaded_at = time.time()
+            self.source_mtime = mtime
+        log.info("Reference loaded: %d rows in %.1fs", reference.row_count, time.perf_counter() - start)
+
+    def refresh_due(self):
+        return time.time() - self.loaded_at >= self.refresh_seconds or self.source_changed()
+
+    def refresh_in_background(self, force=False):
+        """
+        Core function. Starts a refresh if one is due (or force) and none is running; the old index
+        stays in use until the new one is complete.
+        """
+        if self.refreshing is not None and self.refreshing.is_alive():
+            return
+        if not force and not self.refresh_due():
+            return
+
+        def refresh():
+            try:
+                self.load()
+            except Exception as e:  # keep the old index, try again at the next refresh
+                log.error("Reference refresh failed, keeping the loaded reference: %s", e)
+                with self.lock:
+                    self.loaded_at = time.time()
+
+        self.refreshing = threading.Thread(target=refresh, name="reference-refresh", daemon=True)
+        self.refreshing.start()
+
+    def current(self):
+        """
+        Returns:
+            reference (ReferenceIndex): Current index
+            errors (List[List[ErrorRecord]]): Its validation errors
+        """
+        with self.lock:
+            return self.reference, self.errors
+
+
+def ends_with_newline(path):
+    """
+    Helper function. True if the last byte of a file is a line break; a CSV that is still being
+    written usually ends in the middle of a row.
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) in (b"\n", b"\r")
+    except OSError:
+        return False
+
+
+def is_up_to_date(import_path, report_format):
+    """
+    Helper function. True if the report of a file is newer than the file (validated before a restart).
+    """
+    report_path, _ = output_paths(import_path, report_format)
+    try:
+        return os.path.getmtime(report_path) >= os.path.getmtime(import_path)
+    except OSError:
+        return False
+
+
+def validate_dropped_file(import_path, warm, report_format="text", workers=1, allocator=None):
+    """
+    Core function. Validates one import file against the warm reference and writes the report and the
+    corrected file next to it. Hard errors (e.g. missing columns) are written to the report as well.
+
+    Args:
+        import_path (str): Path of the import CSV
+        warm (WarmReference): Loaded reference
+        report_format (str): Format of the report (reporting.FORMATS)
+        workers (int): Number of processes for the row validation
+        allocator (IdAllocator, optional): Allocator for the new lab IDs and instances
+
+    Returns:
+        int | None: Number of errors, None on a hard error
+    """
+    report_path, validated_path = output_paths(import_path, report_format)
+    reference, reference_errors = warm.current()
+    start = time.perf_counter()
+    try:
+        import_rows, import_errors, labid_messages, instance_messages, duplicate_count = check_import(
+            import_path, reference, workers=workers, write_back=False, allocator=allocator
+        )
+        u.save_data_as_csv(import_rows, validated_path)
+        u.write_report(
+            report_path, import_path, import_rows, warm.args.reference, import_errors, reference_errors,
+            labid_messages, instance_messages, fmt=report_format,
+        )
+    except Exception as e:
+        log.error("%s: %s", os.path.basename(import_path), e)
+        with open_report(report_path, report_format, inputs=[("Import", import_path)]) as report:
+            with report.section("hard_error", "Validation Error:"):
+                report.add_messages([e])
+        return None
+    finally:
+        report_suppressed()
+
+    error_count = len(import_errors) + duplicate_count
+    log.info(
+        "%s: %d rows, %d errors in %.2fs -> %s, %s", os.path.basename(import_path), len(import_rows),
+        error_count, time.perf_counter() - start, os.path.basename(report_path), os.path.basename(validated_path),
+    )
+    return error_count
+
+
+def watch(folder, warm, pattern="*.csv", interval=0.5, report_format="text", workers=1, allocator=None,
+          once=False, stop=None):
+    """
+    Core function. Polls the folder and validates every new or changed import file once it is
+    completely written.
+
+    Args:
+        folder (str): Watched folder
+        warm (WarmReference): Loaded reference, refreshed while watching
+        pattern (str): File name pattern of the import files
+        interval (float): Seconds between two polls
+        report_format (str): Format of the reports
+        workers (int): Number of processes for the row validation
+        allocator (IdAllocator, optional): Allocator for the new lab IDs and instances
+        once (bool): Validate the files that are there now and return
+        stop (threading.Event, optional): Ends the loop when set
+    """
+    done = {}     # path -> (size, mtime) validated
+    pending = {}  # path -> ((size, mtime), time first seen unchanged)
+    stop = stop or threading.Event()
+    log.info("Watching %s for %s files", folder, pattern)
+    while not stop.is_set():
+        warm.refresh_in_background()
+        try:
+            names = os.listdir(folder)
+        except OSError as e:
+            log.error("Cannot read %s: %s", folder, e)
+            names = []
+        for name in sorted(names):
+            path = os.path.join(folder, name)
+            if not is_import_file(name, pattern) or not os.path.isfile(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state = (stat.st_size, stat.st_mtime)
+            if done.get(path) == state:
+                continue
+            if path not in done and is_up_to_date(path, report_format):
+                done[path] = state
+                continue
+            if state[0] == 0:
+                continue
+            # still being written: wait until size and time stay the same for one poll and the file
+            # ends with a complete row (files without final line break after SETTLE_SECONDS)
+            if not once:
+                seen_state, since = pending.get(path, (None, None))
+                if seen_state != state:
+                    pending[path] = (state, time.monotonic())
+                    continue
+                if not ends_with_newline(path) and time.monotonic() - since < SETTLE_SECONDS:
+                    continue
+            pending.pop(path, None)
+            validate_dropped_file(path, warm, report_format, workers, allocator)
+            done[path] = state
+        if once:
+            return
+        stop.wait(interval)
+
+
+def build_parser():
+    """
+    Helper function. Builds the argument parser of the watcher.
+    """
+    parser = argparse.ArgumentParser(
+        prog="bioval-watch",
+        description="Validate import CSVs dropped into a folder against a reference kept in memory.",
+    )
+    parser.add_argument("folder", help="Folder the import files are saved to.")
+    add_reference_arguments(parser)
+    parser.add_argument("--pattern", default="*.csv", help="File name pattern of the import files (default: *.csv).")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between two polls (default: 0.5).")
+    parser.add_argument(
+        "--refresh", type=float, default=15,
+        help="Reload the reference every N minutes (default: 15); a reference file also when it changes.",
+    )
+    parser.add_argument("--report-format", choices=FORMATS, default="text", help="Format of the reports.")
+    parser.add_argument(
+        "--allocator-db", metavar="FILE",
+        help="SQLite file of the lab ID / instance reservations (default: .bioval_ids.sqlite in the folder).",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Processes for the row validation.")
+    parser.add_argument("--once", action="store_true", help="Validate the files in the folder now and exit.")
+    add_log_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the watcher; runs until interrupted (Ctrl+C).
+
+    Returns:
+        int: Exit code - 0 on a regular end, 2 if the reference could not be loaded
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.folder):
+        parser.error(f"{args.folder} is not a folder")
+    if args.interval <= 0 or args.refresh <= 0 or args.workers < 1:
+        parser.error("--interval and --refresh must be positive, --workers at least 1")
+    configure_logging(parser, args)
+
+    allocator = IdAllocator(args.allocator_db or os.path.join(args.folder, ".bioval_ids.sqlite"))
+    try:
+        warm = WarmReference(args, args.refresh * 60, allocator)
+    except Exception as e:
+        log.error("Could not load the reference data: %s", e)
+        return 2
+    try:
+        watch(args.folder, warm, args.pattern, args.interval, args.report_format, args.workers, allocator, args.once)
+    except KeyboardInterrupt:
+        log.info("Stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())